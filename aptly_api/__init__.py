@@ -1 +1,79 @@
-from .api import *
+"""
+Lightweight interface for aptly's REST API
+
+Submodules are imported when one of their names is first used, so
+that tools that end up not talking to aptly don't pay for requests.
+"""
+
+import importlib
+
+_exports = {
+	"api" : [
+		"LOCK_FILE",
+		"UNIX_SOCKET_PREFIX",
+		"UNIX_SOCKET_URL",
+		"UPLOAD_BUFFER_SIZE",
+		"decapitalize",
+		"AptlyAPILock",
+		"AptlyAPIError",
+		"VerifiedUpload",
+		"UnixSocketConnection",
+		"UnixSocketConnectionPool",
+		"UnixSocketAdapter",
+		"AptlyAPIProxyObject",
+		"AptlySession",
+	],
+	"api_mapping" : [
+		"APIDescription",
+		"AptlyAPISigningOptions",
+		"AptlyAPISnapshots",
+		"snake_to_camel",
+		"convert_param",
+		"get_aptly_mapping",
+		"aptly_mapping",
+	],
+	"limiter" : [
+		"LIMITS_DIRECTORY",
+		"ROUTE_CLASSES",
+		"DEFAULT_LIMITS",
+		"LATENCY_SENSITIVE",
+		"get_route_class",
+		"get_limits_path",
+		"AdaptiveLimit",
+		"SharedLimit",
+		"ConcurrencyLimiter",
+	],
+	"mirror" : [
+		"get_mirror_path",
+		"split_ref",
+		"MetadataMirror",
+	],
+	"router" : [
+		"DEFAULT_SHARD",
+		"DEFAULT_URL",
+		"DEFAULT_POOL_SIZE",
+		"AptlyRouter",
+	],
+}
+
+_modules = {
+	name : module
+	for module, names in _exports.items()
+	for name in names
+}
+
+def __getattr__(name):
+	"""
+	Imports the submodule providing the given name.
+	"""
+
+	if not name in _modules:
+		raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+	value = getattr(importlib.import_module(".%s" % _modules[name], __name__), name)
+	globals()[name] = value
+
+	return value
+
+def __dir__():
+	return sorted(set(globals()) | set(_modules))
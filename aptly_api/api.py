@@ -34,16 +34,42 @@ import os
 
 import time
 
+import fcntl
+
+import socket
+
+import uuid
+
+import hashlib
+
 import requests
 
 import urllib.parse
 
+import urllib3.connection
+
+import urllib3.connectionpool
+
+from functools import partial
+
 from contextlib import contextmanager
 
-from .api_mapping import AptlyAPISigningOptions, snake_to_camel, convert_param, aptly_mapping
+from .api_mapping import snake_to_camel, convert_param, get_aptly_mapping
+
+from .limiter import get_route_class
 
 LOCK_FILE = "/run/aptly-intake/aptly-api-lock"
 
+# Prefix of the urls of aptly instances listening on a unix socket,
+# e.g. unix:///run/aptly-api/production.sock
+UNIX_SOCKET_PREFIX = "unix://"
+
+# Base url used for the requests sent over a unix socket
+UNIX_SOCKET_URL = "http://aptly-api.socket/"
+
+# Size of the chunks read (and sent) when streaming uploads
+UPLOAD_BUFFER_SIZE = 4 * 1024 * 1024
+
 def decapitalize(string):
 	"""
 	De-capitalizes a string.
@@ -52,19 +78,259 @@ def decapitalize(string):
 	return string[:1].lower() + string[1:] if string else ""
 
 @contextmanager
-def AptlyAPILock():
-	if os.path.exists(LOCK_FILE):
-		# Wait
-		print("Lock file %s exists, waiting..." % LOCK_FILE)
-		time.sleep(5)
+def AptlyAPILock(shard=None):
+	"""
+	Holds an exclusive lock on LOCK_FILE, waiting for it if needed.
+
+	The time the lock has been held for is printed when it's released.
+
+	:param: shard: the name of the aptly instance to lock, if it's not
+	the default one. Every instance has its own lock file, so that
+	they can be operated on at the same time.
+	"""
+
+	lock_file = LOCK_FILE if shard is None else "%s.%s" % (LOCK_FILE, shard)
+
+	with open(lock_file, "a+") as f:
+		try:
+			fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			# Wait
+			print("Lock file %s is held, waiting..." % lock_file)
+			fcntl.flock(f, fcntl.LOCK_EX)
+
+		acquired = time.monotonic()
+
+		try:
+			f.truncate(0)
+			f.write("# File locked by aptly-intake (pid %d)\n" % os.getpid())
+			f.flush()
+
+			yield
+		finally:
+			fcntl.flock(f, fcntl.LOCK_UN)
+
+			print("Lock file %s held for %.2fs" % (lock_file, time.monotonic() - acquired))
+
+class AptlyAPIError(Exception):
+	"""
+	An error returned by aptly's REST API.
+	"""
+
+	def __init__(self, status_code, error):
+		"""
+		Initialises the class.
+
+		:param: status_code: the HTTP status code of the response
+		:param: error: the error reported by aptly
+		"""
+
+		super().__init__(
+			"Aptly API returned the following HTTP status code: %d. Error: %s" % (
+				status_code,
+				error
+			)
+		)
+
+		self.status_code = status_code
+
+class VerifiedUpload:
+	"""
+	A file to upload, verified while being streamed to aptly.
+
+	The file is read only once: every chunk is hashed (sha256 and md5
+	at the same time) and sent right away. If the size or the checksums
+	don't match the expected ones, an exception is raised before the
+	multipart body is terminated, so that the upload is aborted and aptly
+	discards it.
+	"""
+
+	def __init__(self, fileobj, size=None, sha256=None, md5=None, buffer_size=UPLOAD_BUFFER_SIZE):
+		"""
+		Initialises the class.
+
+		:param: fileobj: the file object to upload, opened in binary mode
+		:param: size: the expected size, or None
+		:param: sha256: the expected sha256 hexdigest, or None
+		:param: md5: the expected md5 hexdigest, or None
+		:param: buffer_size: the size of the chunks to read
+		"""
+
+		self.fileobj = fileobj
+		self.name = os.path.basename(fileobj.name)
+		self.size = size
+		self.expected = {
+			x : y
+			for x, y in (("sha256", sha256), ("md5", md5))
+			if y is not None
+		}
+		self.buffer_size = buffer_size
+		self.boundary = uuid.uuid4().hex
+		self.content_type = "multipart/form-data; boundary=%s" % self.boundary
+
+		actual_size = os.fstat(fileobj.fileno()).st_size - fileobj.tell()
+		if self.size is not None and self.size != actual_size:
+			raise Exception(
+				"Size mismatch for %s: expected %d bytes, found %d" % (
+					self.name,
+					self.size,
+					actual_size
+				)
+			)
+		self.size = actual_size
+
+		self._head = (
+			"--%s\r\n"
+			"Content-Disposition: form-data; name=\"file\"; filename=\"%s\"\r\n"
+			"Content-Type: application/octet-stream\r\n"
+			"\r\n" % (self.boundary, self.name)
+		).encode("utf-8")
+		self._tail = ("\r\n--%s--\r\n" % self.boundary).encode("utf-8")
+
+	def __len__(self):
+		"""
+		Returns the length of the multipart body, so that requests can
+		send a proper Content-Length.
+		"""
+
+		return len(self._head) + self.size + len(self._tail)
+
+	def chunks(self):
+		"""
+		Yields the contents of the file, verifying them as it goes.
+		"""
+
+		hashes = {
+			"sha256" : hashlib.sha256(),
+			"md5" : hashlib.md5(),
+		}
+		read = 0
+
+		for chunk in iter(lambda: self.fileobj.read(self.buffer_size), b""):
+			read += len(chunk)
+			if read > self.size:
+				raise Exception(
+					"Size mismatch for %s: file grew while being uploaded" % self.name
+				)
+
+			for digest in hashes.values():
+				digest.update(chunk)
+
+			yield chunk
+
+		if read != self.size:
+			raise Exception(
+				"Size mismatch for %s: expected %d bytes, read %d" % (
+					self.name,
+					self.size,
+					read
+				)
+			)
+
+		for algorithm, expected in self.expected.items():
+			if hashes[algorithm].hexdigest() != expected:
+				raise Exception(
+					"%s checksum mismatch for %s" % (
+						algorithm,
+						self.name
+					)
+				)
+
+		self.digests = {
+			x : y.hexdigest()
+			for x, y in hashes.items()
+		}
+
+	def verify(self):
+		"""
+		Verifies the file without uploading it.
+		"""
+
+		for chunk in self.chunks():
+			pass
+
+	def __iter__(self):
+		"""
+		Yields the multipart body, verifying the file as it goes.
+		"""
+
+		yield self._head
 
-	try:
-		with open(LOCK_FILE, "w") as f:
-			f.write("# File locked by aptly-intake\n")
+		yield from self.chunks()
+
+		yield self._tail
+
+class UnixSocketConnection(urllib3.connection.HTTPConnection):
+	"""
+	An HTTP connection over a unix socket.
+	"""
+
+	def __init__(self, *args, socket_path=None, **kwargs):
+		"""
+		Initialises the class.
+
+		:param: socket_path: the path of the socket to connect to
+		"""
 
-		yield
-	finally:
-		os.remove(LOCK_FILE)
+		self.socket_path = socket_path
+
+		super().__init__(*args, **kwargs)
+
+	def _new_conn(self):
+		"""
+		Connects to the socket.
+		"""
+
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		if isinstance(self.timeout, (int, float)):
+			sock.settimeout(self.timeout)
+		sock.connect(self.socket_path)
+
+		return sock
+
+class UnixSocketConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+	"""
+	A connection pool of UnixSocketConnection objects.
+	"""
+
+	ConnectionCls = UnixSocketConnection
+
+	def __init__(self, socket_path, host, port=None, **kwargs):
+		"""
+		Initialises the class.
+
+		:param: socket_path: the path of the socket to connect to
+		"""
+
+		super().__init__(host, port, socket_path=socket_path, **kwargs)
+
+class UnixSocketAdapter(requests.adapters.HTTPAdapter):
+	"""
+	A transport adapter that sends every request to a unix socket.
+	"""
+
+	def __init__(self, socket_path, **kwargs):
+		"""
+		Initialises the class.
+
+		:param: socket_path: the path of the socket to connect to
+		"""
+
+		self.socket_path = socket_path
+
+		super().__init__(**kwargs)
+
+	def init_poolmanager(self, *args, **kwargs):
+		"""
+		Override to HTTPAdapter().init_poolmanager() that makes the
+		pool manager use UnixSocketConnectionPool objects.
+		"""
+
+		super().init_poolmanager(*args, **kwargs)
+
+		self.poolmanager.pool_classes_by_scheme = {
+			"http" : partial(UnixSocketConnectionPool, self.socket_path),
+		}
 
 class AptlyAPIProxyObject:
 	"""
@@ -136,19 +402,53 @@ class AptlySession(requests.Session):
 	`aptly_mapping.py`).
 	"""
 
-	def __init__(self, url):
+	def __init__(self, url, shard=None, pool_size=None, mirror=None, limiter=None):
 		"""
 		Initialises the class.
 
-		:param: url: the url to connect to
+		:param: url: the url to connect to, or the path of a unix socket
+		prefixed by UNIX_SOCKET_PREFIX
+		:param: shard: the name of the aptly instance, if it's not the
+		default one
+		:param: pool_size: the number of connections to keep open, or
+		None to use requests' default
+		:param: mirror: a MetadataMirror() to keep up to date with the
+		results of the requests, or None
+		:param: limiter: a ConcurrencyLimiter() limiting the requests
+		sent at the same time, or None
 		"""
 
 		# TODO: Handle basic auth
 
-		self.url = url
+		self.shard = shard
+		self.mirror = mirror
+		self.limiter = limiter
 
 		super().__init__()
 
+		adapter_kwargs = {} if pool_size is None else {
+			"pool_connections" : 1,
+			"pool_maxsize" : pool_size,
+		}
+
+		if url.startswith(UNIX_SOCKET_PREFIX):
+			self.url = UNIX_SOCKET_URL
+			self.mount(
+				UNIX_SOCKET_URL,
+				UnixSocketAdapter(url[len(UNIX_SOCKET_PREFIX):], **adapter_kwargs)
+			)
+		else:
+			self.url = url
+			if adapter_kwargs:
+				self.mount(url, requests.adapters.HTTPAdapter(**adapter_kwargs))
+
+	def lock(self):
+		"""
+		Returns an AptlyAPILock() for this aptly instance.
+		"""
+
+		return AptlyAPILock(self.shard)
+
 	def request(self, method, url, *args, **kwargs):
 		"""
 		Override to requests.Session().request() that automatically
@@ -172,17 +472,23 @@ class AptlySession(requests.Session):
 		# are ordered-by-default, which is an implementation detail
 		# in CPython 3.6 and PyPy and spec since Python 3.7.
 
-		description = aptly_mapping[section][method]
+		description = get_aptly_mapping()[section][method]
 
 		# Check required arguments (args)
 
 		# If we should upload a file (description.post_file), we assume
-		# the first one is always the fileobject
+		# the first one is always the fileobject. VerifiedUpload objects
+		# are streamed as they are.
+		_file_description = None
+		_data = None
+		_headers = None
 		if description.post_file and len(args) > 0:
-			_file_description = { "file" : args[0] }
+			if isinstance(args[0], VerifiedUpload):
+				_data = args[0]
+				_headers = { "Content-Type" : args[0].content_type }
+			else:
+				_file_description = { "file" : args[0] }
 			args = args[1:]
-		else:
-			_file_description = None
 
 		if len(args) != len(description.required_params):
 			raise Exception(
@@ -220,35 +526,56 @@ class AptlySession(requests.Session):
 			if not y is None and x in description.query_params
 		}
 
-		result = description.method(
+		request = partial(
+			description.method,
 			self,
 			description.route % shared_state,
 			files=_file_description,
+			data=_data,
+			headers=_headers,
 			json=body_params,
 			params=query_params,
 		)
 
+		if self.limiter is not None:
+			result = self.limiter.call(get_route_class(description), request)
+		else:
+			result = request()
+
 		if not (200 <= result.status_code < 300):
 			try:
 				error = result.json().get("error", "unknown error")
 			except:
 				error = "returned result is not JSON data"
 
-			raise Exception(
-				"Aptly API returned the following HTTP status code: %d. Error: %s" % (
-					result.status_code,
-					error
-				)
-			)
+			raise AptlyAPIError(result.status_code, error)
+
+		result = result.json()
+
+		mirror = self.mirror
+		if mirror is not None:
+			# The mirror is only a cache, don't fail the request
+			try:
+				mirror.record(section, method, shared_state, body_params, query_params, result)
+			except Exception as e:
+				print("Unable to update the metadata mirror: %s" % e)
+
+				# It must not be trusted about whatever the request
+				# changed
+				try:
+					mirror.forget(section, shared_state)
+				except Exception as e:
+					print("Unable to invalidate the metadata mirror, not using it anymore: %s" % e)
+					self.mirror = None
 
-		return result.json()
+		return result
 
 	def __getattr__(self, attr):
 		"""
 		Returns an AptlyAPIProxyObject for the requested attribute.
 		"""
 
-		if not attr in aptly_mapping:
+		if not attr in get_aptly_mapping():
 			raise Exception("%s not found in the API mapping" % attr)
 
 		return AptlyAPIProxyObject(self, attr)
@@ -26,18 +26,26 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import requests
-
 from typing import List
 
+from functools import lru_cache
+
 from collections import namedtuple
 
-globals().update(
-	{
-		x : getattr(requests.Session, x)
-		for x in ["get", "post", "put", "delete"]
-	}
-)
+# HTTP methods, called with the session as the first argument. They're
+# looked up on the session so that requests isn't imported just to
+# describe the API.
+def get(session, *args, **kwargs):
+	return session.get(*args, **kwargs)
+
+def post(session, *args, **kwargs):
+	return session.post(*args, **kwargs)
+
+def put(session, *args, **kwargs):
+	return session.put(*args, **kwargs)
+
+def delete(session, *args, **kwargs):
+	return session.delete(*args, **kwargs)
 
 def snake_to_camel(string):
 	"""
@@ -152,7 +160,13 @@ class AptlyAPISnapshots(KeyBlockedValueTypeCheckedDictionary):
 		"Name" : str,
 	}
 
-aptly_mapping = {
+@lru_cache(maxsize=None)
+def get_aptly_mapping():
+	"""
+	Returns the API mapping, building it on first use.
+	"""
+
+	return {
 	"LocalRepo" : {
 		"@list" : APIDescription(
 			method=get,
@@ -375,6 +389,22 @@ aptly_mapping = {
 			},
 		),
 	},
-	# TODO: Packages
+	"Packages" : {
+		### Show
+		"show" : APIDescription(
+			method=get,
+			route="/api/packages/%(key)s",
+		),
+	},
 	# TODO: Misc
 }
+
+def __getattr__(name):
+	"""
+	Builds aptly_mapping on first access.
+	"""
+
+	if name == "aptly_mapping":
+		return get_aptly_mapping()
+
+	raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,514 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Adaptive limits of the requests sent at the same time to aptly
+"""
+
+import os
+
+import json
+
+import time
+
+import fcntl
+
+import threading
+
+from contextlib import contextmanager
+
+from .api_mapping import get
+
+LIMITS_DIRECTORY = "/run/aptly-intake/limits"
+
+# Requests are classified by what they do to aptly: uploads stream
+# files, mutations write to its database, reads don't change anything
+ROUTE_CLASSES = [
+	"upload",
+	"mutate",
+	"read",
+]
+
+# (initial, minimum, maximum) number of requests in flight, for every
+# route class
+DEFAULT_LIMITS = {
+	"upload" : (4, 1, 16),
+	"mutate" : (2, 1, 8),
+	"read" : (8, 1, 32),
+}
+
+# Route classes whose limits are decreased when requests get slow.
+# The latency of the others depends on what they do (uploads on the
+# file size, mutations range from creating a repository to publishing
+# a distribution), so only failures decrease their limits
+LATENCY_SENSITIVE = [
+	"read",
+]
+
+# A request is slow when it takes more than this many times the
+# baseline latency
+LATENCY_TOLERANCE = 2.0
+
+# Factors the limit is multiplied by when a request fails (5xx or
+# connection errors), or is slow
+ERROR_BACKOFF = 0.5
+LATENCY_BACKOFF = 0.9
+
+# How much the baseline latency can grow at every request, so that it
+# follows a permanent change in aptly's response times
+BASELINE_DRIFT = 0.01
+
+# How often a request waiting for a shared limit checks it again, in
+# seconds
+ACQUIRE_INTERVAL = 0.05
+
+def get_route_class(description):
+	"""
+	Returns the route class of the given APIDescription.
+
+	:param: description: the APIDescription of the request
+	"""
+
+	if description.post_file:
+		return "upload"
+	elif description.method is get:
+		return "read"
+
+	return "mutate"
+
+def get_limits_path(shard=None):
+	"""
+	Returns the path of the state file of the limits of the given
+	aptly instance, shared by every process.
+
+	:param: shard: the name of the aptly instance, if it's not the
+	default one
+	"""
+
+	return os.path.join(
+		LIMITS_DIRECTORY,
+		"%s.json" % (shard or "default")
+	)
+
+def is_running(pid):
+	"""
+	Returns True if the given process is still running.
+
+	:param: pid: the process id
+	"""
+
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass
+
+	return True
+
+class AdaptiveLimit:
+	"""
+	An AIMD limit of the requests in flight.
+
+	The limit grows by one every `limit` successful requests, but only
+	while it's fully used. It's cut by ERROR_BACKOFF when a request
+	fails, and by LATENCY_BACKOFF when a request takes more than
+	LATENCY_TOLERANCE times the baseline (the lowest latency seen
+	recently), at most once per average latency.
+	"""
+
+	# Attributes shared with the other processes, see SharedLimit()
+	STATE = [
+		"limit",
+		"latency",
+		"baseline",
+		"decreased",
+		"requests",
+		"errors",
+		"throttled",
+	]
+
+	def __init__(self, initial, minimum, maximum, latency_sensitive=True):
+		"""
+		Initialises the class.
+
+		:param: initial: the initial limit
+		:param: minimum: the minimum limit
+		:param: maximum: the maximum limit
+		:param: latency_sensitive: if False, only failures decrease the
+		limit (see LATENCY_SENSITIVE)
+		"""
+
+		self.minimum = minimum
+		self.maximum = maximum
+		self.latency_sensitive = latency_sensitive
+
+		self.limit = float(max(minimum, min(initial, maximum)))
+		self.in_flight = 0
+		self.latency = None
+		self.baseline = None
+		self.decreased = 0
+		self.requests = 0
+		self.errors = 0
+		self.throttled = 0
+
+		self.condition = threading.Condition()
+
+	def acquire(self):
+		"""
+		Waits until a request can be sent.
+		"""
+
+		with self.condition:
+			if self.in_flight >= int(self.limit):
+				self.throttled += 1
+				self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+
+			self.in_flight += 1
+
+	def decrease(self, factor):
+		"""
+		Multiplies the limit by the given factor, unless it has been
+		decreased less than an average latency ago.
+
+		:param: factor: the factor to multiply the limit by
+		"""
+
+		now = time.time()
+		if now - self.decreased < (self.latency or 0):
+			return
+
+		self.limit = max(self.minimum, self.limit * factor)
+		self.decreased = now
+
+	def adjust(self, latency, failed):
+		"""
+		Records the outcome of a request still counted as in flight, and
+		adjusts the limit.
+
+		:param: latency: the time the request took, in seconds
+		:param: failed: True if aptly failed or couldn't be reached
+		"""
+
+		saturated = self.in_flight >= int(self.limit)
+		self.requests += 1
+
+		self.latency = latency if self.latency is None \
+			else self.latency * 0.8 + latency * 0.2
+
+		if failed:
+			self.errors += 1
+			self.decrease(ERROR_BACKOFF)
+		elif self.latency_sensitive and self.baseline is not None \
+			and latency > self.baseline * LATENCY_TOLERANCE:
+			self.decrease(LATENCY_BACKOFF)
+		elif saturated:
+			self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+		if self.latency_sensitive and not failed:
+			self.baseline = latency if self.baseline is None \
+				else min(latency, self.baseline * (1 + BASELINE_DRIFT))
+
+	def release(self, latency, failed=False):
+		"""
+		Records the outcome of a request, and adjusts the limit.
+
+		:param: latency: the time the request took, in seconds
+		:param: failed: True if aptly failed or couldn't be reached
+		"""
+
+		with self.condition:
+			self.adjust(latency, failed)
+			self.in_flight -= 1
+
+			self.condition.notify_all()
+
+	def get_status(self):
+		"""
+		Returns the current state of the limit, as a dictionary.
+		"""
+
+		with self.condition:
+			return {
+				"limit" : int(self.limit),
+				"in_flight" : self.in_flight,
+				"latency" : self.latency,
+				"baseline" : self.baseline,
+				"requests" : self.requests,
+				"errors" : self.errors,
+				"throttled" : self.throttled,
+			}
+
+class SharedLimit(AdaptiveLimit):
+	"""
+	An AdaptiveLimit() shared by every process using the same state
+	file, so that the requests in flight are limited for the whole
+	aptly instance rather than per process (e.g. with the importers run
+	by aptly-intake-scheduler), and every process backs off when aptly
+	struggles.
+
+	The state file is locked while being updated. The requests in
+	flight are counted per process, and the ones of processes that are
+	not running anymore are forgotten.
+	"""
+
+	def __init__(self, name, path, initial, minimum, maximum, latency_sensitive=True):
+		"""
+		Initialises the class.
+
+		:param: name: the name of the limit in the state file (the
+		route class)
+		:param: path: the path of the state file
+		:param: initial: the initial limit, if the state file doesn't
+		have one yet
+		:param: minimum: the minimum limit
+		:param: maximum: the maximum limit
+		:param: latency_sensitive: if False, only failures decrease the
+		limit
+		"""
+
+		super().__init__(initial, minimum, maximum, latency_sensitive)
+
+		self.name = name
+		self.path = path
+		self.processes = {}
+
+		# Threads of the same process take turns on the state file
+		self.lock = threading.Lock()
+
+	@contextmanager
+	def shared(self):
+		"""
+		Loads the shared state of the limit, and stores it back on exit.
+		Other processes are kept from updating it in the meantime.
+		"""
+
+		with self.lock, open("%s.lock" % self.path, "a") as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+
+			try:
+				try:
+					with open(self.path, "r") as f:
+						state = json.load(f)
+				except (OSError, ValueError):
+					state = {}
+
+				limits = state.setdefault("limits", {})
+				entry = limits.get(self.name, {})
+				for x in self.STATE:
+					if x in entry:
+						setattr(self, x, entry[x])
+
+				self.limit = float(max(self.minimum, min(self.limit, self.maximum)))
+				self.processes = {
+					int(pid) : count
+					for pid, count in entry.get("processes", {}).items()
+					if count > 0 and is_running(int(pid))
+				}
+				self.in_flight = sum(self.processes.values())
+
+				yield
+
+				limits[self.name] = {
+					**{ x : getattr(self, x) for x in self.STATE },
+					"in_flight" : self.in_flight,
+					"processes" : self.processes,
+				}
+				state["updated"] = time.time()
+
+				tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+				with open(tmp_path, "w") as f:
+					json.dump(state, f, indent=1)
+
+				os.replace(tmp_path, self.path)
+			finally:
+				fcntl.flock(lock, fcntl.LOCK_UN)
+
+	def count(self, delta):
+		"""
+		Adds delta to the requests in flight of the current process.
+
+		:param: delta: the number of requests to add
+		"""
+
+		pid = os.getpid()
+
+		self.processes[pid] = self.processes.get(pid, 0) + delta
+		if self.processes[pid] <= 0:
+			del self.processes[pid]
+
+		self.in_flight += delta
+
+	def acquire(self):
+		"""
+		Waits until a request can be sent, by any process.
+		"""
+
+		throttled = False
+		while True:
+			with self.shared():
+				if self.in_flight < int(self.limit):
+					self.count(1)
+					return
+
+				if not throttled:
+					self.throttled += 1
+					throttled = True
+
+			time.sleep(ACQUIRE_INTERVAL)
+
+	def release(self, latency, failed=False):
+		"""
+		Records the outcome of a request, and adjusts the shared limit.
+
+		:param: latency: the time the request took, in seconds
+		:param: failed: True if aptly failed or couldn't be reached
+		"""
+
+		with self.shared():
+			self.adjust(latency, failed)
+			self.count(-1)
+
+	def get_status(self):
+		"""
+		Returns the current shared state of the limit, as a dictionary.
+		"""
+
+		with self.shared():
+			return {
+				"limit" : int(self.limit),
+				"in_flight" : self.in_flight,
+				"latency" : self.latency,
+				"baseline" : self.baseline,
+				"requests" : self.requests,
+				"errors" : self.errors,
+				"throttled" : self.throttled,
+			}
+
+	def close(self):
+		"""
+		Forgets the requests in flight of the current process (e.g. the
+		ones interrupted by an exception).
+		"""
+
+		with self.shared():
+			self.count(-self.processes.get(os.getpid(), 0))
+
+class ConcurrencyLimiter:
+	"""
+	Limits the requests sent at the same time to an aptly instance,
+	adapting the limit of every route class to aptly's latency and
+	failures.
+
+	With a state file, the limits are shared by every process using it,
+	and the file doubles as a status file for monitoring. Otherwise,
+	they only apply to the current process.
+	"""
+
+	def __init__(self, limits=DEFAULT_LIMITS, status_path=None):
+		"""
+		Initialises the class.
+
+		:param: limits: a dictionary mapping every route class to its
+		(initial, minimum, maximum) limits
+		:param: status_path: the path of the state file, or None
+		"""
+
+		if status_path is not None:
+			try:
+				os.makedirs(os.path.dirname(status_path), exist_ok=True)
+				with open("%s.lock" % status_path, "a"):
+					pass
+			except OSError as e:
+				print("Unable to share the concurrency limits, limiting this process only: %s" % e)
+				status_path = None
+
+		self.limits = {
+			name : (
+				SharedLimit(
+					name,
+					status_path,
+					*limits.get(name, DEFAULT_LIMITS[name]),
+					latency_sensitive=(name in LATENCY_SENSITIVE)
+				)
+				if status_path is not None
+				else AdaptiveLimit(
+					*limits.get(name, DEFAULT_LIMITS[name]),
+					latency_sensitive=(name in LATENCY_SENSITIVE)
+				)
+			)
+			for name in ROUTE_CLASSES
+		}
+		self.status_path = status_path
+
+	def call(self, route_class, function):
+		"""
+		Calls the given function, which sends a request, within the
+		limit of the given route class, and returns its result.
+
+		:param: route_class: the route class of the request
+		:param: function: the function to call, without arguments. It
+		must return a response with a status_code
+		"""
+
+		limit = self.limits[route_class]
+
+		limit.acquire()
+		started = time.monotonic()
+		failed = False
+
+		try:
+			result = function()
+			failed = result.status_code >= 500
+
+			return result
+		except OSError:
+			# Connection errors and timeouts
+			failed = True
+			raise
+		finally:
+			limit.release(time.monotonic() - started, failed)
+
+	def get_status(self):
+		"""
+		Returns the current state of every limit, as a dictionary.
+		"""
+
+		return {
+			name : limit.get_status()
+			for name, limit in self.limits.items()
+		}
+
+	def close(self):
+		"""
+		Releases the shared limits held by the current process.
+		"""
+
+		for limit in self.limits.values():
+			if isinstance(limit, SharedLimit):
+				limit.close()
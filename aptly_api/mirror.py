@@ -0,0 +1,520 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Local mirror of aptly's metadata
+"""
+
+import os
+
+import json
+
+import time
+
+import sqlite3
+
+import threading
+
+SCHEMA = [
+	"CREATE TABLE IF NOT EXISTS repos ("
+	"name TEXT PRIMARY KEY, "
+	"data TEXT NOT NULL"
+	")",
+	"CREATE TABLE IF NOT EXISTS snapshots ("
+	"name TEXT PRIMARY KEY, "
+	"data TEXT NOT NULL"
+	")",
+	"CREATE TABLE IF NOT EXISTS publications ("
+	"prefix TEXT NOT NULL, "
+	"distribution TEXT NOT NULL, "
+	"data TEXT NOT NULL, "
+	"PRIMARY KEY (prefix, distribution)"
+	")",
+	"CREATE TABLE IF NOT EXISTS publication_sources ("
+	"prefix TEXT NOT NULL, "
+	"distribution TEXT NOT NULL, "
+	"component TEXT NOT NULL, "
+	"source TEXT NOT NULL, "
+	"PRIMARY KEY (prefix, distribution, component)"
+	")",
+	"CREATE INDEX IF NOT EXISTS publication_sources_source ON publication_sources (source)",
+	"CREATE TABLE IF NOT EXISTS packages ("
+	"repo TEXT NOT NULL, "
+	"ref TEXT NOT NULL, "
+	"arch TEXT NOT NULL, "
+	"name TEXT NOT NULL, "
+	"version TEXT NOT NULL, "
+	"PRIMARY KEY (repo, ref)"
+	")",
+	"CREATE INDEX IF NOT EXISTS packages_name ON packages (repo, name)",
+	# Repositories whose package list is complete, i.e. it has been
+	# fetched in full and only changed by known operations since then
+	"CREATE TABLE IF NOT EXISTS package_lists ("
+	"repo TEXT PRIMARY KEY, "
+	"synced REAL NOT NULL"
+	")",
+	"CREATE TABLE IF NOT EXISTS meta ("
+	"key TEXT PRIMARY KEY, "
+	"value TEXT"
+	")",
+]
+
+def get_mirror_path(path, shard=None):
+	"""
+	Returns the path of the mirror of the given aptly instance.
+
+	:param: path: the path of the mirror of the default aptly instance
+	:param: shard: the name of the aptly instance, if it's not the
+	default one
+	"""
+
+	if shard is None:
+		return path
+
+	base, extension = os.path.splitext(path)
+
+	return "%s-%s%s" % (base, shard, extension)
+
+def split_ref(ref):
+	"""
+	Returns the (arch, name, version) tuple of the given package ref.
+
+	:param: ref: the package ref (e.g. "Pamd64 foo 1.0 abcdef")
+	"""
+
+	arch, name, version, _ = ref.split(" ")
+
+	return arch[1:], name, version
+
+class MetadataMirror:
+	"""
+	A local, SQLite-backed, mirror of the repositories, snapshots,
+	publications and package refs of an aptly instance.
+
+	The mirror is updated with the results of the requests made by an
+	AptlySession() it has been attached to (see `record()`), so it only
+	knows about the changes made via aptly-intake. Changes made by
+	other means are picked up by `resync()`.
+
+	Package lists are only trusted when they are complete (see
+	`get_packages()`): operations whose effect can't be known from
+	their result (e.g. includes) invalidate the package list of the
+	affected repository.
+	"""
+
+	def __init__(self, path):
+		"""
+		Initialises the class.
+
+		:param: path: the path of the mirror database
+		"""
+
+		self.path = path
+		self.lock = threading.RLock()
+
+		os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+		# The mirror is shared by the threads using the session
+		self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+		with self.connection:
+			for statement in SCHEMA:
+				self.connection.execute(statement)
+
+	def close(self):
+		"""
+		Closes the mirror database.
+		"""
+
+		self.connection.close()
+
+	def _execute(self, statements):
+		"""
+		Executes the given (statement, parameters) tuples in a single
+		transaction.
+
+		:param: statements: an iterable of (statement, parameters) tuples
+		"""
+
+		with self.lock, self.connection:
+			for statement, parameters in statements:
+				self.connection.execute(statement, parameters)
+
+	def _query(self, statement, parameters=()):
+		"""
+		Returns every row returned by the given query.
+
+		:param: statement: the query
+		:param: parameters: the parameters of the query
+		"""
+
+		with self.lock:
+			return self.connection.execute(statement, parameters).fetchall()
+
+	# Updates
+
+	def set_repos(self, repos, replace=False):
+		"""
+		Stores the given repositories.
+
+		:param: repos: a list of repositories, as returned by aptly
+		:param: replace: if True, every other repository is forgotten
+		"""
+
+		statements = []
+
+		if replace:
+			names = [x["Name"] for x in repos]
+			statements.append(
+				(
+					"DELETE FROM repos WHERE name NOT IN (%s)" % ",".join("?" * len(names)),
+					names
+				)
+			)
+			statements += [
+				(
+					"DELETE FROM %s WHERE repo NOT IN (%s)" % (table, ",".join("?" * len(names))),
+					names
+				)
+				for table in ("packages", "package_lists")
+			]
+
+		statements += [
+			("INSERT OR REPLACE INTO repos (name, data) VALUES (?, ?)", (x["Name"], json.dumps(x)))
+			for x in repos
+		]
+
+		self._execute(statements)
+
+	def remove_repo(self, name):
+		"""
+		Forgets the given repository, and its packages.
+
+		:param: name: the name of the repository
+		"""
+
+		self._execute(
+			("DELETE FROM %s WHERE %s = ?" % (table, column), (name,))
+			for table, column in (("repos", "name"), ("packages", "repo"), ("package_lists", "repo"))
+		)
+
+	def set_packages(self, repo, refs):
+		"""
+		Stores the complete package list of the given repository.
+
+		:param: repo: the name of the repository
+		:param: refs: every package ref in the repository
+		"""
+
+		self._execute(
+			[
+				("DELETE FROM packages WHERE repo = ?", (repo,)),
+				("INSERT OR REPLACE INTO package_lists (repo, synced) VALUES (?, ?)", (repo, time.time())),
+			] + [
+				("INSERT OR IGNORE INTO packages (repo, ref, arch, name, version) VALUES (?, ?, ?, ?, ?)", (repo, x, *split_ref(x)))
+				for x in refs
+			]
+		)
+
+	def add_packages(self, repo, refs):
+		"""
+		Adds the given package refs to the given repository.
+
+		:param: repo: the name of the repository
+		:param: refs: the package refs to add
+		"""
+
+		self._execute(
+			("INSERT OR IGNORE INTO packages (repo, ref, arch, name, version) VALUES (?, ?, ?, ?, ?)", (repo, x, *split_ref(x)))
+			for x in refs
+		)
+
+	def remove_packages(self, repo, refs):
+		"""
+		Removes the given package refs from the given repository.
+
+		:param: repo: the name of the repository
+		:param: refs: the package refs to remove
+		"""
+
+		self._execute(
+			("DELETE FROM packages WHERE repo = ? AND ref = ?", (repo, x))
+			for x in refs
+		)
+
+	def invalidate_packages(self, repo):
+		"""
+		Marks the package list of the given repository as incomplete.
+
+		:param: repo: the name of the repository
+		"""
+
+		self._execute([("DELETE FROM package_lists WHERE repo = ?", (repo,))])
+
+	def set_snapshots(self, snapshots, replace=False):
+		"""
+		Stores the given snapshots.
+
+		:param: snapshots: a list of snapshots, as returned by aptly
+		:param: replace: if True, every other snapshot is forgotten
+		"""
+
+		statements = []
+
+		if replace:
+			statements.append(("DELETE FROM snapshots", ()))
+
+		statements += [
+			("INSERT OR REPLACE INTO snapshots (name, data) VALUES (?, ?)", (x["Name"], json.dumps(x)))
+			for x in snapshots
+		]
+
+		self._execute(statements)
+
+	def remove_snapshot(self, name):
+		"""
+		Forgets the given snapshot.
+
+		:param: name: the name of the snapshot
+		"""
+
+		self._execute([("DELETE FROM snapshots WHERE name = ?", (name,))])
+
+	def set_publications(self, publications, replace=False):
+		"""
+		Stores the given published repositories.
+
+		:param: publications: a list of published repositories, as
+		returned by aptly
+		:param: replace: if True, every other publication is forgotten
+		"""
+
+		statements = []
+
+		if replace:
+			statements += [
+				("DELETE FROM publications", ()),
+				("DELETE FROM publication_sources", ()),
+			]
+
+		for publication in publications:
+			key = (publication["Prefix"], publication["Distribution"])
+
+			statements += [
+				("INSERT OR REPLACE INTO publications (prefix, distribution, data) VALUES (?, ?, ?)", (*key, json.dumps(publication))),
+				("DELETE FROM publication_sources WHERE prefix = ? AND distribution = ?", key),
+			] + [
+				("INSERT OR REPLACE INTO publication_sources (prefix, distribution, component, source) VALUES (?, ?, ?, ?)", (*key, x["Component"], x["Name"]))
+				for x in publication.get("Sources", [])
+			]
+
+		self._execute(statements)
+
+	def remove_publication(self, prefix, distribution):
+		"""
+		Forgets the given published repository.
+
+		:param: prefix: the prefix of the publication
+		:param: distribution: the distribution of the publication
+		"""
+
+		self._execute(
+			("DELETE FROM %s WHERE prefix = ? AND distribution = ?" % table, (prefix, distribution))
+			for table in ("publications", "publication_sources")
+		)
+
+	def record(self, section, method, shared_state, params, query_params, result):
+		"""
+		Updates the mirror with the result of a successful request.
+
+		Called by AptlySession() after every request.
+
+		:param: section: the section of the API mapping
+		:param: method: the method of the section
+		:param: shared_state: the shared state of the proxy object
+		:param: params: the body parameters of the request
+		:param: query_params: the query parameters of the request
+		:param: result: the decoded result
+		"""
+
+		name = shared_state.get("name")
+
+		if section == "LocalRepo":
+			if method == "@list":
+				self.set_repos(result, replace=True)
+			elif method in ("@create", "show", "edit"):
+				self.set_repos([result])
+			elif method == "delete":
+				self.remove_repo(name)
+			elif method == "search" and not query_params.get("q"):
+				self.set_packages(
+					name,
+					[(x["Key"] if isinstance(x, dict) else x) for x in result]
+				)
+			elif method == "add_packages":
+				self.add_packages(name, params["PackageRefs"])
+			elif method == "delete_packages":
+				self.remove_packages(name, params["PackageRefs"])
+			elif method == "snapshot":
+				self.set_snapshots([result])
+		elif section == "RepositoryDirectory":
+			# Only the names of the added packages are reported
+			self.invalidate_packages(name)
+		elif section == "Snapshot":
+			if method == "@list":
+				self.set_snapshots(result, replace=True)
+			elif method in ("@create", "show"):
+				self.set_snapshots([result])
+			elif method == "update":
+				self.remove_snapshot(name)
+				self.set_snapshots([result])
+			elif method == "delete":
+				self.remove_snapshot(name)
+		elif section == "PublishedRepo":
+			if method == "@list":
+				self.set_publications(result, replace=True)
+			elif method == "publish":
+				self.set_publications([result])
+		elif section == "PublishedDistribution":
+			if method == "update":
+				self.set_publications([result])
+			elif method == "delete":
+				self.remove_publication(shared_state["prefix"], shared_state["distribution"])
+
+	def forget(self, section, shared_state):
+		"""
+		Forgets what the given request might have changed, when its
+		result couldn't be recorded: the package list of the affected
+		repository is marked as incomplete, so that it's fetched from
+		aptly again.
+
+		:param: section: the section of the API mapping
+		:param: shared_state: the shared state of the proxy object
+		"""
+
+		if section in ("LocalRepo", "RepositoryDirectory") \
+			and shared_state.get("name") is not None:
+			self.invalidate_packages(shared_state["name"])
+
+	def resync(self, session):
+		"""
+		Fetches everything from aptly again.
+
+		:param: session: an AptlySession() instance this mirror is
+		attached to
+		"""
+
+		for repository in session.LocalRepo.list():
+			session.LocalRepo(name=repository["Name"]).search()
+
+		session.Snapshot.list()
+		session.PublishedRepo.list()
+
+		self._execute([("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", ("resynced", str(time.time())))])
+
+	# Queries
+
+	@property
+	def resynced(self):
+		"""
+		Returns the timestamp of the last full resync, or None.
+		"""
+
+		rows = self._query("SELECT value FROM meta WHERE key = ?", ("resynced",))
+
+		return float(rows[0][0]) if rows else None
+
+	def list_repos(self):
+		"""
+		Returns the repositories, like LocalRepo.list().
+		"""
+
+		return [json.loads(x) for x, in self._query("SELECT data FROM repos ORDER BY name")]
+
+	def list_snapshots(self):
+		"""
+		Returns the snapshots, like Snapshot.list().
+		"""
+
+		return [json.loads(x) for x, in self._query("SELECT data FROM snapshots ORDER BY name")]
+
+	def list_publications(self):
+		"""
+		Returns the published repositories, like PublishedRepo.list().
+		"""
+
+		return [
+			json.loads(x)
+			for x, in self._query("SELECT data FROM publications ORDER BY prefix, distribution")
+		]
+
+	def get_published_snapshots(self):
+		"""
+		Returns the set of the names of the published snapshots.
+		"""
+
+		return {x for x, in self._query("SELECT DISTINCT source FROM publication_sources")}
+
+	def is_published(self, snapshot):
+		"""
+		Returns True if the given snapshot is published.
+
+		:param: snapshot: the name of the snapshot
+		"""
+
+		return bool(
+			self._query("SELECT 1 FROM publication_sources WHERE source = ? LIMIT 1", (snapshot,))
+		)
+
+	def get_packages(self, repo):
+		"""
+		Returns every package ref of the given repository, or None if
+		its package list is not complete.
+
+		:param: repo: the name of the repository
+		"""
+
+		with self.lock:
+			if not self._query("SELECT 1 FROM package_lists WHERE repo = ?", (repo,)):
+				return None
+
+			return [x for x, in self._query("SELECT ref FROM packages WHERE repo = ?", (repo,))]
+
+	def get_versions(self, repo, name):
+		"""
+		Returns the (arch, version, ref) tuples of the given package in
+		the given repository. Only complete if `get_packages()` is.
+
+		:param: repo: the name of the repository
+		:param: name: the name of the package
+		"""
+
+		return self._query(
+			"SELECT arch, version, ref FROM packages WHERE repo = ? AND name = ? ORDER BY arch",
+			(repo, name)
+		)
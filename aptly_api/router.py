@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Routing of channels and distributions to several aptly instances
+"""
+
+import fnmatch
+
+import threading
+
+DEFAULT_SHARD = "default"
+
+DEFAULT_URL = "http://localhost:8080/"
+
+# Number of connections kept open to every aptly instance
+DEFAULT_POOL_SIZE = 4
+
+class AptlyRouter:
+	"""
+	Maps channels and distributions to aptly instances ("shards").
+
+	Every shard has its own AptlySession() (and thus its own connection
+	pool) and its own lock, so that an operation on a shard doesn't
+	block the others.
+
+	Can be used as a context manager, which closes every session on
+	exit.
+	"""
+
+	def __init__(self, backends=None, routes=[], pool_size=DEFAULT_POOL_SIZE, mirror=None, limits=None):
+		"""
+		Initialises the class.
+
+		:param: backends: a dictionary mapping shard names to the url
+		(or unix socket) of the aptly instance. Defaults to DEFAULT_URL
+		as the DEFAULT_SHARD
+		:param: routes: a list of (pattern, shard) tuples. Patterns are
+		shell-style wildcards matched against channel/distribution, the
+		first matching one wins. Everything else goes to DEFAULT_SHARD
+		(or the first backend, if there is no DEFAULT_SHARD)
+		:param: pool_size: the number of connections to keep open to
+		every aptly instance
+		:param: mirror: the path of the MetadataMirror() of the default
+		aptly instance (the other ones are stored alongside it), or None
+		to disable the mirrors
+		:param: limits: a dictionary mapping route classes to their
+		(initial, minimum, maximum) number of requests in flight to
+		every aptly instance (see ConcurrencyLimiter()), or None to
+		disable the adaptive limits
+		"""
+
+		self.backends = backends or { DEFAULT_SHARD : DEFAULT_URL }
+		self.routes = routes
+		self.pool_size = pool_size
+		self.mirror = mirror
+		self.limits = limits
+		self.default = DEFAULT_SHARD if DEFAULT_SHARD in self.backends \
+			else next(iter(self.backends))
+
+		for pattern, shard in self.routes:
+			if not shard in self.backends:
+				raise Exception(
+					"Route %s points to the unknown aptly instance %s" % (
+						pattern,
+						shard
+					)
+				)
+
+		# Sessions are created lazily, possibly by several threads at
+		# once (e.g. the upload stage of a pipeline)
+		self._sessions = {}
+		self._sessions_lock = threading.Lock()
+
+	@classmethod
+	def from_config(cls, config, section="Intake"):
+		"""
+		Returns an AptlyRouter configured from the given ConfigParser.
+
+		Backends are read from APTLY_BACKENDS, in the form
+		 shard:url
+		and routes from APTLY_ROUTES, in the form
+		 channel/distribution:shard
+		both separated by spaces. The metadata mirror is enabled by
+		setting APTLY_METADATA_MIRROR to its path.
+
+		Adaptive limits are enabled by setting APTLY_ADAPTIVE_CONCURRENCY
+		to true. APTLY_CONCURRENCY_LIMITS overrides the limits of some
+		route classes, in the form
+		 class:initial:minimum:maximum
+		separated by spaces.
+
+		:param: config: a ConfigParser instance
+		:param: section: the section to read from
+		"""
+
+		return cls(
+			backends={
+				shard : url
+				for shard, url in (
+					x.split(":", 1)
+					for x in config.get(
+						section,
+						"APTLY_BACKENDS",
+						fallback="%s:%s" % (DEFAULT_SHARD, DEFAULT_URL)
+					).split()
+				)
+			},
+			routes=[
+				tuple(x.rsplit(":", 1))
+				for x in config.get(
+					section,
+					"APTLY_ROUTES",
+					fallback=""
+				).split()
+			],
+			pool_size=config.getint(
+				section,
+				"APTLY_BACKEND_POOL_SIZE",
+				fallback=DEFAULT_POOL_SIZE
+			),
+			mirror=config.get(
+				section,
+				"APTLY_METADATA_MIRROR",
+				fallback=""
+			) or None,
+			limits={
+				route_class : tuple(int(y) for y in limits.split(":"))
+				for route_class, limits in (
+					x.split(":", 1)
+					for x in config.get(
+						section,
+						"APTLY_CONCURRENCY_LIMITS",
+						fallback=""
+					).split()
+				)
+			} if config.getboolean(
+				section,
+				"APTLY_ADAPTIVE_CONCURRENCY",
+				fallback=False
+			) else None
+		)
+
+	@property
+	def shards(self):
+		"""
+		Returns the names of every shard.
+		"""
+
+		return list(self.backends)
+
+	def get_shard(self, channel, distribution):
+		"""
+		Returns the name of the shard serving the given channel and
+		distribution.
+
+		:param: channel: the channel
+		:param: distribution: the distribution
+		"""
+
+		target = "%s/%s" % (channel, distribution)
+
+		for pattern, shard in self.routes:
+			if fnmatch.fnmatchcase(target, pattern):
+				return shard
+
+		return self.default
+
+	def get_session(self, shard):
+		"""
+		Returns the AptlySession() of the given shard, creating it if
+		needed.
+
+		:param: shard: the name of the shard
+		"""
+
+		with self._sessions_lock:
+			if not shard in self._sessions:
+				# Imported here, as it pulls in requests
+				from .api import AptlySession
+				from .mirror import MetadataMirror, get_mirror_path
+				from .limiter import ConcurrencyLimiter, DEFAULT_LIMITS, get_limits_path
+
+				name = None if shard == DEFAULT_SHARD else shard
+
+				self._sessions[shard] = AptlySession(
+					self.backends[shard],
+					shard=name,
+					pool_size=self.pool_size,
+					mirror=(
+						MetadataMirror(get_mirror_path(self.mirror, name))
+						if self.mirror is not None else None
+					),
+					limiter=(
+						ConcurrencyLimiter(
+							{ **DEFAULT_LIMITS, **self.limits },
+							status_path=get_limits_path(name)
+						)
+						if self.limits is not None else None
+					)
+				)
+
+			return self._sessions[shard]
+
+	def session_for(self, channel, distribution):
+		"""
+		Returns the AptlySession() serving the given channel and
+		distribution.
+
+		:param: channel: the channel
+		:param: distribution: the distribution
+		"""
+
+		return self.get_session(self.get_shard(channel, distribution))
+
+	def is_routed(self, shard, channel, distribution):
+		"""
+		Returns True if the given channel and distribution are served
+		by the given shard.
+
+		:param: shard: the name of the shard
+		:param: channel: the channel
+		:param: distribution: the distribution
+		"""
+
+		return self.get_shard(channel, distribution) == shard
+
+	def map(self, function):
+		"""
+		Calls function(shard, session) for every shard, at the same time.
+
+		Every shard is processed even if some of them fail: the errors
+		are printed, and an exception is raised at the end.
+
+		:param: function: the function to call
+		"""
+
+		from concurrent.futures import ThreadPoolExecutor
+
+		failed = []
+
+		with ThreadPoolExecutor(max_workers=len(self.backends)) as executor:
+			futures = {
+				shard : executor.submit(function, shard, self.get_session(shard))
+				for shard in self.backends
+			}
+
+			for shard, future in futures.items():
+				try:
+					future.result()
+				except Exception as e:
+					print("aptly instance %s failed: %s" % (shard, e))
+					failed.append(shard)
+
+		if failed:
+			raise Exception("Failed on %d aptly instance(s): %s" % (len(failed), ", ".join(failed)))
+
+	def get_limits(self):
+		"""
+		Returns the current concurrency limits of every shard with an
+		open session, as a dictionary.
+		"""
+
+		with self._sessions_lock:
+			sessions = dict(self._sessions)
+
+		return {
+			shard : session.limiter.get_status()
+			for shard, session in sessions.items()
+			if session.limiter is not None
+		}
+
+	def close(self):
+		"""
+		Closes every session.
+		"""
+
+		with self._sessions_lock:
+			sessions = list(self._sessions.values())
+			self._sessions.clear()
+
+		for session in sessions:
+			session.close()
+
+			if session.mirror is not None:
+				session.mirror.close()
+
+			if session.limiter is not None:
+				session.limiter.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
@@ -29,91 +29,206 @@
 
 import os
 
-import sys
+import time
 
-import apt_pkg
+import argparse
 
 import aptly_api
 
+import aptly_intake
+
 import subprocess
 
-from functools import reduce
+import configparser
+
+INTAKE_SETTINGS = "/var/lib/aptly-api/intake-settings"
+
+config = configparser.ConfigParser()
+config.read(INTAKE_SETTINGS)
+
+# Configuration files of the aptly instances to run `aptly db cleanup`
+# with, in the form
+#  shard:path
+# separated by spaces. aptly instances without one (e.g. the ones on
+# other hosts) are not cleaned up.
+DEFAULT_CLEANUP_CONFIGS = {
+	shard : path
+	for shard, path in (
+		x.split(":", 1)
+		for x in config.get(
+			"Intake",
+			"APTLY_CLEANUP_CONFIGS",
+			fallback="%s:/etc/aptly-api.conf" % aptly_api.DEFAULT_SHARD
+		).split()
+	)
+}
+
+# aptly's upload directory (<rootDir>/upload), used to know the age and
+# size of the upload directories of the default aptly instance
+DEFAULT_UPLOAD_DIRECTORY = config.get(
+	"Intake",
+	"APTLY_UPLOAD_DIRECTORY",
+	fallback="/var/lib/aptly-api/upload"
+)
+
+# Upload directories left by failed imports are removed after this
+# many hours
+DEFAULT_UPLOAD_GC_MAX_AGE = config.getint(
+	"Intake",
+	"APTLY_UPLOAD_GC_MAX_AGE",
+	fallback=24
+)
+
+def get_retention_policy():
+	"""
+	Returns the RetentionPolicy() configured in the intake settings.
+	"""
+
+	return aptly_intake.RetentionPolicy.from_config(config)
+
+def collect_uploads(shard, session, dry_run=False):
+	"""
+	Removes the upload directories left by failed imports from the
+	given aptly instance.
 
-EXTENDED_KEEP = [
-	"production_trixie_main",
-	"staging_trixie_main",
-	"production_sid_main",
-	"staging_sid_main",
-]
+	:param: shard: the name of the aptly instance
+	:param: session: the AptlySession() of the aptly instance
+	:param: dry_run: if True, only shows what would be removed
+	"""
 
-def get_packages_to_remove(packages_per_arch, keep=3):
+	collector = aptly_intake.UploadGarbageCollector(
+		session,
+		upload_directory=(
+			DEFAULT_UPLOAD_DIRECTORY
+			if session.shard is None and os.path.isdir(DEFAULT_UPLOAD_DIRECTORY)
+			else None
+		),
+		max_age=DEFAULT_UPLOAD_GC_MAX_AGE * 60 * 60
+	)
+
+	removed, files, size = collector.collect(dry_run=dry_run)
+
+	if dry_run:
+		print("%s: %d stale upload directories" % (shard, removed))
+	else:
+		print(
+			"%s: removed %d stale upload directories, reclaimed %d files (%s)" % (
+				shard,
+				removed,
+				files,
+				"%d bytes" % size if size is not None else "size unknown"
+			)
+		)
+
+def clean(shard, session):
 	"""
-	Returns a list of packages to remove.
+	Removes old packages and unpublished snapshots from the given
+	aptly instance, and cleans up its database.
 
-	:param: packages_per_arch: a dictionary containing the packages to filter
-	:param: keep: the number of versions of the same package to keep (defaults
-	to 3)
+	:param: shard: the name of the aptly instance
+	:param: session: the AptlySession() of the aptly instance
 	"""
 
-	to_remove = []
+	collect_uploads(shard, session)
 
-	for arch, packages in packages_per_arch.items():
-		for package, versions in packages.items():
-			to_keep = []
+	with session.lock() as lock:
+		# Remove old packages
+		policy = get_retention_policy()
+		with aptly_intake.VersionIndex(
+			aptly_intake.get_version_index_path(session.shard)
+		) as index:
+			start = time.monotonic()
 
-			if len(versions) <= keep:
-				# Go to the next package
-				continue
+			published = aptly_intake.get_published_refs(session, index) \
+				if policy.keep_published else set()
 
-			_versions = list(versions.keys())
-			for i in range(0, keep):
-				winner = reduce(
-					lambda x, y : x if apt_pkg.version_compare(x, y) > 0 else y,
-					_versions
-				)
+			repositories = [x["Name"] for x in session.LocalRepo.list()]
+			index.prune(repositories)
 
-				_versions.remove(winner)
-				to_keep.append(winner)
+			for name in repositories:
+				repo = session.LocalRepo(name=name)
 
-			to_remove += [ref for version, ref in versions.items() if version not in to_keep]
+				# Use the metadata mirror, if it has a complete list
+				refs = session.mirror.get_packages(name) \
+					if session.mirror is not None else None
+				if refs is None:
+					refs = repo.search()
 
-	return to_remove
+				index.update(name, refs)
+				to_remove = policy.plan(index, name, published)
 
-if __name__ == "__main__":
-	apt_pkg.init_system()
-
-	with aptly_api.AptlySession("http://localhost:8080") as session:
-		with aptly_api.AptlyAPILock() as lock:
-			# Remove old packages
-			for repository in session.LocalRepo.list():
-				repo = session.LocalRepo(name=repository["Name"])
-				packages_per_arch = {}
-
-				for ref in repo.search():
-					arch, name, version, _ = ref.split(" ")
-					packages_per_arch.setdefault(arch, {}).setdefault(name, {})[version] = ref
-
-				to_remove = get_packages_to_remove(packages_per_arch, keep=(1 if not repository["Name"] in EXTENDED_KEEP else 3))
-
-				print("Repo: %s, removing: %s" % (repository["Name"], "\n    - ".join(to_remove)))
-
-				repo.delete_packages(to_remove)
-
-			# Remove old snapshots
-			for snapshot in session.Snapshot.list():
-				snap = session.Snapshot(name=snapshot["Name"])
-				# Always try deleting, aptly will complain if it's published
-				try:
-					snap.delete()
-				except Exception as e:
-					if "snapshot is published" in str(e):
-						# Safely continue
-						continue
-					else:
-						# Shouldn't reach this
-						raise
+				print("Repo: %s, removing: %s" % (name, "\n    - ".join(to_remove)))
+
+				if to_remove:
+					repo.delete_packages(to_remove)
+					index.remove(name, to_remove)
+
+			print(
+				"%s: applied retention to %d repositories in %.1fs" % (
+					shard,
+					len(repositories),
+					time.monotonic() - start
+				)
+			)
+
+		# Remove old snapshots
+		for snapshot in session.Snapshot.list():
+			if session.mirror is not None and session.mirror.is_published(snapshot["Name"]):
+				continue
+
+			snap = session.Snapshot(name=snapshot["Name"])
+			# Always try deleting, aptly will complain if it's published
+			try:
+				snap.delete()
+			except Exception as e:
+				if "snapshot is published" in str(e):
+					# Safely continue
+					continue
 				else:
-					print("Removed snapshot %s" % snapshot["Name"])
+					# Shouldn't reach this
+					raise
+			else:
+				print("Removed snapshot %s" % snapshot["Name"])
+
+		# Cleanup
+		if not shard in DEFAULT_CLEANUP_CONFIGS:
+			print("No configuration for aptly instance %s, skipping database cleanup" % shard)
+			return
 
-			# Cleanup
-			subprocess.check_call(["aptly", "db", "cleanup", "-config", "/etc/aptly-api.conf", "-dep-follow-all-variants", "-dep-follow-source"])
+		subprocess.check_call(["aptly", "db", "cleanup", "-config", DEFAULT_CLEANUP_CONFIGS[shard], "-dep-follow-all-variants", "-dep-follow-source"])
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description="Removes old packages, snapshots and upload directories "
+		"from aptly"
+	)
+	parser.add_argument(
+		"--gc-only",
+		action="store_true",
+		help="only remove the upload directories left by failed imports"
+	)
+	parser.add_argument(
+		"--dry-run",
+		action="store_true",
+		help="with --gc-only, only show what would be removed"
+	)
+	parser.add_argument(
+		"--profile",
+		metavar="MODES",
+		help="profile the run: cpu, memory or all (default: $APTLY_INTAKE_PROFILE). "
+		"Profiles are written to /var/lib/aptly-intake/profiles"
+	)
+	args = parser.parse_args()
+
+	if args.dry_run and not args.gc_only:
+		parser.error("--dry-run is only supported with --gc-only")
+
+	# Every aptly instance is cleaned up at the same time
+	with aptly_intake.profiled("clean", modes=args.profile), \
+		aptly_api.AptlyRouter.from_config(config) as router:
+		if args.gc_only:
+			router.map(
+				lambda shard, session: collect_uploads(shard, session, dry_run=args.dry_run)
+			)
+		else:
+			router.map(clean)
@@ -31,13 +31,21 @@ import os
 
 import sys
 
+import time
+
 import uuid
 
+import hashlib
+
+import argparse
+
 import configparser
 
 import aptly_api
 
-from debian.deb822 import Changes
+import aptly_intake
+
+from functools import partial
 
 ALLOWED_DISTRIBUTIONS = [
 	"bullseye",
@@ -47,16 +55,42 @@ ALLOWED_DISTRIBUTIONS = [
 	"hotfixes",
 ]
 
+# Fields every .changes file must have
+REQUIRED_CHANGES_FIELDS = [
+	"Source",
+	"Version",
+	"Distribution",
+	"Files",
+]
+
 # How does the publishing work:
 #  1. This script is invoked by a watcher whenever a new .changes
 #     file appears
-#  2. Every file referenced in the .changes file gets uploaded to
+#  2. The .changes file is validated, and its signature verified
+#     locally if possible (see preflight())
+#  3. Every file referenced in the .changes file gets uploaded to
 #     a new directory in aptly
-#  3. A lock is acquired
-#  4. The files are included in the local repo
-#  5. Every component is snapshotted
-#  6. The new snapshots gets published
-#  7. Lock is released
+#  4. A lock is acquired
+#  5. The files are included in the local repo
+#  6. The included packages are added to the repositories of the
+#     fan-out distributions, if any
+#  7. Every component of every affected distribution is snapshotted
+#  8. The new snapshots gets published
+#  9. Lock is released
+#
+# Packages are fanned out to the additional distributions listed in
+# the Distribution field of the .changes file (the first one is the
+# target distribution), and to the ones configured with APTLY_FANOUT.
+#
+# Several .changes files for the same channel and distribution can
+# be imported together (see --scan): they share the upload directories,
+# so that every component is included, and the distribution published,
+# only once.
+#
+# Every completed step is recorded in a per-run journal (see
+# aptly_intake/journal.py), so that an interrupted import can be
+# resumed by calling this script again on the same .changes file, or
+# with --resume.
 
 INTAKE_SETTINGS = "/var/lib/aptly-api/intake-settings"
 
@@ -85,180 +119,1549 @@ DEFAULT_SIGNING_DISABLE_VERIFY_TRANSIT = config.getboolean(
 	fallback=False
 )
 
-# FIXME?
-DEFAULT_ARCHITECTURES = [
-	"source",
-	"amd64",
-	"i386",
-	"arm64",
-	"armhf",
+# Keyring used to verify .changes signatures locally. Should be the
+# same one aptly uses.
+DEFAULT_VERIFY_GPG_KEYRING = config.get(
+	"Intake",
+	"APTLY_VERIFY_GPG_KEYRING",
+	fallback="/var/lib/aptly-api/.gnupg/trustedkeys.gpg"
+)
+
+# Number of .changes files validated at the same time
+DEFAULT_PREFLIGHT_WORKERS = config.getint(
+	"Intake",
+	"APTLY_PREFLIGHT_WORKERS",
+	fallback=aptly_intake.PARALLEL_WORKERS
+)
+
+# aptly's upload directory (<rootDir>/upload). When local staging is
+# enabled and it's writable (i.e. aptly runs on the same host), files
+# are staged there directly rather than being uploaded via HTTP.
+DEFAULT_UPLOAD_DIRECTORY = config.get(
+	"Intake",
+	"APTLY_UPLOAD_DIRECTORY",
+	fallback="/var/lib/aptly-api/upload"
+)
+DEFAULT_LOCAL_STAGING = config.getboolean(
+	"Intake",
+	"APTLY_LOCAL_STAGING",
+	fallback=False
+)
+
+# Whether files already in aptly's pool should be referenced rather
+# than uploaded again
+DEFAULT_DEDUPE_UPLOADS = config.getboolean(
+	"Intake",
+	"APTLY_DEDUPE_UPLOADS",
+	fallback=True
+)
+
+# Additional distributions the packages uploaded to a distribution
+# should be added to, in the form
+#  distribution:distribution[,distribution...]
+# separated by spaces.
+DEFAULT_FANOUT = {
+	distribution : targets.split(",")
+	for distribution, targets in (
+		x.split(":", 1)
+		for x in config.get(
+			"Intake",
+			"APTLY_FANOUT",
+			fallback=""
+		).split()
+	)
+}
+
+# Minimum interval between two publishes of the same channel and
+# distribution, in seconds. Changes made in the meantime are published
+# together once it has elapsed. 0 disables debouncing.
+DEFAULT_PUBLISH_MIN_INTERVAL = config.getint(
+	"Intake",
+	"APTLY_PUBLISH_MIN_INTERVAL",
+	fallback=0
+)
+
+# Per-distribution overrides of the minimum interval, in the form
+#  channel/distribution:seconds
+# separated by spaces. Patterns are shell-style wildcards.
+DEFAULT_PUBLISH_INTERVALS = [
+	(pattern, int(interval))
+	for pattern, interval in (
+		x.rsplit(":", 1)
+		for x in config.get(
+			"Intake",
+			"APTLY_PUBLISH_INTERVALS",
+			fallback=""
+		).split()
+	)
 ]
 
-if __name__ == "__main__":
-	# Open changes files as specified in the command line
-	if len(sys.argv) == 2:
-		changes_path = os.path.abspath(sys.argv[1])
-		with open(changes_path, "r") as f:
-			changes = Changes(f)
-	else:
-		raise Exception("No (or too many) .changes files has been specified")
+# Number of components included (and repositories snapshotted) at the
+# same time while the lock is held
+DEFAULT_COMPONENT_WORKERS = config.getint(
+	"Intake",
+	"APTLY_COMPONENT_WORKERS",
+	fallback=aptly_intake.PARALLEL_WORKERS
+)
+
+# Whether the old versions of the imported packages are removed right
+# after they're included, following aptly-clean's retention policy
+DEFAULT_INLINE_RETENTION = config.getboolean(
+	"Intake",
+	"APTLY_INLINE_RETENTION",
+	fallback=True
+)
+
+# Directory where a manifest of the packages added and removed by
+# every publish is written, for downstream mirrors. Disabled if empty.
+DEFAULT_MANIFEST_OUTBOX = aptly_intake.ManifestOutbox.from_config(config)
+
+# Number of batches of .changes files uploaded ahead while another one
+# is being imported (with --resume and --scan). 0 disables pipelining.
+DEFAULT_PIPELINE_DEPTH = config.getint(
+	"Intake",
+	"APTLY_PIPELINE_DEPTH",
+	fallback=aptly_intake.PIPELINE_DEPTH
+)
 
-	run_uuid = uuid.uuid4()
+def parse_changes(changes_path, data=None):
+	"""
+	Parses the given .changes file.
 
-	with aptly_api.AptlySession("http://localhost:8080/") as session:
+	:param: changes_path: the path of the .changes file
+	:param: data: the contents of the file, if they've already been
+	read
+	"""
 
-		base_directory = os.path.dirname(changes_path)
+	# Imported here, as it's slow to load and not needed when there's
+	# nothing to import
+	from debian.deb822 import Changes
+
+	if data is not None:
+		return Changes(data)
+
+	with open(changes_path, "r") as f:
+		return Changes(f)
+
+def preflight(changes_path):
+	"""
+	Validates the given .changes file before anything is uploaded or
+	locked, raises an exception if it can't be imported.
+
+	The signature is verified locally when possible, so that aptly
+	doesn't need to do it while the lock is held. The file is read only
+	once, and only the payload that has been verified is parsed:
+	anything outside the signed block is refused.
+
+	Returns a (parsed .changes file, sha256 hexdigest, payload sha256
+	hexdigest) tuple, the last one being None if the signature hasn't
+	been verified locally.
 
-		# Obtain distribution
-		distribution = changes["Distribution"]
+	:param: changes_path: the absolute path of the .changes file
+	"""
 
-		# We assume the channel is the directory name
-		channel = os.path.basename(base_directory)
+	with open(changes_path, "rb") as f:
+		data = f.read()
 
+	digest = hashlib.sha256(data).hexdigest()
+
+	verified = None
+	if not DEFAULT_SIGNING_DISABLE_VERIFY_TRANSIT:
+		if aptly_intake.can_verify_signature(DEFAULT_VERIFY_GPG_KEYRING):
+			data = aptly_intake.verify_signature(changes_path, DEFAULT_VERIFY_GPG_KEYRING, data)
+			verified = hashlib.sha256(data).hexdigest()
+		else:
+			print(
+				"Unable to verify signatures locally using %s, leaving it to aptly" % (
+					DEFAULT_VERIFY_GPG_KEYRING
+				)
+			)
+
+			# aptly checks only the signed block as well
+			aptly_intake.check_signed_block(changes_path, data)
+
+	changes = parse_changes(changes_path, data)
+
+	missing = [x for x in REQUIRED_CHANGES_FIELDS if not x in changes]
+	if missing:
+		raise Exception("Missing fields: %s" % ", ".join(missing))
+
+	for distribution in changes["Distribution"].split():
 		if not distribution in ALLOWED_DISTRIBUTIONS:
 			raise Exception("Distribution %s not allowed" % distribution)
 
-		touched_components = set()
+	# Files might have already been uploaded (and removed) by a
+	# previous run
+	journal = aptly_intake.ImportJournal.find(changes_path)
+	if journal is None or journal.changes_sha256 != digest:
+		base_directory = os.path.dirname(changes_path)
 		for referenced_file in changes["files"]:
-			component = referenced_file["section"].split("/")[0] \
-				if "section" in referenced_file and "/" in referenced_file["section"] \
-				else "main"
+			if not os.path.exists(os.path.join(base_directory, referenced_file["name"])):
+				raise Exception("Referenced file %s not found" % referenced_file["name"])
+
+	return changes, digest, verified
+
+def get_package_names(changes):
+	"""
+	Returns the set of the names of the source and binary packages of
+	the given .changes file.
+
+	:param: changes: the parsed .changes file
+	"""
+
+	names = set(changes.get("Binary", "").split())
+	names.add(changes["Source"].split()[0])
+
+	return names
+
+def get_component(referenced_file):
+	"""
+	Returns the component of the given file, as referenced in the
+	.changes file.
+
+	:param: referenced_file: the file entry in the .changes file
+	"""
+
+	return referenced_file["section"].split("/")[0] \
+		if "section" in referenced_file and "/" in referenced_file["section"] \
+		else "main"
+
+def classify(session, journal, changes):
+	"""
+	Checks the files referenced in the .changes file against the pool
+	index, and records in the journal the ones that don't need to be
+	uploaded.
+
+	Packages already known to aptly can't be included using the .changes
+	file (aptly wants every referenced file), so their components are
+	added file by file instead. As that skips aptly's signature check,
+	this is done only if the signature has been verified locally (see
+	preflight()), and if the .changes file hasn't changed since.
+
+	:param: session: an AptlySession() instance
+	:param: journal: the ImportJournal of the current run
+	:param: changes: the parsed .changes file
+	"""
+
+	known = {}
+
+	if DEFAULT_DEDUPE_UPLOADS:
+		checksums = {
+			x["name"] : x
+			for x in changes.get("Checksums-Sha256", [])
+		}
+
+		with aptly_intake.PoolIndex(aptly_intake.get_pool_index_path(session.shard)) as index:
+			for referenced_file in changes["files"]:
+				name = referenced_file["name"]
+				if not name.endswith(aptly_intake.BINARY_EXTENSIONS + aptly_intake.SOURCE_EXTENSIONS) \
+					or not name in checksums:
+					continue
+
+				key = index.lookup(session, checksums[name]["sha256"])
+				if key is not None:
+					known[name] = {
+						"component" : get_component(referenced_file),
+						"key" : key,
+						"size" : int(checksums[name]["size"]),
+					}
+
+	if known and not DEFAULT_SIGNING_DISABLE_VERIFY_TRANSIT:
+		if not journal.verified:
+			print("Signature of %s not verified locally, uploading every file" % journal.changes_path)
+			known = {}
+		else:
+			# The .changes file must still be the verified one, as it
+			# won't be uploaded for the deduplicated components
+			journal.read_changes()
+
+	# Source files other than the .dsc, and everything aptly doesn't
+	# import (i.e. .buildinfo), are needed only by a .dsc that is going
+	# to be uploaded
+	dedupe_components = {x["component"] for x in known.values()}
+	for referenced_file in changes["files"]:
+		name = referenced_file["name"]
+		component = get_component(referenced_file)
+
+		if name in known or not component in dedupe_components \
+			or name.endswith(aptly_intake.BINARY_EXTENSIONS + aptly_intake.SOURCE_EXTENSIONS):
+			continue
+
+		needed = any(
+			x["name"].endswith(aptly_intake.SOURCE_EXTENSIONS) and not x["name"] in known
+			for x in changes["files"]
+			if get_component(x) == component
+		)
+		if not needed:
+			known[name] = {
+				"component" : component,
+				"key" : None,
+				"size" : int(referenced_file["size"]),
+			}
+
+	if known:
+		print(
+			"Skipping upload of %d file(s) already in the pool, %d bytes saved" % (
+				len(known),
+				sum(x["size"] for x in known.values())
+			)
+		)
+
+	journal.mark_classified(known)
+
+def is_local_staging_available(session):
+	"""
+	Returns True if files can be staged directly into aptly's upload
+	directory.
+
+	Only the default aptly instance can be staged into.
+
+	:param: session: an AptlySession() instance
+	"""
+
+	return DEFAULT_LOCAL_STAGING \
+		and session.shard is None \
+		and os.access(DEFAULT_UPLOAD_DIRECTORY, os.W_OK | os.X_OK)
+
+def get_staging_directory(directory):
+	"""
+	Returns the local path of the given upload directory, creating it
+	if needed.
+
+	:param: directory: the name of the upload directory
+	"""
+
+	path = os.path.join(DEFAULT_UPLOAD_DIRECTORY, directory)
+	os.makedirs(path, exist_ok=True)
+
+	return path
+
+def upload(session, journal, changes, uploaded):
+	"""
+	Uploads every file referenced in the .changes file (and the
+	.changes file itself) into per-component directories.
+
+	Files already uploaded in a previous attempt are skipped.
+
+	:param: session: an AptlySession() instance
+	:param: journal: the ImportJournal of the current run
+	:param: changes: the parsed .changes file
+	:param: uploaded: a set of (directory, file name) tuples already
+	uploaded by the runs imported together with this one. It gets
+	updated with the files uploaded by this run.
+	"""
 
-			# Create a new directory and upload every referenced file
-			upload_directory = session.Directory(dir="%s-%s" % (run_uuid, component))
+	base_directory = os.path.dirname(journal.changes_path)
 
-			full_filepath = os.path.join(base_directory, referenced_file["name"])
+	if not journal.is_classified():
+		classify(session, journal, changes)
 
-			with open(full_filepath, "r+b") as f:
+	checksums = {
+		x["name"] : x
+		for x in changes.get("Checksums-Sha256", [])
+	}
+
+	local_staging = is_local_staging_available(session)
+
+	# A hardlinked file must be removed from the queue, otherwise it
+	# would share its inode with the upload directory (and then the
+	# pool), and any write to the queue would corrupt it
+	can_link = os.access(base_directory, os.W_OK | os.X_OK)
+	staged = {
+		"linked" : 0,
+		"copied" : 0,
+	}
+	started = time.monotonic()
+
+	touched_components = set()
+	for referenced_file in changes["files"]:
+		component = get_component(referenced_file)
+		touched_components.add(component)
+
+		if referenced_file["name"] in journal.known:
+			# Already in the pool
+			continue
+		elif journal.is_file_uploaded(referenced_file["name"]):
+			print("Skipping %s, already uploaded" % referenced_file["name"])
+			continue
+		elif (journal.upload_directory(component), referenced_file["name"]) in uploaded:
+			# Shared with another .changes file imported together
+			# with this one (e.g. an .orig.tar.*)
+			journal.mark_file_uploaded(referenced_file["name"], component)
+			continue
+
+		# Create a new directory and upload every referenced file
+		upload_directory = session.Directory(dir=journal.upload_directory(component))
+
+		full_filepath = os.path.join(base_directory, referenced_file["name"])
+
+		# Size and checksums are verified while uploading: a corrupted
+		# file aborts the import before the lock is taken
+		with open(full_filepath, "r+b") as f:
+			verified_file = aptly_api.VerifiedUpload(
+				f,
+				size=int(referenced_file["size"]),
+				sha256=checksums[referenced_file["name"]]["sha256"] \
+					if referenced_file["name"] in checksums else None,
+				md5=referenced_file["md5sum"],
+			)
+
+			linked = False
+			if local_staging:
+				print("Staging %s" % full_filepath)
+				verified_file.verify()
+				staged_path = os.path.join(
+					get_staging_directory(journal.upload_directory(component)),
+					referenced_file["name"]
+				)
+				linked = aptly_intake.stage_file(full_filepath, staged_path, link=can_link)
+			else:
 				print("Uploading %s" % full_filepath)
-				upload_directory.upload(f)
+				upload_directory.upload(verified_file)
+
+			# Record the upload before truncating, so that we never
+			# end up with a truncated file that is not in the journal
+			journal.mark_file_uploaded(referenced_file["name"], component)
+			uploaded.add((journal.upload_directory(component), referenced_file["name"]))
 
+			if linked:
+				# The staged file is the same as the queued one, so it
+				# can't be truncated. If it can't be removed either,
+				# replace the staged file with a copy.
+				try:
+					os.remove(full_filepath)
+				except OSError as e:
+					print("Unable to remove %s (%s), copying it instead" % (full_filepath, e))
+					os.remove(staged_path)
+					aptly_intake.copy_file(full_filepath, staged_path)
+					linked = False
+
+			if local_staging:
+				staged["linked" if linked else "copied"] += verified_file.size
+
+			if not linked:
 				# Truncate rather than removing as we might not be
 				# able to write to the upload directory
 				f.truncate(0)
 
-			touched_components.add(component)
+	# Truncate the files we skipped as well
+	for name in journal.known:
+		with open(os.path.join(base_directory, name), "r+b") as f:
+			f.truncate(0)
+
+	# Upload the changes file for every component
+	# FIXME: Is this wrong?
+	for component in touched_components - journal.dedupe_components:
+		if local_staging:
+			print("Staging changes file %s on touched component %s" % (journal.changes_path, component))
+
+			# Only the contents that have been validated can be staged
+			data = journal.read_changes()
+			with open(
+				os.path.join(
+					get_staging_directory(journal.upload_directory(component)),
+					os.path.basename(journal.changes_path)
+				),
+				"wb"
+			) as f:
+				f.write(data)
+
+			staged["copied"] += len(data)
+			continue
+
+		upload_directory = session.Directory(dir=journal.upload_directory(component))
+
+		with open(journal.changes_path, "rb") as f:
+			print("Uploading changes file %s on touched component %s" % (journal.changes_path, component))
+
+			# Only the contents that have been validated can be
+			# uploaded
+			upload_directory.upload(
+				aptly_api.VerifiedUpload(f, sha256=journal.changes_sha256)
+			)
+
+	if local_staging:
+		print(
+			"Staged files locally in %.2fs: %d bytes hardlinked, %d bytes copied" % (
+				time.monotonic() - started,
+				staged["linked"],
+				staged["copied"]
+			)
+		)
+
+	journal.mark_uploaded(touched_components)
+
+def check_uploaded(session, journal, changes):
+	"""
+	Ensures that the files uploaded in a previous attempt are still
+	available on the server, raises an exception otherwise.
+
+	:param: session: an AptlySession() instance
+	:param: journal: the ImportJournal of the current run
+	:param: changes: the parsed .changes file
+	"""
+
+	for component in journal.components:
+		if journal.is_included(component):
+			continue
+
+		upload_directory = journal.upload_directory(component)
+
+		try:
+			available = set(session.Directory(dir=upload_directory).list())
+		except aptly_api.AptlyAPIError as e:
+			# Anything but a missing directory is worth retrying later
+			if e.status_code != 404:
+				raise
+
+			available = set()
+
+		expected = set(journal.uploaded_files(component))
+		if not component in journal.dedupe_components:
+			expected.add(os.path.basename(journal.changes_path))
+
+		if not expected:
+			# Nothing has been uploaded for this component
+			continue
+
+		if not expected <= available:
+			raise Exception(
+				"Unable to resume run %s: upload directory %s is missing %s. "
+				"If the files have already been included, remove the journal "
+				"%s and run aptly-new-snapshot, otherwise re-upload from the builder" % (
+					journal.run_uuid,
+					upload_directory,
+					", ".join(sorted(expected - available)),
+					journal.path
+				)
+			)
+
+def get_failed(result, names):
+	"""
+	Returns True if any of the given file names has been reported
+	as failed by aptly.
+
+	:param: result: the result of an include or add request
+	:param: names: the file names to look for
+	"""
+
+	failed = {
+		os.path.basename(x)
+		for x in (result or {}).get("FailedFiles") or []
+	}
+
+	return bool(failed & set(names))
+
+def get_distribution_repositories(repos, channel, distribution):
+	"""
+	Returns the repositories of the given channel and distribution.
+
+	:param: repos: a dictionary of the channel's local repositories and
+	their component
+	:param: channel: the channel
+	:param: distribution: the distribution
+	"""
+
+	return {
+		x : y
+		for x, y in repos.items()
+		if x.startswith("%s_%s_" % (channel, distribution))
+	}
+
+def add_component(session, journal, changes, component, repository):
+	"""
+	Adds the uploaded files of a deduplicated component one by one, and
+	references the ones that are already in the pool.
+
+	Returns the list of the journals whose files aptly refused to add.
+
+	:param: session: an AptlySession() instance
+	:param: journal: the ImportJournal of the run
+	:param: changes: the parsed .changes file
+	:param: component: the component
+	:param: repository: the name of the target local repository
+	"""
+
+	if journal.uploaded_files(component):
+		print("Adding packages for component %s" % component)
+		res = session.RepositoryDirectory(
+			name=repository,
+			dir=journal.upload_directory(component)
+		).add()
+		print("Result of import is %s" % res)
+
+		if get_failed(res, journal.uploaded_files(component)):
+			return [journal]
+
+	package_refs = [
+		x["key"]
+		for x in journal.known.values()
+		if x["component"] == component and x["key"] is not None
+	]
+	if package_refs:
+		print("Referencing packages %s for component %s" % (", ".join(package_refs), component))
+		session.LocalRepo(name=repository).add_packages(package_refs)
+
+	journal.mark_component_included(
+		component,
+		get_package_refs(session, journal, repository, changes)
+	)
+
+	return []
+
+def include_directory(session, directory, repository, component, runs):
+	"""
+	Includes an upload directory, shared by the given runs.
+
+	aptly doesn't check the signatures again if every .changes file has
+	been verified locally.
+
+	Returns the list of the journals whose files aptly refused to
+	include.
+
+	:param: session: an AptlySession() instance
+	:param: directory: the upload directory
+	:param: repository: the name of the target local repository
+	:param: component: the component
+	:param: runs: a list of (ImportJournal, parsed .changes file) tuples
+	"""
+
+	print("Importing packages for component %s" % component)
+	res = session.RepositoryDirectory(
+		name=repository,
+		dir=directory
+	).include(
+		accept_unsigned=DEFAULT_SIGNING_DISABLE_VERIFY_TRANSIT,
+		ignore_signature=all(x.verified for x, y in runs)
+	)
+	print("Result of import is %s" % res)
+
+	failed = []
+	for journal, changes in runs:
+		if get_failed(res, [os.path.basename(journal.changes_path)]):
+			failed.append(journal)
+			continue
+
+		journal.mark_component_included(
+			component,
+			get_package_refs(session, journal, repository, changes)
+		)
+
+	return failed
+
+def include_steps(steps):
+	"""
+	Runs the given include steps in order, and returns the list of the
+	journals whose files aptly refused to include.
+
+	:param: steps: a list of functions, as add_component() and
+	include_directory() with their arguments
+	"""
+
+	failed = []
+	for step in steps:
+		failed += step()
+
+	return failed
+
+def include(session, runs, repos):
+	"""
+	Includes the uploaded files into the target local repositories,
+	creating them if needed.
+
+	Upload directories shared by several runs are included only once.
+	Different repositories (i.e. components) are included at the same
+	time, DEFAULT_COMPONENT_WORKERS at most: if any of them fails, the
+	others are still included and an exception is raised at the end.
+
+	Returns the list of the journals whose files aptly refused to
+	include.
+
+	:param: session: an AptlySession() instance
+	:param: runs: a list of (ImportJournal, parsed .changes file) tuples
+	:param: repos: a dictionary of the channel's local repositories and
+	their component. Newly created repositories are added to it.
+	"""
+
+	# Maps target repositories to the steps needed to include them,
+	# which are run in order
+	steps = {}
+
+	# Maps upload directories to the target repository and the runs
+	# that should be included from there
+	directories = {}
+
+	for journal, changes in runs:
+		for component in journal.components:
+
+			target_repository_name = aptly_intake.get_repository(
+				session,
+				repos,
+				journal.channel,
+				journal.distribution,
+				component
+			)
+
+			if journal.is_included(component):
+				print("Skipping import for component %s, already included" % component)
+				continue
+
+			if component in journal.dedupe_components:
+				steps.setdefault(target_repository_name, []).append(
+					partial(add_component, session, journal, changes, component, target_repository_name)
+				)
+			else:
+				directories.setdefault(
+					journal.upload_directory(component),
+					(target_repository_name, component, [])
+				)[2].append((journal, changes))
+
+	for directory, (target_repository_name, component, directory_runs) in directories.items():
+		steps.setdefault(target_repository_name, []).append(
+			partial(include_directory, session, directory, target_repository_name, component, directory_runs)
+		)
+
+	results = aptly_intake.run_parallel(
+		{
+			repository : partial(include_steps, repository_steps)
+			for repository, repository_steps in steps.items()
+		},
+		workers=DEFAULT_COMPONENT_WORKERS
+	)
+
+	failed = []
+	for journals in results.values():
+		failed += [x for x in journals if not x in failed]
+
+	return failed
+
+def get_package_refs(session, journal, repository, changes):
+	"""
+	Returns the package refs of the packages of the .changes file that
+	are now in the given repository, and adds them to the pool index.
+
+	Returns None if the refs are not needed.
+
+	:param: session: an AptlySession() instance
+	:param: journal: the ImportJournal of the current run
+	:param: repository: the name of the local repository
+	:param: changes: the parsed .changes file
+	"""
+
+	if not journal.fanout and not DEFAULT_DEDUPE_UPLOADS:
+		return None
+
+	names = get_package_names(changes)
+
+	try:
+		packages = session.LocalRepo(name=repository).search(
+			q=" | ".join("Name (= %s)" % x for x in sorted(names)),
+			format="details"
+		)
+	except Exception as e:
+		if journal.fanout:
+			raise
+
+		# The index is only a cache, don't fail the import
+		print("Unable to update the pool index: %s" % e)
+		return None
+
+	if DEFAULT_DEDUPE_UPLOADS:
+		try:
+			with aptly_intake.PoolIndex(aptly_intake.get_pool_index_path(session.shard)) as index:
+				index.update(packages)
+		except Exception as e:
+			print("Unable to update the pool index: %s" % e)
+
+	# Only keep the packages coming from this upload, and not other
+	# versions of them
+	checksums = {
+		x["sha256"]
+		for x in changes.get("Checksums-Sha256", [])
+	}
 
-		# Upload the changes file for every component
-		# FIXME: Is this wrong?
-		for component in touched_components:
-			upload_directory = session.Directory(dir="%s-%s" % (run_uuid, component))
+	return [
+		x["Key"]
+		for x in packages
+		if checksums & set(aptly_intake.get_checksums(x, dsc_only=True))
+	]
 
-			with open(changes_path, "rb") as f:
-				print("Uploading changes file %s on touched component %s" % (changes_path, component))
-				upload_directory.upload(f)
+def fanout(session, journals, repos):
+	"""
+	Adds the included packages to the repositories of the fan-out
+	distributions.
+
+	:param: session: an AptlySession() instance
+	:param: journals: the ImportJournals of the runs being imported
+	:param: repos: a dictionary of the channel's local repositories and
+	their component. Newly created repositories are added to it.
+	"""
+
+	for journal in journals:
+		if journal.is_fanned_out():
+			continue
+
+		for distribution in journal.fanout:
+			for component, refs in journal.refs.items():
+				if not refs:
+					continue
+
+				target_repository_name = aptly_intake.get_repository(
+					session,
+					repos,
+					journal.channel,
+					distribution,
+					component
+				)
+
+				print("Adding %s to %s" % (", ".join(refs), target_repository_name))
+				session.LocalRepo(name=target_repository_name).add_packages(refs)
+
+		journal.mark_fanned_out()
+
+def prune(session, runs, repos):
+	"""
+	Removes the old versions of the imported packages from the
+	repositories they've been included into, following the retention
+	policy of aptly-clean.
+
+	Only the packages of the given runs are looked at, aptly-clean
+	takes care of everything else.
+
+	:param: session: an AptlySession() instance
+	:param: runs: a list of (ImportJournal, parsed .changes file) tuples
+	:param: repos: a dictionary of the channel's local repositories and
+	their component
+	"""
+
+	policy = aptly_intake.RetentionPolicy.from_config(config)
+
+	# Maps the repositories to the names of their packages to look at
+	targets = {}
+	for journal, changes in runs:
+		for distribution in journal.distributions:
+			for component in journal.components:
+				repository = "%s_%s_%s" % (journal.channel, distribution, component)
+				if repository in repos:
+					targets.setdefault(repository, set()).update(get_package_names(changes))
+
+	if not targets:
+		return
+
+	with aptly_intake.VersionIndex(
+		aptly_intake.get_version_index_path(session.shard)
+	) as index:
+		published = aptly_intake.get_published_refs(
+			session,
+			index,
+			set().union(*targets.values())
+		) if policy.keep_published else set()
+
+		for repository, names in targets.items():
+			repo = session.LocalRepo(name=repository)
+
+			index.update(
+				repository,
+				repo.search(q=" | ".join("Name (= %s)" % x for x in sorted(names))),
+				names=names
+			)
+			to_remove = policy.plan(index, repository, published, names=names)
+			if not to_remove:
+				continue
+
+			print("Repo: %s, removing: %s" % (repository, "\n    - ".join(to_remove)))
+
+			repo.delete_packages(to_remove)
+			index.remove(repository, to_remove)
+
+def get_debouncer():
+	"""
+	Returns the PublishDebouncer() configured in the intake settings.
+	"""
+
+	return aptly_intake.PublishDebouncer(
+		DEFAULT_PUBLISH_MIN_INTERVAL,
+		DEFAULT_PUBLISH_INTERVALS
+	)
+
+def publish_distribution(session, debouncer, repos, channel, distribution, suffix):
+	"""
+	Snapshots every repository of the given distribution, publishes
+	them, and returns the created snapshots.
+
+	:param: session: an AptlySession() instance
+	:param: debouncer: a PublishDebouncer() instance
+	:param: repos: a dictionary of the channel's local repositories and
+	their component
+	:param: channel: the channel
+	:param: distribution: the distribution
+	:param: suffix: the suffix of the snapshot names
+	"""
+
+	signing_configuration = aptly_api.AptlyAPISigningOptions(
+		[
+			("Skip", False),
+			("GpgKey", DEFAULT_SIGNING_GPG_FINGERPRINT),
+		]
+	)
+
+	created_snapshots = aptly_intake.snapshot_repositories(
+		session,
+		get_distribution_repositories(repos, channel, distribution),
+		suffix,
+		workers=DEFAULT_COMPONENT_WORKERS
+	)
+
+	previous_snapshots = aptly_intake.publish_snapshots(
+		session,
+		channel,
+		distribution,
+		created_snapshots,
+		signing_configuration,
+		"%s (%s channel)" % (DEFAULT_VENDOR, channel),
+		DEFAULT_VENDOR,
+		aptly_intake.DEFAULT_ARCHITECTURES
+	)
+
+	if DEFAULT_MANIFEST_OUTBOX is not None:
+		try:
+			DEFAULT_MANIFEST_OUTBOX.emit(session, channel, distribution, previous_snapshots, created_snapshots)
+		except Exception as e:
+			print("Unable to write the change manifest of %s/%s: %s" % (channel, distribution, e))
+
+	coalesced = debouncer.mark_published(channel, distribution)
+	if coalesced:
+		print("Published %s/%s, coalescing %d publish(es)" % (channel, distribution, coalesced))
+
+	return created_snapshots
+
+def snapshot_and_publish(session, journals, repos, suffix):
+	"""
+	Snapshots every repository of every affected distribution, and
+	publishes them.
+
+	Snapshots must reflect the state of the repositories while the lock
+	is held, so they are always re-taken when resuming.
+
+	Distributions published too recently are not published right away,
+	but left to `publish_pending()`.
+
+	:param: session: an AptlySession() instance
+	:param: journals: the ImportJournals of the runs being imported
+	:param: repos: a dictionary of the channel's local repositories and
+	their component
+	:param: suffix: the suffix of the snapshot names
+	"""
+
+	channel = journals[0].channel
+	debouncer = get_debouncer()
+
+	distributions = []
+	for journal in journals:
+		distributions += [x for x in journal.distributions if not x in distributions]
+
+	for distribution in distributions:
+		if not debouncer.should_publish(channel, distribution):
+			print(
+				"%s/%s has been published less than %ds ago, deferring its publish" % (
+					channel,
+					distribution,
+					debouncer.get_interval(channel, distribution)
+				)
+			)
+			continue
+
+		created_snapshots = publish_distribution(
+			session,
+			debouncer,
+			repos,
+			channel,
+			distribution,
+			suffix
+		)
+
+		for journal in journals:
+			if distribution in journal.distributions:
+				journal.mark_snapshotted(distribution, created_snapshots)
+
+	for journal in journals:
+		journal.mark_published()
+
+def publish_pending(router):
+	"""
+	Publishes every distribution whose publish has been deferred, and
+	whose minimum interval has elapsed.
+
+	Returns the list of the distributions that couldn't be published.
+
+	:param: router: an AptlyRouter() instance
+	"""
+
+	debouncer = get_debouncer()
+	failed = []
+
+	for channel, distribution in debouncer.get_due():
+		session = router.session_for(channel, distribution)
+
+		try:
+			with session.lock() as lock:
+				# Might have been published in the meantime
+				if not debouncer.is_due(channel, distribution):
+					continue
+
+				repos = {
+					x["Name"] : x["DefaultComponent"] # FIXME: this is an assumption we make
+					for x in session.LocalRepo.list()
+					if x["Name"].startswith("%s_" % channel)
+				}
+
+				print("Publishing deferred changes of %s/%s" % (channel, distribution))
+				publish_distribution(
+					session,
+					debouncer,
+					repos,
+					channel,
+					distribution,
+					str(uuid.uuid4())
+				)
+		except Exception as e:
+			print("Unable to publish %s/%s: %s" % (channel, distribution, e))
+			failed.append("%s/%s" % (channel, distribution))
+
+	return failed
+
+def finalize(journal):
+	"""
+	Truncates the .changes file and removes the journal of a completed
+	run.
+
+	:param: journal: the ImportJournal of the current run
+	"""
+
+	# Remove changes files
+	with open(journal.changes_path, "w") as f:
+		f.truncate(0)
+
+	journal.remove()
+
+def get_journal(router, changes_path, changes, digest, upload_prefix=None, run_uuid=None):
+	"""
+	Returns the journal to use for the given .changes file: either
+	the one of a previous, interrupted, run, or a brand new one.
+
+	:param: router: an AptlyRouter() instance
+	:param: changes_path: the absolute path of the .changes file
+	:param: changes: the parsed .changes file
+	:param: digest: the sha256 hexdigest of the parsed contents, as
+	returned by preflight()
+	:param: upload_prefix: the prefix of the upload directories of a
+	new run, see ImportJournal.create()
+	:param: run_uuid: the uuid of a new run, or None to generate one
+	"""
+
+	journal = aptly_intake.ImportJournal.find(changes_path)
+
+	if journal is not None:
+		if journal.changes_sha256 == digest:
+			print("Resuming run %s from step %s" % (journal.run_uuid, journal.step))
+			journal.new_attempt()
+			return journal
+
+		# A new upload with the same name replaced the one of the
+		# interrupted run, which is now stale
+		print("Discarding stale journal %s" % journal.path)
+		journal.remove()
+
+		# Its upload directories might still be around
+		if str(run_uuid) == journal.run_uuid:
+			run_uuid = None
+
+	# Obtain distribution, and the fan-out ones
+	distributions = changes["Distribution"].split()
+	for distribution in DEFAULT_FANOUT.get(distributions[0], []):
+		if not distribution in distributions:
+			distributions.append(distribution)
+
+	# The ones in the .changes file have been checked by preflight()
+	for distribution in distributions:
+		if not distribution in ALLOWED_DISTRIBUTIONS:
+			raise Exception("Distribution %s not allowed" % distribution)
+
+	# We assume the channel is the directory name
+	channel = os.path.basename(os.path.dirname(changes_path))
+
+	# Packages are fanned out within the same aptly database
+	shard = router.get_shard(channel, distributions[0])
+	for distribution in distributions[1:]:
+		if not router.is_routed(shard, channel, distribution):
+			raise Exception(
+				"Distribution %s is not served by the same aptly instance as %s" % (
+					distribution,
+					distributions[0]
+				)
+			)
+
+	return aptly_intake.ImportJournal.create(
+		run_uuid or uuid.uuid4(),
+		changes_path,
+		channel,
+		distributions[0],
+		fanout=distributions[1:],
+		upload_prefix=upload_prefix,
+		changes_sha256=digest
+	)
+
+def prepare_import(router, changes_paths, run_uuid=None):
+	"""
+	Validates the given .changes files and uploads their files,
+	resuming previous runs if there are any. Nothing is locked.
+
+	Returns a (session, runs, failed) tuple: the AptlySession() to
+	import the runs with (None if there's nothing left to import), the
+	list of (ImportJournal, parsed .changes file) tuples to import, and
+	the list of the .changes files that couldn't be imported.
+
+	:param: router: an AptlyRouter() instance, the runs are imported
+	into the aptly instance serving their channel and distribution
+	:param: changes_paths: a list of absolute paths of .changes files
+	:param: run_uuid: the uuid of the new run, when importing a single
+	.changes file (see get_run_uuid())
+	"""
+
+	# Runs imported together share the upload directories
+	upload_prefix = str(uuid.uuid4()) if len(changes_paths) > 1 else None
+
+	failed = []
+	pending = []
+	for changes_path in changes_paths:
+		journal = aptly_intake.ImportJournal.find(changes_path)
+
+		if journal is not None and journal.done("published"):
+			# finalize() might have truncated the .changes file
+			# already, so it can't go through preflight()
+			if os.path.getsize(changes_path) == 0 or journal.matches(changes_path):
+				print("Resuming run %s from step %s" % (journal.run_uuid, journal.step))
+				finalize(journal)
+				continue
+
+			# A new upload with the same name arrived after the run
+			# has been published
+			print("Discarding stale journal %s" % journal.path)
+			journal.remove()
+			journal = None
+
+		if os.path.getsize(changes_path) == 0 and journal is None:
+			print("%s has already been imported, skipping" % changes_path)
+			continue
+
+		pending.append(changes_path)
+
+	# Validate every file before uploading anything or locking
+	preflights = aptly_intake.run_parallel(
+		{
+			x : partial(preflight, x)
+			for x in pending
+		},
+		workers=DEFAULT_PREFLIGHT_WORKERS,
+		return_exceptions=True
+	)
+
+	runs = []
+	for changes_path in pending:
+		try:
+			if isinstance(preflights[changes_path], Exception):
+				raise preflights[changes_path]
+
+			changes, digest, verified = preflights[changes_path]
+
+			journal = get_journal(router, changes_path, changes, digest, upload_prefix, run_uuid)
+			if verified and not journal.verified:
+				journal.mark_verified(digest, verified)
+		except Exception as e:
+			print("Unable to import %s: %s" % (changes_path, e))
+			failed.append(changes_path)
+			continue
+
+		runs.append((journal, changes))
+
+	if len({(x.channel, x.distribution) for x, y in runs}) > 1:
+		raise Exception("Only .changes files for the same channel and distribution can be imported together")
+
+	if not runs:
+		return None, runs, failed
+
+	session = router.session_for(runs[0][0].channel, runs[0][0].distribution)
+
+	uploaded = set()
+	for journal, changes in runs[:]:
+		try:
+			if not journal.done("uploaded"):
+				upload(session, journal, changes, uploaded)
+			else:
+				check_uploaded(session, journal, changes)
+		except Exception as e:
+			print("Unable to upload %s: %s" % (journal.changes_path, e))
+			failed.append(journal.changes_path)
+			runs.remove((journal, changes))
+
+	return session, runs, failed
+
+def complete_import(session, runs, failed):
+	"""
+	Includes, snapshots and publishes the given runs, prepared by
+	prepare_import(), while holding the lock.
+
+	Returns the list of the .changes files that couldn't be imported.
+
+	:param: session: the AptlySession() to import the runs with
+	:param: runs: a list of (ImportJournal, parsed .changes file) tuples
+	:param: failed: the list of the .changes files that couldn't be
+	prepared
+	"""
+
+	failed = list(failed)
+
+	if runs:
+		channel = runs[0][0].channel
 
 		# Now we should operate on the aptly database directly, so
 		# obtain a lock...
-		with aptly_api.AptlyAPILock() as lock:
+		with session.lock() as lock:
 			# Get the list of local repositories related to the current
-			# channel and distribution combo
+			# channel
 			repos = {
 				x["Name"] : x["DefaultComponent"] # FIXME: this is an assumption we make
 				for x in session.LocalRepo.list()
-				if x["Name"].startswith("%s_%s_" % (channel, distribution))
+				if x["Name"].startswith("%s_" % channel)
 			}
 
-			# We should create a new repository?
-			for component in touched_components:
+			for journal in include(session, [x for x in runs if not x[0].done("included")], repos):
+				print("aptly refused to include %s" % journal.changes_path)
+				failed.append(journal.changes_path)
 
-				# Construct target repository name, which boils down to
-				#  channel_distribution_component
-				target_repository_name = "%s_%s_%s" % (
-					channel,
-					distribution,
-					component
+			journals = [x for x, y in runs if x.done("included")]
+
+			if journals:
+				if len(runs) > 1:
+					suffix = str(uuid.uuid4())
+				elif journals[0].state["attempts"] > 1:
+					# Avoid clashing with the snapshots of the
+					# previous attempt
+					suffix = "%s_%d" % (journals[0].run_uuid, journals[0].state["attempts"])
+				else:
+					suffix = journals[0].run_uuid
+
+				fanout(session, journals, repos)
+
+				if DEFAULT_INLINE_RETENTION:
+					try:
+						prune(session, [x for x in runs if x[0].done("included")], repos)
+					except Exception as e:
+						# aptly-clean will take care of them
+						print("Unable to remove old versions: %s" % e)
+
+				# Local repo is ok now, snapshot every repository and
+				# re-publish them
+				snapshot_and_publish(session, journals, repos, suffix)
+
+		for journal in journals:
+			finalize(journal)
+
+	return failed
+
+def import_changes(router, changes_paths, run_uuid=None):
+	"""
+	Imports the given .changes files, resuming previous runs if there
+	are any.
+
+	Every file must target the same channel and distribution: they
+	are included together, and the distribution is published once.
+
+	Returns the list of the .changes files that couldn't be imported.
+
+	:param: router: an AptlyRouter() instance, the runs are imported
+	into the aptly instance serving their channel and distribution
+	:param: changes_paths: a list of absolute paths of .changes files
+	:param: run_uuid: the uuid of the new run, when importing a single
+	.changes file (see get_run_uuid())
+	"""
+
+	return complete_import(*prepare_import(router, changes_paths, run_uuid))
+
+def get_run_uuid(changes_path):
+	"""
+	Returns the uuid of the run importing the given .changes file: the
+	one of its interrupted run, if it's going to be resumed, or a new
+	one.
+
+	:param: changes_path: the absolute path of the .changes file
+	"""
+
+	journal = aptly_intake.ImportJournal.find(changes_path)
+	if journal is not None and os.path.exists(changes_path) \
+		and journal.matches(changes_path):
+		return journal.run_uuid
+
+	return str(uuid.uuid4())
+
+def import_batches(router, batches, depth=None):
+	"""
+	Imports the given batches of .changes files (see import_changes()),
+	uploading the files of the next batch while the current one is
+	being imported with the lock held.
+
+	A batch that fails doesn't stop the others.
+
+	Returns the list of the .changes files that couldn't be imported.
+
+	:param: router: an AptlyRouter() instance
+	:param: batches: a list of lists of absolute paths of .changes files
+	:param: depth: the number of batches that can be uploaded ahead,
+	defaults to DEFAULT_PIPELINE_DEPTH
+	"""
+
+	def upload_batch(batch):
+		try:
+			return prepare_import(router, batch)
+		except Exception as e:
+			print("Unable to upload %s: %s" % (", ".join(batch), e))
+			return None, [], batch
+
+	def import_batch(batch, prepared):
+		session, runs, failed = prepared
+
+		try:
+			return complete_import(session, runs, failed)
+		except Exception as e:
+			# Can be resumed later on
+			print("Unable to import %s: %s" % (", ".join(batch), e))
+			return batch
+
+	pipeline = aptly_intake.Pipeline(
+		upload_batch,
+		import_batch,
+		depth=DEFAULT_PIPELINE_DEPTH if depth is None else depth,
+		names=("upload", "import")
+	)
+
+	failed = []
+	for batch_failed in pipeline.run(batches):
+		failed += batch_failed
+
+	pipeline.report()
+
+	return failed
+
+def benchmark_staging(session, changes_path):
+	"""
+	Compares the time needed to upload the files of the given .changes
+	file via HTTP with the time needed to stage them locally.
+
+	Nothing is imported, and the queued files are left untouched.
+
+	:param: session: an AptlySession() instance
+	:param: changes_path: the absolute path of the .changes file
+	"""
+
+	changes = parse_changes(changes_path)
+
+	base_directory = os.path.dirname(changes_path)
+	directory = "benchmark-%s" % uuid.uuid4()
+	files = [
+		(os.path.join(base_directory, x["name"]), int(x["size"]))
+		for x in changes["files"]
+	]
+
+	try:
+		started = time.monotonic()
+		for path, size in files:
+			with open(path, "rb") as f:
+				session.Directory(dir="%s-http" % directory).upload(
+					aptly_api.VerifiedUpload(f, size=size)
 				)
+		http_time = time.monotonic() - started
+
+		started = time.monotonic()
+		staged = {
+			True : 0,
+			False : 0,
+		}
+		for path, size in files:
+			with open(path, "rb") as f:
+				aptly_api.VerifiedUpload(f, size=size).verify()
 
-				if not target_repository_name in repos:
-					# Create a new repository
-					session.LocalRepo.create(
-						target_repository_name,
-						comment="Local repository for %s/%s" % (
-							distribution,
-							component
-						),
-						default_distribution=distribution,
-						default_component=component
+			staged[
+				aptly_intake.stage_file(
+					path,
+					os.path.join(
+						get_staging_directory("%s-local" % directory),
+						os.path.basename(path)
 					)
-					repos[target_repository_name] = component
-
-				# Now include the new packages
-				print("Importing packages for component %s" % component)
-				res = session.RepositoryDirectory(
-					name=target_repository_name,
-					dir="%s-%s" % (run_uuid, component)
-				).include(accept_unsigned=DEFAULT_SIGNING_DISABLE_VERIFY_TRANSIT)
-				print("Result of import is %s" % res)
-
-			# Local repo is ok now, snapshot every repository and
-			# re-publish them
-			created_snapshots = []
-			for repo, component in repos.items():
-				snapshot_name = "%s_%s" % (repo, run_uuid)
-				print("Creating snapshot for repo %s" % repo)
-				session.LocalRepo(name=repo).snapshot(snapshot_name)
-				created_snapshots.append(
-					{
-						"Component" : component,
-						"Name" : snapshot_name
-					}
 				)
+			] += size
+		local_time = time.monotonic() - started
+	finally:
+		for suffix in ("http", "local"):
+			try:
+				session.Directory(dir="%s-%s" % (directory, suffix)).delete()
+			except Exception as e:
+				print("Unable to remove upload directory %s-%s: %s" % (directory, suffix, e))
 
-			# Obtain the list of published repositories
-			channel_published = (channel, distribution) in [
-				(x["Prefix"], x["Distribution"])
-				for x in session.PublishedRepo.list()
-			]
-
-			signing_configuration = aptly_api.AptlyAPISigningOptions(
-				[
-					("Skip", False),
-					("GpgKey", DEFAULT_SIGNING_GPG_FINGERPRINT),
-				]
-			)
+	print("HTTP upload: %d bytes sent in %.2fs" % (sum(x for y, x in files), http_time))
+	print(
+		"Local staging: %d bytes hardlinked, %d bytes copied in %.2fs" % (
+			staged[True],
+			staged[False],
+			local_time
+		)
+	)
+	print(
+		"Time saved: %.2fs (%.0f%%)" % (
+			http_time - local_time,
+			(http_time - local_time) / http_time * 100 if http_time else 0
+		)
+	)
 
-			for publish_try in range(0, 2):
-				# We should try two times due to how aptly behaves when
-				# switching snapshots on an already published repository
-				# when a new component has been added.
+def scan_queue(queue_directory):
+	"""
+	Finds every .changes file waiting in the queue, and returns them
+	grouped in batches that can be imported together.
 
-				if channel_published:
-					# Switch
-					target_published_distribution = session.PublishedDistribution(
-						prefix=channel,
-						distribution=distribution,
-					)
+	Files of the same channel and distribution are batched together,
+	unless they reference files with the same name but different
+	content.
 
-					try:
-						target_published_distribution.update(
-							snapshots=created_snapshots,
-							signing=signing_configuration,
-							force_overwrite=True,
-						)
-					except Exception as e:
-						if "not in published repository" in str(e):
-							# Trying to publish an unpublished component,
-							# drop the published repo and try again from
-							# scratch
-							target_published_distribution.delete()
-							channel_published = False
-							continue
-				else:
-					# Create new published repository
-					session.PublishedRepo(prefix=channel).publish(
-						"snapshot",
-						created_snapshots,
-						distribution=distribution,
-						label="%s (%s channel)" % (DEFAULT_VENDOR, channel),
-						origin=DEFAULT_VENDOR,
-						architectures=DEFAULT_ARCHITECTURES,
-						signing=signing_configuration,
-						force_overwrite=True,
-					)
+	:param: queue_directory: the queue directory
+	"""
 
-				break
+	batches = []
+	for directory, dirnames, filenames in os.walk(queue_directory):
+		for filename in sorted(filenames):
+			changes_path = os.path.abspath(os.path.join(directory, filename))
+			if not filename.endswith(".changes") or os.path.getsize(changes_path) == 0:
+				continue
 
-	# Remove changes files
-	with open(changes_path, "w") as f:
-		f.truncate(0)
+			try:
+				changes = parse_changes(changes_path)
+
+				target = (
+					os.path.basename(directory),
+					changes["Distribution"].split()[0]
+				)
+				files = {
+					x["name"] : x["md5sum"]
+					for x in changes["files"]
+				}
+			except Exception as e:
+				# Import it on its own so that it fails loudly
+				print("Unable to read %s: %s" % (changes_path, e))
+				batches.append((None, {}, [changes_path]))
+				continue
+
+			for batch_target, batch_files, batch_paths in batches:
+				if batch_target == target \
+					and all(batch_files.get(x, y) == y for x, y in files.items()):
+					batch_files.update(files)
+					batch_paths.append(changes_path)
+					break
+			else:
+				batches.append((target, files, [changes_path]))
+
+	return [x for y, z, x in batches]
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description="Imports a .changes file into aptly"
+	)
+	parser.add_argument(
+		"changes",
+		nargs="?",
+		help="the .changes file to import"
+	)
+	parser.add_argument(
+		"--resume",
+		action="store_true",
+		help="resume every interrupted import recorded in the journal"
+	)
+	parser.add_argument(
+		"--scan",
+		metavar="QUEUE_DIRECTORY",
+		help="import every .changes file waiting in the given queue directory, "
+		"in bulk"
+	)
+	parser.add_argument(
+		"--publish-pending",
+		action="store_true",
+		help="publish the distributions whose publish has been deferred, "
+		"if their minimum interval has elapsed"
+	)
+	parser.add_argument(
+		"--benchmark-staging",
+		action="store_true",
+		help="don't import the .changes file, but compare the time needed "
+		"to upload its files via HTTP with the time needed to stage them locally"
+	)
+	parser.add_argument(
+		"--profile",
+		metavar="MODES",
+		help="profile the run: cpu, memory or all (default: $APTLY_INTAKE_PROFILE). "
+		"Profiles are written to /var/lib/aptly-intake/profiles"
+	)
+	args = parser.parse_args()
+
+	if args.changes is None and not args.resume and args.scan is None \
+		and not args.publish_pending:
+		parser.error("No .changes file has been specified")
+
+	# The profile of a single import is named after its run, so that
+	# they can be matched. Looking the run up is only worth it when
+	# profiling
+	run_uuid = get_run_uuid(os.path.abspath(args.changes)) \
+		if args.changes is not None and not args.benchmark_staging \
+		and aptly_intake.get_profile_modes(args.profile) else None
+
+	with aptly_intake.profiled("import", run_uuid, modes=args.profile), \
+		aptly_api.AptlyRouter.from_config(config) as router:
+		if args.benchmark_staging:
+			if args.changes is None:
+				parser.error("No .changes file has been specified")
+
+			benchmark_staging(router.get_session(router.default), os.path.abspath(args.changes))
+			sys.exit(0)
+
+		failed = []
+
+		# Uploads of the next batch overlap with the import of the
+		# current one
+		batches = []
+
+		if args.resume:
+			for journal in aptly_intake.ImportJournal.pending():
+				print("Resuming import of %s" % journal.changes_path)
+				batches.append([journal.changes_path])
+
+		if args.scan is not None:
+			resumed = {x for y in batches for x in y}
+
+			for batch in scan_queue(args.scan):
+				# Already being resumed
+				batch = [x for x in batch if not x in resumed]
+				if not batch:
+					continue
+
+				print("Importing %d .changes file(s) in bulk: %s" % (len(batch), ", ".join(batch)))
+				batches.append(batch)
+
+		if batches:
+			failed += import_batches(router, batches)
+
+		if args.changes is not None:
+			failed += import_changes(router, [os.path.abspath(args.changes)], run_uuid)
+
+		unpublished = publish_pending(router) if args.publish_pending else []
+
+		if failed:
+			raise Exception("Unable to import %d .changes file(s): %s" % (len(failed), ", ".join(failed)))
+
+		if unpublished:
+			raise Exception("Unable to publish %d distribution(s): %s" % (len(unpublished), ", ".join(unpublished)))
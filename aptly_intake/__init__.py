@@ -0,0 +1,120 @@
+"""
+Import pipeline of aptly-intake
+
+Submodules are imported when one of their names is first used, so
+that every entry point only pays for what it needs.
+"""
+
+import importlib
+
+_exports = {
+	"journal" : [
+		"JOURNAL_DIRECTORY",
+		"STEPS",
+		"file_digest",
+		"ImportJournal",
+	],
+	"manifest" : [
+		"MANIFEST_OUTBOX",
+		"MANIFEST_KEEP",
+		"get_pool_directory",
+		"get_pool_files",
+		"get_package_details",
+		"get_snapshot_changes",
+		"ManifestOutbox",
+	],
+	"parallel" : [
+		"PARALLEL_WORKERS",
+		"run_parallel",
+	],
+	"pipeline" : [
+		"PIPELINE_DEPTH",
+		"Pipeline",
+	],
+	"pool_index" : [
+		"POOL_INDEX",
+		"BINARY_EXTENSIONS",
+		"SOURCE_EXTENSIONS",
+		"get_pool_index_path",
+		"PoolIndex",
+		"get_checksums",
+	],
+	"signature" : [
+		"can_verify_signature",
+		"check_signed_block",
+		"verify_signature",
+	],
+	"retention" : [
+		"VERSION_INDEX",
+		"RETENTION_KEEP",
+		"get_version_key",
+		"get_version_index_path",
+		"VersionIndex",
+		"RetentionPolicy",
+		"get_pinned_snapshots",
+		"get_published_refs",
+	],
+	"scheduler" : [
+		"STATUS_FILE",
+		"DEFAULT_PRIORITIES",
+		"PUBLISH_RETRY_INTERVAL",
+		"IntakeJob",
+		"IntakeScheduler",
+	],
+	"staging" : [
+		"copy_file",
+		"stage_file",
+	],
+	"publish" : [
+		"DEFAULT_ARCHITECTURES",
+		"get_repository",
+		"get_published_sources",
+		"snapshot_repositories",
+		"publish_snapshots",
+	],
+	"debounce" : [
+		"PUBLISH_STATE",
+		"PublishDebouncer",
+	],
+	"profiling" : [
+		"PROFILES_DIRECTORY",
+		"PROFILE_ENVIRONMENT",
+		"PROFILE_MODES",
+		"PROFILE_KEEP",
+		"PROFILE_TOP_ALLOCATIONS",
+		"get_profile_modes",
+		"prune_profiles",
+		"write_allocations",
+		"profiled",
+	],
+	"upload_gc" : [
+		"GC_STATE",
+		"UPLOAD_DIRECTORY_PATTERN",
+		"GC_MAX_AGE",
+		"GC_WORKERS",
+		"get_directory_size",
+		"UploadGarbageCollector",
+	],
+}
+
+_modules = {
+	name : module
+	for module, names in _exports.items()
+	for name in names
+}
+
+def __getattr__(name):
+	"""
+	Imports the submodule providing the given name.
+	"""
+
+	if not name in _modules:
+		raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+	value = getattr(importlib.import_module(".%s" % _modules[name], __name__), name)
+	globals()[name] = value
+
+	return value
+
+def __dir__():
+	return sorted(set(globals()) | set(_modules))
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Debouncing of the publishes of every distribution
+"""
+
+import os
+
+import json
+
+import time
+
+import fcntl
+
+import fnmatch
+
+from contextlib import contextmanager
+
+PUBLISH_STATE = "/var/lib/aptly-intake/publish-state.json"
+
+class PublishDebouncer:
+	"""
+	Limits how often every channel/distribution is published.
+
+	A distribution published less than its minimum interval ago is not
+	published again right away: it is marked as pending instead, and
+	published once the interval has elapsed (see `get_due()`), so that
+	the last change always ends up being published. Every publish
+	skipped this way is counted as coalesced.
+
+	The state is shared by every aptly-intake process, and stored in
+	PUBLISH_STATE.
+	"""
+
+	def __init__(self, min_interval=0, intervals=[], path=PUBLISH_STATE):
+		"""
+		Initialises the class.
+
+		:param: min_interval: the default minimum interval between two
+		publishes of the same distribution, in seconds. 0 disables
+		debouncing
+		:param: intervals: a list of (pattern, interval) tuples
+		overriding min_interval. Patterns are shell-style wildcards
+		matched against channel/distribution, the first matching one wins
+		:param: path: the path of the state file
+		"""
+
+		self.min_interval = min_interval
+		self.intervals = intervals
+		self.path = path
+
+	@staticmethod
+	def get_key(channel, distribution):
+		return "%s/%s" % (channel, distribution)
+
+	def get_interval(self, channel, distribution):
+		"""
+		Returns the minimum interval of the given channel and
+		distribution, in seconds.
+
+		:param: channel: the channel
+		:param: distribution: the distribution
+		"""
+
+		target = self.get_key(channel, distribution)
+
+		for pattern, interval in self.intervals:
+			if fnmatch.fnmatchcase(target, pattern):
+				return interval
+
+		return self.min_interval
+
+	def load(self):
+		"""
+		Returns the current state.
+		"""
+
+		try:
+			with open(self.path, "r") as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return {}
+
+	@contextmanager
+	def update(self):
+		"""
+		Yields the current state, and stores it back on exit. Other
+		processes are kept from updating it in the meantime.
+		"""
+
+		os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+		with open("%s.lock" % self.path, "a") as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+
+			try:
+				state = self.load()
+
+				yield state
+
+				tmp_path = "%s.tmp" % self.path
+				with open(tmp_path, "w") as f:
+					json.dump(state, f, indent="\t")
+					f.flush()
+					os.fsync(f.fileno())
+
+				os.replace(tmp_path, self.path)
+			finally:
+				fcntl.flock(lock, fcntl.LOCK_UN)
+
+	def should_publish(self, channel, distribution):
+		"""
+		Returns True if the given channel and distribution can be
+		published now. Otherwise, marks it as pending and returns False.
+
+		The aptly lock should be held, and `mark_published()` called
+		after publishing.
+
+		:param: channel: the channel
+		:param: distribution: the distribution
+		"""
+
+		interval = self.get_interval(channel, distribution)
+		if interval <= 0:
+			return True
+
+		key = self.get_key(channel, distribution)
+		now = time.time()
+
+		with self.update() as state:
+			entry = state.setdefault(key, {})
+
+			if now - entry.get("published", 0) >= interval:
+				return True
+
+			entry["pending"] = True
+			entry["due"] = entry.get("published", 0) + interval
+			entry["coalesced"] = entry.get("coalesced", 0) + 1
+			entry["total_coalesced"] = entry.get("total_coalesced", 0) + 1
+
+		return False
+
+	def mark_published(self, channel, distribution):
+		"""
+		Records that the given channel and distribution has just been
+		published, and returns the number of publishes coalesced into
+		this one.
+
+		:param: channel: the channel
+		:param: distribution: the distribution
+		"""
+
+		with self.update() as state:
+			entry = state.setdefault(self.get_key(channel, distribution), {})
+			coalesced = entry.get("coalesced", 0)
+
+			entry.update(
+				{
+					"published" : time.time(),
+					"pending" : False,
+					"due" : None,
+					"coalesced" : 0,
+					"publishes" : entry.get("publishes", 0) + 1,
+				}
+			)
+
+		return coalesced
+
+	def is_due(self, channel, distribution):
+		"""
+		Returns True if the given channel and distribution is pending,
+		and its interval has elapsed.
+
+		:param: channel: the channel
+		:param: distribution: the distribution
+		"""
+
+		entry = self.load().get(self.get_key(channel, distribution), {})
+
+		return entry.get("pending", False) and entry["due"] <= time.time()
+
+	def get_due(self):
+		"""
+		Returns the list of the (channel, distribution) tuples that are
+		pending, and whose interval has elapsed.
+		"""
+
+		now = time.time()
+
+		return [
+			tuple(x.split("/", 1))
+			for x, y in sorted(self.load().items())
+			if y.get("pending", False) and y["due"] <= now
+		]
+
+	def get_next_due(self):
+		"""
+		Returns the number of seconds until the next pending publish is
+		due (0 if one is already due), or None if nothing is pending.
+		"""
+
+		now = time.time()
+
+		return min(
+			(
+				max(0, y["due"] - now)
+				for x, y in self.load().items()
+				if y.get("pending", False)
+			),
+			default=None
+		)
+
+	def get_status(self):
+		"""
+		Returns the state of every distribution: whether it is pending,
+		how many publishes have been coalesced into the pending one and
+		in total, and how many have been made.
+		"""
+
+		return {
+			x : {
+				"pending" : y.get("pending", False),
+				"coalesced" : y.get("coalesced", 0),
+				"total_coalesced" : y.get("total_coalesced", 0),
+				"publishes" : y.get("publishes", 0),
+			}
+			for x, y in self.load().items()
+		}
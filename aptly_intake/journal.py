@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Persistent, per-run import journal
+"""
+
+import os
+
+import json
+
+import time
+
+import hashlib
+
+import threading
+
+JOURNAL_DIRECTORY = "/var/lib/aptly-intake/journal"
+
+# Steps an import goes through, in order
+STEPS = [
+	"uploaded",
+	"included",
+	"snapshotted",
+	"published",
+]
+
+def file_digest(path):
+	"""
+	Returns the sha256 hexdigest of the given file.
+
+	:param: path: the path of the file to hash
+	"""
+
+	digest = hashlib.sha256()
+
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b""):
+			digest.update(chunk)
+
+	return digest.hexdigest()
+
+class ImportJournal:
+	"""
+	The journal of a single import run.
+
+	Every state change is committed to disk before the next step is
+	started, so that an interrupted import can be resumed from the
+	last completed step rather than from scratch (which is not possible
+	anyway, as the source files get truncated after being uploaded).
+	"""
+
+	def __init__(self, path, state):
+		"""
+		Initialises the class.
+
+		:param: path: the path of the journal file
+		:param: state: the journal state, as a dictionary
+		"""
+
+		self.path = path
+		self.state = state
+
+		# Components can be included at the same time
+		self.lock = threading.RLock()
+
+	@classmethod
+	def create(cls, run_uuid, changes_path, channel, distribution, fanout=None, upload_prefix=None, changes_sha256=None, directory=JOURNAL_DIRECTORY):
+		"""
+		Creates (and commits) a new journal for the given run.
+
+		:param: run_uuid: the run UUID
+		:param: changes_path: the absolute path of the .changes file
+		:param: channel: the target channel
+		:param: distribution: the target distribution
+		:param: fanout: a list of additional distributions the packages
+		should be added to
+		:param: upload_prefix: the prefix of the upload directories,
+		defaults to the run UUID. Runs imported together share it.
+		:param: changes_sha256: the sha256 hexdigest of the contents of
+		the .changes file that have been validated, defaults to the
+		digest of the file
+		:param: directory: the directory where journals are stored
+		"""
+
+		now = time.time()
+
+		journal = cls(
+			os.path.join(directory, "%s.json" % run_uuid),
+			{
+				"run_uuid" : str(run_uuid),
+				"upload_prefix" : str(upload_prefix or run_uuid),
+				"changes_path" : changes_path,
+				"changes_sha256" : changes_sha256 or file_digest(changes_path),
+				"channel" : channel,
+				"distribution" : distribution,
+				"fanout" : list(fanout or []),
+				"created" : now,
+				"updated" : now,
+				"attempts" : 1,
+				"step" : None,
+				"files" : {},
+				"known" : None,
+				"verified" : None,
+				"payload_sha256" : None,
+				"components" : [],
+				"included" : [],
+				"refs" : {},
+				"fanned_out" : False,
+				"snapshots" : {},
+			}
+		)
+		journal.commit()
+
+		return journal
+
+	@classmethod
+	def load(cls, path):
+		"""
+		Loads a journal from the given path.
+
+		:param: path: the path of the journal file
+		"""
+
+		with open(path, "r") as f:
+			return cls(path, json.load(f))
+
+	@classmethod
+	def pending(cls, directory=JOURNAL_DIRECTORY):
+		"""
+		Returns a list of every journal that has not been completed
+		yet, oldest first.
+
+		Journals are removed once a run is done, so every journal
+		found on disk is pending (even if its snapshots have already
+		been published, as the .changes file still needs to be
+		cleaned up).
+
+		:param: directory: the directory where journals are stored
+		"""
+
+		if not os.path.isdir(directory):
+			return []
+
+		return sorted(
+			(
+				cls.load(os.path.join(directory, x))
+				for x in os.listdir(directory)
+				if x.endswith(".json")
+			),
+			key=lambda x: x.state["created"]
+		)
+
+	@classmethod
+	def find(cls, changes_path, directory=JOURNAL_DIRECTORY):
+		"""
+		Returns the pending journal of the given .changes file, or
+		None if there isn't any.
+
+		:param: changes_path: the absolute path of the .changes file
+		:param: directory: the directory where journals are stored
+		"""
+
+		for journal in cls.pending(directory):
+			if journal.changes_path == changes_path:
+				return journal
+
+		return None
+
+	@property
+	def run_uuid(self):
+		return self.state["run_uuid"]
+
+	@property
+	def upload_prefix(self):
+		return self.state["upload_prefix"]
+
+	@property
+	def changes_path(self):
+		return self.state["changes_path"]
+
+	@property
+	def changes_sha256(self):
+		return self.state["changes_sha256"]
+
+	@property
+	def channel(self):
+		return self.state["channel"]
+
+	@property
+	def distribution(self):
+		return self.state["distribution"]
+
+	@property
+	def fanout(self):
+		return self.state["fanout"]
+
+	@property
+	def distributions(self):
+		"""
+		Returns every distribution affected by the run, the target one
+		first.
+		"""
+
+		return [self.distribution] + self.fanout
+
+	@property
+	def step(self):
+		return self.state["step"]
+
+	@property
+	def components(self):
+		return self.state["components"]
+
+	@property
+	def snapshots(self):
+		return self.state["snapshots"]
+
+	@property
+	def refs(self):
+		return self.state["refs"]
+
+	def done(self, step):
+		"""
+		Returns True if the given step has been completed.
+
+		:param: step: the step to check
+		"""
+
+		return (
+			self.step is not None and
+			STEPS.index(self.step) >= STEPS.index(step)
+		)
+
+	def matches(self, changes_path):
+		"""
+		Returns True if the given .changes file is the same one this
+		journal has been created for.
+
+		:param: changes_path: the .changes file to check
+		"""
+
+		return file_digest(changes_path) == self.changes_sha256
+
+	def commit(self):
+		"""
+		Atomically writes the journal to disk.
+		"""
+
+		with self.lock:
+			self.state["updated"] = time.time()
+
+			os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+			tmp_path = "%s.tmp" % self.path
+			with open(tmp_path, "w") as f:
+				json.dump(self.state, f, indent=1)
+				f.flush()
+				os.fsync(f.fileno())
+
+			os.replace(tmp_path, self.path)
+
+	def remove(self):
+		"""
+		Removes the journal from disk.
+		"""
+
+		if os.path.exists(self.path):
+			os.remove(self.path)
+
+	def new_attempt(self):
+		"""
+		Records that the run is being resumed.
+		"""
+
+		self.state["attempts"] += 1
+		self.commit()
+
+	@property
+	def known(self):
+		return self.state["known"] or {}
+
+	@property
+	def dedupe_components(self):
+		"""
+		Returns the set of components that have files already known to
+		aptly, and thus can't be included using the .changes file.
+		"""
+
+		return {x["component"] for x in self.known.values()}
+
+	@property
+	def verified(self):
+		"""
+		Returns True if the signature of the .changes file this journal
+		has been created for has been verified locally.
+		"""
+
+		return self.state.get("verified") == self.changes_sha256
+
+	def mark_verified(self, digest, payload_sha256):
+		"""
+		Records that the signature of the .changes file has been
+		verified locally.
+
+		:param: digest: the sha256 hexdigest of the .changes file that
+		has been verified
+		:param: payload_sha256: the sha256 hexdigest of its signed
+		payload, which is what has been parsed
+		"""
+
+		self.state["verified"] = digest
+		self.state["payload_sha256"] = payload_sha256
+		self.commit()
+
+	def read_changes(self):
+		"""
+		Returns the contents of the .changes file, raises an exception
+		if they're not the ones this journal has been created for (e.g.
+		the file has been replaced after its signature was verified).
+		"""
+
+		with open(self.changes_path, "rb") as f:
+			data = f.read()
+
+		if hashlib.sha256(data).hexdigest() != self.changes_sha256:
+			raise Exception(
+				"%s changed since it has been validated, refusing to use it" % (
+					self.changes_path
+				)
+			)
+
+		return data
+
+	def is_classified(self):
+		"""
+		Returns True if the files have been already checked against
+		the pool.
+		"""
+
+		return self.state["known"] is not None
+
+	def mark_classified(self, known):
+		"""
+		Records which files don't need to be uploaded.
+
+		:param: known: a dictionary mapping the file names to a
+		{ "component", "key", "size" } dictionary. key is the package
+		key of the file in aptly, or None if the file is not needed
+		at all.
+		"""
+
+		self.state["known"] = known
+		self.commit()
+
+	def is_file_uploaded(self, name):
+		"""
+		Returns True if the given file has already been uploaded, or
+		if it doesn't need to be.
+
+		:param: name: the file name, as in the .changes file
+		"""
+
+		return name in self.state["files"] or name in self.known
+
+	def upload_directory(self, component):
+		"""
+		Returns the name of the upload directory of the given component.
+
+		Components with files already in the pool are added file by
+		file, so they always get a directory of their own.
+
+		:param: component: the component
+		"""
+
+		return "%s-%s" % (
+			self.run_uuid if component in self.dedupe_components else self.upload_prefix,
+			component
+		)
+
+	def uploaded_files(self, component):
+		"""
+		Returns the names of the files uploaded for the given component.
+
+		:param: component: the component
+		"""
+
+		return [
+			x
+			for x, y in self.state["files"].items()
+			if y == component
+		]
+
+	def mark_file_uploaded(self, name, component):
+		"""
+		Records that the given file has been uploaded.
+
+		:param: name: the file name, as in the .changes file
+		:param: component: the component the file has been uploaded for
+		"""
+
+		self.state["files"][name] = component
+		self.commit()
+
+	def mark_uploaded(self, components):
+		"""
+		Records that every file has been uploaded.
+
+		:param: components: the list of touched components
+		"""
+
+		self.state["components"] = sorted(components)
+		self.state["step"] = "uploaded"
+		self.commit()
+
+	def is_included(self, component):
+		"""
+		Returns True if the given component has already been included.
+
+		:param: component: the component to check
+		"""
+
+		return component in self.state["included"]
+
+	def mark_component_included(self, component, refs=None):
+		"""
+		Records that the given component has been included.
+
+		:param: component: the included component
+		:param: refs: the package refs of the included packages, if
+		they're needed for the fan-out
+		"""
+
+		with self.lock:
+			self.state["included"].append(component)
+			if refs is not None:
+				self.state["refs"][component] = refs
+
+			if set(self.state["included"]) >= set(self.state["components"]):
+				self.state["step"] = "included"
+
+			self.commit()
+
+	def is_fanned_out(self):
+		"""
+		Returns True if the packages have been added to the fan-out
+		distributions.
+		"""
+
+		return self.state["fanned_out"] or not self.fanout
+
+	def mark_fanned_out(self):
+		"""
+		Records that the packages have been added to the fan-out
+		distributions.
+		"""
+
+		self.state["fanned_out"] = True
+		self.commit()
+
+	def mark_snapshotted(self, distribution, snapshots):
+		"""
+		Records the snapshots that have been created for the given
+		distribution.
+
+		:param: distribution: the snapshotted distribution
+		:param: snapshots: a list of { "Component", "Name" } dictionaries
+		"""
+
+		self.state["snapshots"][distribution] = snapshots
+
+		if set(self.state["snapshots"]) >= set(self.distributions):
+			self.state["step"] = "snapshotted"
+
+		self.commit()
+
+	def mark_published(self):
+		"""
+		Records that the snapshots have been published.
+		"""
+
+		self.state["step"] = "published"
+		self.commit()
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Manifests of the changes brought by every publish, for downstream
+mirrors
+"""
+
+import os
+
+import json
+
+import time
+
+MANIFEST_OUTBOX = "/var/lib/aptly-intake/outbox"
+
+# Number of manifests kept in the outbox
+MANIFEST_KEEP = 1000
+
+def get_pool_directory(package, component):
+	"""
+	Returns the directory of the given package in the pool of a
+	published repository, like aptly does (e.g. "pool/main/libf/libfoo").
+
+	:param: package: the package details, as returned by aptly
+	:param: component: the component the package is published in
+	"""
+
+	# Binary packages are stored along with their source package
+	source = package.get("Source", package["Package"]).split("(")[0].strip()
+
+	return "pool/%s/%s/%s" % (
+		component,
+		source[:4] if source.startswith("lib") else source[:1],
+		source
+	)
+
+def get_pool_files(package, component):
+	"""
+	Returns the paths of the files of the given package in the pool of
+	a published repository.
+
+	:param: package: the package details, as returned by aptly
+	:param: component: the component the package is published in
+	"""
+
+	if "Filename" in package:
+		# Binary package
+		names = [os.path.basename(package["Filename"])]
+	else:
+		names = [
+			x.split()[2]
+			for x in package.get("Files", "").splitlines()
+			if len(x.split()) == 3
+		]
+
+	directory = get_pool_directory(package, component)
+
+	return ["%s/%s" % (directory, x) for x in names]
+
+def get_package_details(session, snapshot, refs):
+	"""
+	Returns the details of the given packages of the given snapshot.
+
+	:param: session: an AptlySession() instance
+	:param: snapshot: the name of the snapshot
+	:param: refs: the package refs, or None for every package
+	"""
+
+	if refs is not None and not refs:
+		return []
+
+	packages = session.Snapshot(name=snapshot).search(
+		q=(
+			" | ".join(
+				"Name (= %s)" % x
+				for x in sorted({y.split(" ")[1] for y in refs})
+			)
+			if refs is not None else None
+		),
+		format="details"
+	)
+
+	return [x for x in packages if refs is None or x["Key"] in refs]
+
+def get_snapshot_changes(session, previous, current):
+	"""
+	Returns the package refs added and removed by switching a published
+	distribution from the previous snapshots to the current ones, and
+	the paths of their files in the pool, as a dictionary of components
+	and { "previous", "snapshot", "added", "removed", "added_files",
+	"removed_files" } dictionaries.
+
+	Removed files might still be used by other distributions published
+	with the same prefix.
+
+	:param: session: an AptlySession() instance
+	:param: previous: a dictionary of components and their previously
+	published snapshot
+	:param: current: a dictionary of components and their newly
+	published snapshot
+	"""
+
+	changes = {}
+
+	for component in sorted(set(previous) | set(current)):
+		old = previous.get(component)
+		new = current.get(component)
+
+		if old == new:
+			added, removed = [], []
+		elif old is None:
+			added, removed = get_package_details(session, new, None), []
+		elif new is None:
+			added, removed = [], get_package_details(session, old, None)
+		else:
+			diff = session.SnapshotDiff(name=old, with_snapshot=new).diff()
+			added = get_package_details(
+				session,
+				new,
+				{x["Right"] for x in diff if x["Right"] is not None}
+			)
+			removed = get_package_details(
+				session,
+				old,
+				{x["Left"] for x in diff if x["Left"] is not None}
+			)
+
+		changes[component] = {
+			"previous" : old,
+			"snapshot" : new,
+			"added" : sorted(x["Key"] for x in added),
+			"removed" : sorted(x["Key"] for x in removed),
+			"added_files" : sorted(
+				{y for x in added for y in get_pool_files(x, component)}
+			),
+			"removed_files" : sorted(
+				{y for x in removed for y in get_pool_files(x, component)}
+			),
+		}
+
+	return changes
+
+class ManifestOutbox:
+	"""
+	A directory of change manifests, one for every publish, that
+	downstream mirrors can fetch (e.g. via HTTP) to only sync the
+	changed packages.
+
+	Manifests are named so that they sort in publishing order. A mirror
+	should fall back to a full sync if the previous snapshots of a
+	manifest are not the ones it last synced.
+	"""
+
+	def __init__(self, directory=MANIFEST_OUTBOX, keep=MANIFEST_KEEP):
+		"""
+		Initialises the class.
+
+		:param: directory: the outbox directory
+		:param: keep: the number of manifests to keep
+		"""
+
+		self.directory = directory
+		self.keep = keep
+
+	@classmethod
+	def from_config(cls, config):
+		"""
+		Returns the ManifestOutbox() configured in the intake settings
+		(APTLY_MANIFEST_OUTBOX, APTLY_MANIFEST_KEEP), or None if manifests
+		are disabled.
+
+		:param: config: a ConfigParser() instance
+		"""
+
+		directory = config.get("Intake", "APTLY_MANIFEST_OUTBOX", fallback="")
+		if not directory:
+			return None
+
+		return cls(
+			directory,
+			keep=config.getint("Intake", "APTLY_MANIFEST_KEEP", fallback=MANIFEST_KEEP)
+		)
+
+	def write(self, manifest):
+		"""
+		Atomically writes the given manifest to the outbox, and returns
+		its path.
+
+		:param: manifest: the manifest, as a dictionary
+		"""
+
+		os.makedirs(self.directory, exist_ok=True)
+
+		path = os.path.join(
+			self.directory,
+			"%020d-%s-%s.json" % (
+				time.time_ns(),
+				manifest["channel"],
+				manifest["distribution"]
+			)
+		)
+
+		# Hidden until complete
+		tmp_path = os.path.join(self.directory, ".%s.tmp" % os.path.basename(path))
+		with open(tmp_path, "w") as f:
+			json.dump(manifest, f, indent=1)
+			f.flush()
+			os.fsync(f.fileno())
+
+		os.replace(tmp_path, path)
+
+		return path
+
+	def prune(self):
+		"""
+		Removes the oldest manifests, keeping the last `keep` ones.
+		"""
+
+		manifests = sorted(
+			x
+			for x in os.listdir(self.directory)
+			if x.endswith(".json") and not x.startswith(".")
+		)
+
+		for name in manifests[:max(0, len(manifests) - self.keep)]:
+			try:
+				os.remove(os.path.join(self.directory, name))
+			except FileNotFoundError:
+				pass
+
+	def emit(self, session, channel, distribution, previous, current):
+		"""
+		Writes the manifest of a publish to the outbox, and returns its
+		path.
+
+		:param: session: the AptlySession() of the aptly instance
+		:param: channel: the channel (the publishing prefix)
+		:param: distribution: the distribution
+		:param: previous: a dictionary of components and their previously
+		published snapshot, or None if the distribution was not published
+		:param: current: a list of the newly published { "Component",
+		"Name" } snapshots
+		"""
+
+		path = self.write(
+			{
+				"channel" : channel,
+				"distribution" : distribution,
+				"shard" : session.shard,
+				"published" : time.time(),
+				# Every package is new, a full sync is needed
+				"full" : previous is None,
+				"components" : get_snapshot_changes(
+					session,
+					previous or {},
+					{
+						x["Component"] : x["Name"]
+						for x in current
+					}
+				),
+			}
+		)
+
+		self.prune()
+
+		return path
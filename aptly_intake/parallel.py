@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Bounded parallel execution of independent tasks
+"""
+
+PARALLEL_WORKERS = 4
+
+def run_parallel(tasks, workers=PARALLEL_WORKERS, return_exceptions=False):
+	"""
+	Runs the given tasks, at most `workers` at the same time, and
+	returns a dictionary of their results.
+
+	Every task is run even if some of them fail: the errors are
+	printed, and an exception is raised at the end.
+
+	:param: tasks: a dictionary of task names and functions to call,
+	without arguments
+	:param: workers: the maximum number of tasks to run at the same time
+	:param: return_exceptions: if True, the exceptions raised by the
+	tasks are returned as their results instead
+	"""
+
+	# Imported here, as it's only needed when there's something to run
+	from concurrent.futures import ThreadPoolExecutor
+
+	results = {}
+	failed = []
+
+	with ThreadPoolExecutor(max_workers=max(1, min(workers, len(tasks)))) as executor:
+		futures = {
+			name : executor.submit(function)
+			for name, function in tasks.items()
+		}
+
+		for name, future in futures.items():
+			try:
+				results[name] = future.result()
+			except Exception as e:
+				if return_exceptions:
+					results[name] = e
+					continue
+
+				print("%s failed: %s" % (name, e))
+				failed.append(name)
+
+	if failed:
+		raise Exception("Failed on %d task(s): %s" % (len(failed), ", ".join(failed)))
+
+	return results
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Two-stage pipeline, overlapping the stages of consecutive items
+"""
+
+import time
+
+import queue
+
+import threading
+
+# Number of items the first stage can complete ahead of the second one
+PIPELINE_DEPTH = 1
+
+# Marks the end of the items
+_DONE = object()
+
+class Pipeline:
+	"""
+	Runs every item through two stages: the first one in a background
+	thread, the second one in the calling thread, in order. Items are
+	handed over through a bounded queue, so that the first stage of an
+	item runs while the second stage of the previous one does.
+
+	The time every stage spends waiting for the other one (stalled) is
+	recorded, as well as the depth of the queue.
+	"""
+
+	def __init__(self, first, second, depth=PIPELINE_DEPTH, names=("first", "second")):
+		"""
+		Initialises the class.
+
+		:param: first: the first stage, called as first(item)
+		:param: second: the second stage, called as second(item, result)
+		with the result of the first stage
+		:param: depth: the number of items the first stage can complete
+		ahead of the second one. If 0, the stages are run one after the
+		other, without a background thread
+		:param: names: the names of the two stages, used in the reports
+		"""
+
+		self.first = first
+		self.second = second
+		self.depth = depth
+		self.names = names
+
+		self.stats = {
+			name : {
+				"items" : 0,
+				"busy" : 0.0,
+				"stalled" : 0.0,
+			}
+			for name in names
+		}
+		self.max_depth = 0
+
+	def record(self, stage, busy, stalled, depth):
+		"""
+		Records the completion of an item by the given stage, and prints
+		it.
+
+		:param: stage: the index of the stage
+		:param: busy: the time spent on the item
+		:param: stalled: the time spent waiting for the other stage
+		:param: depth: the depth of the queue
+		"""
+
+		stats = self.stats[self.names[stage]]
+		stats["items"] += 1
+		stats["busy"] += busy
+		stats["stalled"] += stalled
+
+		self.max_depth = max(self.max_depth, depth)
+
+		print(
+			"Pipeline: %s stage done in %.2fs, stalled %.2fs, queue depth %d" % (
+				self.names[stage],
+				busy,
+				stalled,
+				depth
+			)
+		)
+
+	def run(self, items):
+		"""
+		Runs the given items through the pipeline, and returns the
+		results of the second stage.
+
+		Exceptions raised by the first stage are raised again when the
+		second stage gets to their item, exceptions raised by the second
+		stage stop the pipeline.
+
+		:param: items: the items to process
+		"""
+
+		if self.depth <= 0:
+			results = []
+			for item in items:
+				started = time.monotonic()
+				result = self.first(item)
+				self.record(0, time.monotonic() - started, 0, 0)
+
+				started = time.monotonic()
+				results.append(self.second(item, result))
+				self.record(1, time.monotonic() - started, 0, 0)
+
+			return results
+
+		handover = queue.Queue(maxsize=self.depth)
+		stopped = threading.Event()
+
+		def put(entry):
+			# Give up if the second stage stopped
+			while not stopped.is_set():
+				try:
+					handover.put(entry, timeout=0.5)
+					return True
+				except queue.Full:
+					continue
+
+			return False
+
+		def produce():
+			for item in items:
+				if stopped.is_set():
+					return
+
+				started = time.monotonic()
+				try:
+					entry = (item, self.first(item), None)
+				except Exception as e:
+					entry = (item, None, e)
+				busy = time.monotonic() - started
+
+				started = time.monotonic()
+				if not put(entry):
+					return
+				self.record(0, busy, time.monotonic() - started, handover.qsize())
+
+			put(_DONE)
+
+		thread = threading.Thread(target=produce, daemon=True)
+		thread.start()
+
+		results = []
+		try:
+			while True:
+				started = time.monotonic()
+				entry = handover.get()
+				stalled = time.monotonic() - started
+
+				if entry is _DONE:
+					break
+
+				item, result, error = entry
+				if error is not None:
+					raise error
+
+				started = time.monotonic()
+				results.append(self.second(item, result))
+				self.record(1, time.monotonic() - started, stalled, handover.qsize())
+		finally:
+			stopped.set()
+			thread.join()
+
+		return results
+
+	def report(self):
+		"""
+		Prints the time every stage has been busy and stalled for, and
+		the maximum depth of the queue.
+		"""
+
+		for name in self.names:
+			stats = self.stats[name]
+			print(
+				"Pipeline: %s stage processed %d item(s), busy %.2fs, stalled %.2fs" % (
+					name,
+					stats["items"],
+					stats["busy"],
+					stats["stalled"]
+				)
+			)
+
+		print("Pipeline: maximum queue depth %d of %d" % (self.max_depth, self.depth))
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Local index of the content already available in aptly's pool
+"""
+
+import os
+
+import sqlite3
+
+POOL_INDEX = "/var/lib/aptly-intake/pool-index.db"
+
+# Extensions of the files aptly can add on their own, without the
+# .changes file
+BINARY_EXTENSIONS = (".deb", ".udeb")
+SOURCE_EXTENSIONS = (".dsc",)
+
+def get_pool_index_path(shard=None):
+	"""
+	Returns the path of the index of the given aptly instance.
+
+	:param: shard: the name of the aptly instance, if it's not the
+	default one
+	"""
+
+	if shard is None:
+		return POOL_INDEX
+
+	base, extension = os.path.splitext(POOL_INDEX)
+
+	return "%s-%s%s" % (base, shard, extension)
+
+class PoolIndex:
+	"""
+	Maps the sha256 checksum of every .deb and .dsc imported by
+	aptly-intake to the key of the resulting aptly package.
+
+	The index is only a hint: entries might refer to packages that
+	have been removed in the meantime, so they should be checked
+	against aptly before being relied upon (see `lookup()`).
+	"""
+
+	def __init__(self, path=POOL_INDEX):
+		"""
+		Initialises the class.
+
+		:param: path: the path of the index database
+		"""
+
+		self.path = path
+		self.connection = None
+
+	def __enter__(self):
+		os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+		self.connection = sqlite3.connect(self.path, timeout=60)
+		self.connection.execute(
+			"CREATE TABLE IF NOT EXISTS pool ("
+			"sha256 TEXT PRIMARY KEY, "
+			"key TEXT NOT NULL, "
+			"size INTEGER"
+			")"
+		)
+
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.connection.commit()
+		self.connection.close()
+		self.connection = None
+
+	def get(self, sha256):
+		"""
+		Returns the package key of the given checksum, or None.
+
+		:param: sha256: the checksum to look for
+		"""
+
+		row = self.connection.execute(
+			"SELECT key FROM pool WHERE sha256 = ?",
+			(sha256,)
+		).fetchone()
+
+		return row[0] if row else None
+
+	def add(self, sha256, key, size=None):
+		"""
+		Adds (or replaces) an entry in the index.
+
+		:param: sha256: the checksum of the file
+		:param: key: the aptly package key
+		:param: size: the size of the file
+		"""
+
+		self.connection.execute(
+			"INSERT OR REPLACE INTO pool (sha256, key, size) VALUES (?, ?, ?)",
+			(sha256, key, size)
+		)
+
+	def discard(self, sha256):
+		"""
+		Removes an entry from the index.
+
+		:param: sha256: the checksum to remove
+		"""
+
+		self.connection.execute(
+			"DELETE FROM pool WHERE sha256 = ?",
+			(sha256,)
+		)
+
+	def lookup(self, session, sha256):
+		"""
+		Returns the package key of the given checksum, but only if the
+		package is still known to aptly. Stale entries are removed.
+
+		:param: session: an AptlySession() instance
+		:param: sha256: the checksum to look for
+		"""
+
+		key = self.get(sha256)
+
+		if key is None:
+			return None
+
+		try:
+			details = session.Packages(key=key).show()
+		except Exception:
+			details = {}
+
+		if sha256 not in get_checksums(details):
+			self.discard(sha256)
+			return None
+
+		return key
+
+	def update(self, packages):
+		"""
+		Indexes the given packages.
+
+		:param: packages: a list of package details, as returned by
+		aptly when searching with format=details
+		"""
+
+		for package in packages:
+			for sha256 in get_checksums(package, dsc_only=True):
+				self.add(sha256, package["Key"])
+
+def get_checksums(package, dsc_only=False):
+	"""
+	Returns the sha256 checksums of the files of the given package.
+
+	:param: package: the package details, as returned by aptly
+	:param: dsc_only: if True, only the checksum of the .dsc file
+	is returned for source packages
+	"""
+
+	if "SHA256" in package:
+		# Binary package
+		return [package["SHA256"]]
+
+	checksums = []
+	for line in package.get("Checksums-Sha256", "").splitlines():
+		fields = line.split()
+		if len(fields) != 3:
+			continue
+
+		sha256, size, name = fields
+		if not dsc_only or name.endswith(SOURCE_EXTENSIONS):
+			checksums.append(sha256)
+
+	return checksums
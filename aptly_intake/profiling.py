@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Optional profiling of the aptly-intake entry points
+"""
+
+import os
+
+import sys
+
+import uuid
+
+import threading
+
+from contextlib import contextmanager
+
+PROFILES_DIRECTORY = "/var/lib/aptly-intake/profiles"
+
+# Environment variable enabling profiling, see get_profile_modes()
+PROFILE_ENVIRONMENT = "APTLY_INTAKE_PROFILE"
+
+PROFILE_MODES = ["cpu", "memory"]
+
+# Number of profiled runs kept for every entry point
+PROFILE_KEEP = 20
+
+# Number of allocation sites listed in the memory report
+PROFILE_TOP_ALLOCATIONS = 30
+
+def get_profile_modes(value=None):
+	"""
+	Returns the set of the enabled profiling modes.
+
+	:param: value: a comma-separated list of modes ("cpu", "memory"), or
+	"all". If None, PROFILE_ENVIRONMENT is used
+	"""
+
+	if value is None:
+		value = os.environ.get(PROFILE_ENVIRONMENT, "")
+
+	modes = {x.strip() for x in value.split(",") if x.strip()}
+
+	if "all" in modes:
+		return set(PROFILE_MODES)
+
+	unknown = modes - set(PROFILE_MODES)
+	if unknown:
+		raise Exception("Unknown profiling mode(s): %s" % ", ".join(sorted(unknown)))
+
+	return modes
+
+def prune_profiles(name, directory=PROFILES_DIRECTORY, keep=PROFILE_KEEP):
+	"""
+	Removes the files of every profiled run of the given entry point
+	but the newest ones.
+
+	:param: name: the name of the entry point
+	:param: directory: the directory where profiles are stored
+	:param: keep: the number of runs to keep
+	"""
+
+	runs = {}
+	for entry in os.scandir(directory):
+		if entry.name.startswith("%s-" % name):
+			run = entry.name.split(".", 1)[0]
+			runs.setdefault(run, []).append(entry)
+
+	stale = sorted(
+		runs.values(),
+		key=lambda x: max(y.stat().st_mtime for y in x),
+		reverse=True
+	)[keep:]
+
+	for entries in stale:
+		for entry in entries:
+			try:
+				os.remove(entry.path)
+			except OSError:
+				pass
+
+def write_allocations(path, snapshot, peak, top=PROFILE_TOP_ALLOCATIONS):
+	"""
+	Writes a report of the allocation sites using the most memory.
+
+	:param: path: the path of the report
+	:param: snapshot: a tracemalloc snapshot
+	:param: peak: the peak traced memory, in bytes
+	:param: top: the number of allocation sites to list
+	"""
+
+	statistics = snapshot.statistics("lineno")
+
+	with open(path, "w") as f:
+		f.write(
+			"Peak traced memory: %d bytes\n"
+			"Traced memory at exit: %d bytes in %d blocks\n\n" % (
+				peak,
+				sum(x.size for x in statistics),
+				sum(x.count for x in statistics)
+			)
+		)
+
+		for statistic in statistics[:top]:
+			f.write("%s\n" % statistic)
+
+@contextmanager
+def profiled(name, run_uuid=None, modes=None, directory=PROFILES_DIRECTORY, keep=PROFILE_KEEP):
+	"""
+	Profiles the code run in this context, if enabled.
+
+	Writes <name>-<run_uuid>.prof (cProfile, "cpu" mode) and
+	<name>-<run_uuid>.allocations.txt (tracemalloc, "memory" mode) in
+	the given directory. When nothing is enabled, nothing is imported
+	nor hooked.
+
+	:param: name: the name of the entry point
+	:param: run_uuid: the uuid of the run, or None to generate one
+	:param: modes: a comma-separated list of modes (see
+	get_profile_modes()), or None to use PROFILE_ENVIRONMENT
+	:param: directory: the directory where profiles are stored
+	:param: keep: the number of runs to keep (see prune_profiles())
+	"""
+
+	modes = get_profile_modes(modes)
+
+	if not modes:
+		yield
+		return
+
+	base = os.path.join(directory, "%s-%s" % (name, run_uuid or uuid.uuid4()))
+	os.makedirs(directory, exist_ok=True)
+
+	profiles = []
+	if "cpu" in modes:
+		import cProfile
+
+		if sys.version_info < (3, 12):
+			# Profilers are per-thread, so start one in every new
+			# thread as well (e.g. the ones processing every aptly
+			# instance)
+			def start_thread_profile(*args):
+				profile = cProfile.Profile()
+				profiles.append(profile)
+				profile.enable()
+
+			threading.setprofile(start_thread_profile)
+
+		profile = cProfile.Profile()
+		profiles.append(profile)
+		profile.enable()
+
+	if "memory" in modes:
+		import tracemalloc
+
+		tracemalloc.start()
+
+	try:
+		yield
+	finally:
+		if "memory" in modes:
+			snapshot = tracemalloc.take_snapshot()
+			current, peak = tracemalloc.get_traced_memory()
+			tracemalloc.stop()
+
+			write_allocations("%s.allocations.txt" % base, snapshot, peak)
+			print("Memory profile written to %s.allocations.txt" % base)
+
+		if "cpu" in modes:
+			import pstats
+
+			profile.disable()
+			threading.setprofile(None)
+
+			stats = pstats.Stats(profile)
+			for thread_profile in profiles[1:]:
+				stats.add(thread_profile)
+
+			stats.dump_stats("%s.prof" % base)
+			print("CPU profile written to %s.prof" % base)
+
+		prune_profiles(name, directory, keep)
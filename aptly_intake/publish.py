@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Snapshotting and publishing of channels
+"""
+
+from functools import partial
+
+from .parallel import run_parallel
+
+# FIXME?
+DEFAULT_ARCHITECTURES = [
+	"source",
+	"amd64",
+	"i386",
+	"arm64",
+	"armhf",
+]
+
+def get_repository(session, repos, channel, distribution, component):
+	"""
+	Returns the name of the local repository of the given channel,
+	distribution and component, creating it if it doesn't exist.
+
+	:param: session: an AptlySession() instance
+	:param: repos: a dictionary of the channel's local repositories and
+	their component. Newly created repositories are added to it.
+	:param: channel: the channel
+	:param: distribution: the distribution
+	:param: component: the component
+	"""
+
+	# Construct target repository name, which boils down to
+	#  channel_distribution_component
+	target_repository_name = "%s_%s_%s" % (
+		channel,
+		distribution,
+		component
+	)
+
+	if not target_repository_name in repos:
+		# Create a new repository
+		session.LocalRepo.create(
+			target_repository_name,
+			comment="Local repository for %s/%s" % (
+				distribution,
+				component
+			),
+			default_distribution=distribution,
+			default_component=component
+		)
+		repos[target_repository_name] = component
+
+	return target_repository_name
+
+def get_published_sources(published, channel, distribution):
+	"""
+	Returns a dictionary of the components of the given published
+	distribution and their snapshots, or None if it's not published
+	from snapshots.
+
+	:param: published: the published repositories, as returned by
+	PublishedRepo.list()
+	:param: channel: the channel (the publishing prefix)
+	:param: distribution: the distribution
+	"""
+
+	for published_repo in published:
+		if published_repo["Prefix"] == channel \
+			and published_repo["Distribution"] == distribution \
+			and published_repo["SourceKind"] == "snapshot":
+			return {
+				x["Component"] : x["Name"]
+				for x in published_repo["Sources"]
+			}
+
+	return None
+
+def snapshot_repositories(session, repos, suffix, workers=1):
+	"""
+	Snapshots the given repositories, and returns the list of
+	the created snapshots, ready to be published.
+
+	:param: session: an AptlySession() instance
+	:param: repos: a dictionary of local repositories and their
+	component
+	:param: suffix: the suffix of the snapshot names
+	:param: workers: the number of repositories to snapshot at the
+	same time
+	"""
+
+	created_snapshots = []
+	for repo, component in repos.items():
+		created_snapshots.append(
+			{
+				"Component" : component,
+				"Name" : "%s_%s" % (repo, suffix)
+			}
+		)
+
+	for repo in repos:
+		print("Creating snapshot for repo %s" % repo)
+
+	run_parallel(
+		{
+			repo : partial(session.LocalRepo(name=repo).snapshot, snapshot["Name"])
+			for repo, snapshot in zip(repos, created_snapshots)
+		},
+		workers=workers
+	)
+
+	return created_snapshots
+
+def publish_snapshots(session, channel, distribution, snapshots, signing, label, origin, architectures):
+	"""
+	Publishes the given snapshots, either by switching the already
+	published distribution or by publishing a new one.
+
+	Returns the previously published snapshots, as returned by
+	get_published_sources().
+
+	:param: session: an AptlySession() instance
+	:param: channel: the channel (used as the publishing prefix)
+	:param: distribution: the distribution
+	:param: snapshots: a list of { "Component", "Name" } dictionaries
+	:param: signing: an AptlyAPISigningOptions() instance
+	:param: label: the label of newly published distributions
+	:param: origin: the origin of newly published distributions
+	:param: architectures: the architectures of newly published
+	distributions
+	"""
+
+	# Obtain the list of published repositories
+	published = session.PublishedRepo.list()
+	channel_published = (channel, distribution) in [
+		(x["Prefix"], x["Distribution"])
+		for x in published
+	]
+
+	for publish_try in range(0, 2):
+		# We should try two times due to how aptly behaves when
+		# switching snapshots on an already published repository
+		# when a new component has been added.
+
+		if channel_published:
+			# Switch
+			target_published_distribution = session.PublishedDistribution(
+				prefix=channel,
+				distribution=distribution,
+			)
+
+			try:
+				target_published_distribution.update(
+					snapshots=snapshots,
+					signing=signing,
+					force_overwrite=True,
+				)
+			except Exception as e:
+				if "not in published repository" in str(e):
+					# Trying to publish an unpublished component,
+					# drop the published repo and try again from
+					# scratch
+					target_published_distribution.delete()
+					channel_published = False
+					continue
+		else:
+			# Create new published repository
+			session.PublishedRepo(prefix=channel).publish(
+				"snapshot",
+				snapshots,
+				distribution=distribution,
+				label=label,
+				origin=origin,
+				architectures=architectures,
+				signing=signing,
+				force_overwrite=True,
+			)
+
+		break
+
+	return get_published_sources(published, channel, distribution)
@@ -0,0 +1,524 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Retention policies, backed by a persisted index of package versions
+"""
+
+import os
+
+import time
+
+import bisect
+
+import fnmatch
+
+import sqlite3
+
+from functools import cmp_to_key
+
+VERSION_INDEX = "/var/lib/aptly-intake/version-index.db"
+
+# Default number of versions to keep, by repository
+RETENTION_KEEP = [
+	("production_trixie_main", 3),
+	("staging_trixie_main", 3),
+	("production_sid_main", 3),
+	("staging_sid_main", 3),
+]
+
+_version_key = None
+
+def get_version_key():
+	"""
+	Returns a sort key ordering Debian versions from the newest to
+	the oldest.
+	"""
+
+	global _version_key
+
+	if _version_key is None:
+		# Imported here, as it's only needed when there's something to
+		# sort
+		import apt_pkg
+		apt_pkg.init_system()
+
+		_version_key = cmp_to_key(lambda x, y: apt_pkg.version_compare(y, x))
+
+	return _version_key
+
+def get_name_filter(names):
+	"""
+	Returns an SQL condition (and its parameters) matching the given
+	package names, or matching everything if names is None.
+
+	:param: names: a set of package names, or None
+	"""
+
+	if names is None:
+		return "", []
+
+	names = sorted(names)
+
+	return " AND name IN (%s)" % ",".join("?" * len(names)), names
+
+def get_version_index_path(shard=None):
+	"""
+	Returns the path of the version index of the given aptly instance.
+
+	:param: shard: the name of the aptly instance, if it's not the
+	default one
+	"""
+
+	if shard is None:
+		return VERSION_INDEX
+
+	base, extension = os.path.splitext(VERSION_INDEX)
+
+	return "%s-%s%s" % (base, shard, extension)
+
+class VersionIndex:
+	"""
+	Keeps the package refs of every repository, ranked by version
+	(0 being the newest) for every architecture and package name, and
+	the package refs of the published snapshots.
+
+	The index is updated incrementally: only the versions of the
+	packages that changed since the last update get compared, so that
+	retention can be planned with a query.
+	"""
+
+	def __init__(self, path=VERSION_INDEX):
+		"""
+		Initialises the class.
+
+		:param: path: the path of the index database
+		"""
+
+		self.path = path
+		self.connection = None
+
+	def __enter__(self):
+		os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+		self.connection = sqlite3.connect(self.path, timeout=60)
+		self.connection.execute(
+			"CREATE TABLE IF NOT EXISTS packages ("
+			"repo TEXT NOT NULL, "
+			"ref TEXT NOT NULL, "
+			"arch TEXT NOT NULL, "
+			"name TEXT NOT NULL, "
+			"version TEXT NOT NULL, "
+			"rank INTEGER, "
+			"first_seen REAL NOT NULL, "
+			"PRIMARY KEY (repo, ref)"
+			")"
+		)
+		self.connection.execute(
+			"CREATE INDEX IF NOT EXISTS packages_name ON packages (repo, arch, name)"
+		)
+		self.connection.execute(
+			"CREATE INDEX IF NOT EXISTS packages_rank ON packages (repo, rank)"
+		)
+		self.connection.execute(
+			"CREATE TABLE IF NOT EXISTS snapshots ("
+			"snapshot TEXT NOT NULL, "
+			"ref TEXT NOT NULL, "
+			"PRIMARY KEY (snapshot, ref)"
+			")"
+		)
+
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.connection.commit()
+
+		self.connection.close()
+		self.connection = None
+
+	def has_repo(self, repo):
+		"""
+		Returns True if the given repository has been indexed.
+
+		:param: repo: the name of the repository
+		"""
+
+		return self.connection.execute(
+			"SELECT 1 FROM packages WHERE repo = ? LIMIT 1",
+			(repo,)
+		).fetchone() is not None
+
+	def get_refs(self, repo, names=None):
+		"""
+		Returns the set of the package refs of the given repository.
+
+		:param: repo: the name of the repository
+		:param: names: if not None, only the packages with these names
+		are returned
+		"""
+
+		condition, parameters = get_name_filter(names)
+
+		return {
+			x
+			for x, in self.connection.execute(
+				"SELECT ref FROM packages WHERE repo = ?" + condition,
+				[repo] + parameters
+			)
+		}
+
+	def rank(self, repo, arch, name):
+		"""
+		Ranks the versions of the given package. Versions already ranked
+		keep their order, new ones are inserted in it.
+
+		:param: repo: the name of the repository
+		:param: arch: the architecture
+		:param: name: the name of the package
+		"""
+
+		version_key = get_version_key()
+
+		# (key, ref) tuples, as bisect only takes a key function since
+		# Python 3.10
+		ranked = []
+		new = []
+		for ref, version, rank in self.connection.execute(
+			"SELECT ref, version, rank FROM packages "
+			"WHERE repo = ? AND arch = ? AND name = ? "
+			"ORDER BY rank",
+			(repo, arch, name)
+		):
+			(new if rank is None else ranked).append((version_key(version), ref))
+
+		for package in new:
+			bisect.insort(ranked, package)
+
+		self.connection.executemany(
+			"UPDATE packages SET rank = ? WHERE repo = ? AND ref = ?",
+			((rank, repo, ref) for rank, (key, ref) in enumerate(ranked))
+		)
+
+	def update(self, repo, refs, now=None, names=None):
+		"""
+		Updates the given repository with its current package refs, and
+		returns the number of refs added and removed.
+
+		Packages are considered added when they're first found. The
+		packages found when a repository is indexed for the first time
+		are considered as old as they can be.
+
+		:param: repo: the name of the repository
+		:param: refs: every package ref in the repository, or every ref
+		of the packages with the given names
+		:param: now: the current timestamp, or None
+		:param: names: if not None, only the packages with these names
+		are updated
+		"""
+
+		current = self.get_refs(repo, names)
+		refs = set(refs)
+
+		added = refs - current
+		removed = current - refs
+		first_seen = (now or time.time()) if self.has_repo(repo) else 0
+
+		self.connection.executemany(
+			"DELETE FROM packages WHERE repo = ? AND ref = ?",
+			((repo, x) for x in removed)
+		)
+
+		touched = set()
+		for ref in added:
+			arch, name, version, _ = ref.split(" ")
+			touched.add((arch, name))
+
+			self.connection.execute(
+				"INSERT INTO packages (repo, ref, arch, name, version, rank, first_seen) "
+				"VALUES (?, ?, ?, ?, ?, NULL, ?)",
+				(repo, ref, arch, name, version, first_seen)
+			)
+
+		for ref in removed:
+			arch, name, version, _ = ref.split(" ")
+			touched.add((arch, name))
+
+		for arch, name in touched:
+			self.rank(repo, arch, name)
+
+		return len(added), len(removed)
+
+	def remove(self, repo, refs):
+		"""
+		Removes the given package refs from the given repository.
+
+		:param: repo: the name of the repository
+		:param: refs: the package refs to remove
+		"""
+
+		self.update(repo, self.get_refs(repo) - set(refs))
+
+	def prune(self, repos):
+		"""
+		Forgets every repository but the given ones.
+
+		:param: repos: the names of the repositories to keep
+		"""
+
+		repos = list(repos)
+
+		self.connection.execute(
+			"DELETE FROM packages WHERE repo NOT IN (%s)" % ",".join("?" * len(repos)),
+			repos
+		)
+
+	def get_older(self, repo, keep, names=None):
+		"""
+		Returns the (ref, first_seen) tuples of the packages of the
+		given repository that are not among the `keep` newest versions
+		of their package.
+
+		:param: repo: the name of the repository
+		:param: keep: the number of versions to keep
+		:param: names: if not None, only the packages with these names
+		are returned
+		"""
+
+		condition, parameters = get_name_filter(names)
+
+		return self.connection.execute(
+			"SELECT ref, first_seen FROM packages WHERE repo = ? AND rank >= ?" + condition,
+			[repo, keep] + parameters
+		).fetchall()
+
+	def has_snapshot(self, snapshot):
+		"""
+		Returns True if the package refs of the given snapshot are known.
+
+		:param: snapshot: the name of the snapshot
+		"""
+
+		return self.connection.execute(
+			"SELECT 1 FROM snapshots WHERE snapshot = ? LIMIT 1",
+			(snapshot,)
+		).fetchone() is not None
+
+	def set_snapshot(self, snapshot, refs):
+		"""
+		Stores the package refs of the given snapshot. Snapshots never
+		change, so this is needed only once.
+
+		:param: snapshot: the name of the snapshot
+		:param: refs: every package ref in the snapshot
+		"""
+
+		self.connection.execute("DELETE FROM snapshots WHERE snapshot = ?", (snapshot,))
+		self.connection.executemany(
+			"INSERT OR IGNORE INTO snapshots (snapshot, ref) VALUES (?, ?)",
+			((snapshot, x) for x in refs)
+		)
+
+	def get_snapshot_refs(self, snapshots):
+		"""
+		Returns the set of the package refs of the given snapshots
+		(which must be known), and forgets every other snapshot.
+
+		:param: snapshots: the names of the snapshots
+		"""
+
+		snapshots = list(snapshots)
+		placeholders = ",".join("?" * len(snapshots))
+
+		self.connection.execute(
+			"DELETE FROM snapshots WHERE snapshot NOT IN (%s)" % placeholders,
+			snapshots
+		)
+
+		return {
+			x
+			for x, in self.connection.execute(
+				"SELECT DISTINCT ref FROM snapshots WHERE snapshot IN (%s)" % placeholders,
+				snapshots
+			)
+		}
+
+class RetentionPolicy:
+	"""
+	Decides which packages to remove from a repository.
+
+	The newest versions of every package are kept (how many depends on
+	the repository), as well as the ones added recently and, optionally,
+	the packages referenced by a pinned snapshot (see
+	get_pinned_snapshots()).
+	"""
+
+	def __init__(self, keep=RETENTION_KEEP, default_keep=1, keep_published=False, min_age=0):
+		"""
+		Initialises the class.
+
+		:param: keep: a list of (pattern, number) tuples, the number of
+		versions to keep in the repositories matching the pattern.
+		Patterns are shell-style wildcards, the first matching one wins
+		:param: default_keep: the number of versions to keep in every
+		other repository
+		:param: keep_published: if True, packages referenced by a
+		pinned snapshot are kept
+		:param: min_age: packages added less than this many seconds ago
+		are kept
+		"""
+
+		self.keep = keep
+		self.default_keep = default_keep
+		self.keep_published = keep_published
+		self.min_age = min_age
+
+	@classmethod
+	def from_config(cls, config):
+		"""
+		Returns a RetentionPolicy() configured in the intake settings:
+		APTLY_RETENTION_KEEP (pattern:number, separated by spaces),
+		APTLY_RETENTION_DEFAULT_KEEP, APTLY_RETENTION_KEEP_PUBLISHED and
+		APTLY_RETENTION_MIN_AGE (in days).
+
+		:param: config: a ConfigParser() instance
+		"""
+
+		return cls(
+			keep=[
+				(pattern, int(keep))
+				for pattern, keep in (
+					x.rsplit(":", 1)
+					for x in config.get(
+						"Intake",
+						"APTLY_RETENTION_KEEP",
+						fallback=" ".join("%s:%d" % x for x in RETENTION_KEEP)
+					).split()
+				)
+			],
+			default_keep=config.getint("Intake", "APTLY_RETENTION_DEFAULT_KEEP", fallback=1),
+			keep_published=config.getboolean("Intake", "APTLY_RETENTION_KEEP_PUBLISHED", fallback=False),
+			min_age=config.getfloat("Intake", "APTLY_RETENTION_MIN_AGE", fallback=0) * 24 * 60 * 60
+		)
+
+	def get_keep(self, repo):
+		"""
+		Returns the number of versions to keep in the given repository.
+
+		:param: repo: the name of the repository
+		"""
+
+		for pattern, keep in self.keep:
+			if fnmatch.fnmatchcase(repo, pattern):
+				return keep
+
+		return self.default_keep
+
+	def plan(self, index, repo, published=set(), now=None, names=None):
+		"""
+		Returns the list of the package refs to remove from the given
+		repository.
+
+		:param: index: an up to date VersionIndex() instance
+		:param: repo: the name of the repository
+		:param: published: the set of the package refs referenced by a
+		pinned snapshot
+		:param: now: the current timestamp, or None
+		:param: names: if not None, only the packages with these names
+		are considered
+		"""
+
+		now = now or time.time()
+
+		return sorted(
+			ref
+			for ref, first_seen in index.get_older(repo, self.get_keep(repo), names)
+			if not (self.keep_published and ref in published)
+			and not (now - first_seen < self.min_age)
+		)
+
+def get_pinned_snapshots(publications):
+	"""
+	Returns the set of the names of the pinned snapshots: the published
+	snapshots that are not the current publication of their repository
+	(e.g. a snapshot published by hand under another prefix).
+
+	Every import publishes a new snapshot of the repositories of its
+	distribution, so the current publication of a repository never
+	holds anything worth keeping that the repository itself doesn't.
+
+	:param: publications: the published repositories, as returned by
+	PublishedRepo.list()
+	"""
+
+	pinned = set()
+	for published_repo in publications:
+		if published_repo["SourceKind"] != "snapshot":
+			continue
+
+		for source in published_repo["Sources"]:
+			repo = "%s_%s_%s" % (
+				published_repo["Prefix"],
+				published_repo["Distribution"],
+				source["Component"]
+			)
+
+			if not source["Name"].startswith("%s_" % repo):
+				pinned.add(source["Name"])
+
+	return pinned
+
+def get_published_refs(session, index, names=None):
+	"""
+	Returns the set of the package refs referenced by a pinned snapshot
+	of the given aptly instance.
+
+	Snapshots never change, so they're fetched only once and kept in
+	the index: pinned snapshots rarely change, and looking them up
+	costs no request to aptly afterwards, even when importing.
+
+	:param: session: the AptlySession() of the aptly instance
+	:param: index: the VersionIndex() of the aptly instance
+	:param: names: if not None, only the packages with these names are
+	returned
+	"""
+
+	if session.mirror is not None and session.mirror.resynced is not None:
+		pinned = get_pinned_snapshots(session.mirror.list_publications())
+	else:
+		pinned = get_pinned_snapshots(session.PublishedRepo.list())
+
+	for snapshot in pinned:
+		if not index.has_snapshot(snapshot):
+			index.set_snapshot(snapshot, session.Snapshot(name=snapshot).search())
+
+	return {
+		x
+		for x in index.get_snapshot_refs(pinned)
+		if names is None or x.split(" ")[1] in names
+	}
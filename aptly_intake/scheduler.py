@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Priority-aware, multi-worker intake queue
+"""
+
+import os
+
+import json
+
+import time
+
+import fnmatch
+
+import threading
+
+import subprocess
+
+STATUS_FILE = "/run/aptly-intake/queue-status.json"
+
+# Priority classes, highest first. Every class is a list of
+# channel/distribution patterns; imports not matching any class
+# end up in the "default" one.
+DEFAULT_PRIORITIES = [
+	("hotfixes", ["*/hotfixes"]),
+	("production", ["production/*"]),
+]
+
+# Seconds to wait before retrying a failed publish of the deferred
+# distributions
+PUBLISH_RETRY_INTERVAL = 60
+
+class IntakeJob:
+	"""
+	A queued import.
+	"""
+
+	def __init__(self, path, channel, distribution, priority, sequence):
+		"""
+		Initialises the class.
+
+		:param: path: the path of the .changes file
+		:param: channel: the target channel
+		:param: distribution: the target distribution
+		:param: priority: the index of the priority class
+		:param: sequence: the arrival order of the job
+		"""
+
+		self.path = path
+		self.channel = channel
+		self.distribution = distribution
+		self.priority = priority
+		self.sequence = sequence
+		self.queued = time.monotonic()
+
+	@property
+	def target(self):
+		return (self.channel, self.distribution)
+
+class IntakeScheduler:
+	"""
+	Runs imports in parallel, highest priority class first.
+
+	At most `workers` imports run at the same time, and at most
+	`max_per_distribution` of them target the same channel and
+	distribution (so that, by default, imports for the same
+	distribution keep their arrival order).
+
+	If a PublishDebouncer() is given, publish_command is run whenever
+	a deferred publish is due, so that the last change of every
+	distribution is published even if no other import follows it.
+	"""
+
+	def __init__(self, command, workers=4, max_per_distribution=1, priorities=DEFAULT_PRIORITIES, status_file=STATUS_FILE, debouncer=None, publish_command=None):
+		"""
+		Initialises the class.
+
+		:param: command: the command to run for every job, as a list.
+		The path of the .changes file gets appended to it.
+		:param: workers: the maximum number of concurrent imports
+		:param: max_per_distribution: the maximum number of concurrent
+		imports for the same channel and distribution
+		:param: priorities: the priority classes, highest first, as a
+		list of (name, [patterns]) tuples
+		:param: status_file: the file where the queue status is written,
+		or None
+		:param: debouncer: a PublishDebouncer() instance, or None
+		:param: publish_command: the command publishing the deferred
+		distributions, as a list
+		"""
+
+		self.command = command
+		self.workers = workers
+		self.max_per_distribution = max_per_distribution
+		self.priorities = priorities
+		self.status_file = status_file
+		self.debouncer = debouncer
+		self.publish_command = publish_command
+
+		self.publishing = False
+		self.publish_failed = False
+		self.publish_retry = 0.0
+
+		self.class_names = [x for x, y in priorities] + ["default"]
+
+		self.condition = threading.Condition()
+		self.queue = []
+		self.running = {}
+		self.closed = False
+		self.sequence = 0
+
+		self.stats = {
+			x : {
+				"dispatched" : 0,
+				"failed" : 0,
+				"total_wait" : 0.0,
+				"max_wait" : 0.0,
+			}
+			for x in self.class_names
+		}
+
+	def get_priority(self, channel, distribution):
+		"""
+		Returns the index of the priority class of the given channel
+		and distribution.
+
+		:param: channel: the channel
+		:param: distribution: the distribution
+		"""
+
+		target = "%s/%s" % (channel, distribution)
+
+		for index, (name, patterns) in enumerate(self.priorities):
+			if any(fnmatch.fnmatchcase(target, x) for x in patterns):
+				return index
+
+		return len(self.priorities)
+
+	def submit(self, path):
+		"""
+		Queues the given .changes file.
+
+		:param: path: the path of the .changes file
+		"""
+
+		# Imported here, as it's slow to load and not needed when there's
+		# nothing to import
+		from debian.deb822 import Changes
+
+		path = os.path.abspath(path)
+
+		try:
+			with open(path, "r") as f:
+				distributions = Changes(f).get("Distribution", "").split() or [""]
+		except Exception as e:
+			print("Unable to read %s, skipping: %s" % (path, e))
+			return
+
+		# We assume the channel is the directory name
+		channel = os.path.basename(os.path.dirname(path))
+
+		# Uploads fanned out to other distributions get the highest
+		# priority among them
+		distribution = distributions[0]
+		priority = min(self.get_priority(channel, x) for x in distributions)
+
+		with self.condition:
+			if any(x.path == path for x in self.queue):
+				# Already queued
+				return
+
+			job = IntakeJob(
+				path,
+				channel,
+				distribution,
+				priority,
+				self.sequence
+			)
+			self.sequence += 1
+			self.queue.append(job)
+
+			print(
+				"Queued %s (%s/%s, class %s)" % (
+					path,
+					channel,
+					distribution,
+					self.class_names[job.priority]
+				)
+			)
+
+			self.write_status()
+			self.condition.notify_all()
+
+	def close(self):
+		"""
+		Tells the scheduler that no more jobs will be submitted. run()
+		returns once the queue has been drained.
+		"""
+
+		with self.condition:
+			self.closed = True
+			self.condition.notify_all()
+
+	def next_job(self):
+		"""
+		Returns the next job that can be started, or None.
+
+		Must be called with the condition held.
+		"""
+
+		if len(self.running) >= self.workers:
+			return None
+
+		for job in sorted(self.queue, key=lambda x: (x.priority, x.sequence)):
+			if job.path in self.running:
+				# Queued again while being imported, it's started
+				# once the running import is done
+				continue
+
+			running_for_target = sum(
+				1
+				for x in self.running.values()
+				if x.target == job.target
+			)
+
+			if running_for_target < self.max_per_distribution:
+				return job
+
+		return None
+
+	def get_publish_timeout(self):
+		"""
+		Starts the publish of the deferred distributions if one of them
+		is due. Returns the number of seconds until the next one is due,
+		or None.
+
+		Must be called with the condition held.
+		"""
+
+		if self.debouncer is None or self.publishing:
+			return None
+
+		due = self.debouncer.get_next_due()
+		if due is None:
+			return None
+
+		due = max(due, self.publish_retry - time.monotonic())
+		if due > 0:
+			return due
+
+		self.publishing = True
+
+		threading.Thread(
+			target=self.publish,
+			daemon=True
+		).start()
+
+		return None
+
+	def publish(self):
+		"""
+		Publishes the deferred distributions.
+		"""
+
+		try:
+			returncode = subprocess.call(self.publish_command)
+		except Exception as e:
+			print("Unable to run publish of the deferred distributions: %s" % e)
+			returncode = -1
+
+		with self.condition:
+			self.publishing = False
+			self.publish_failed = returncode != 0
+
+			if self.publish_failed:
+				print("Unable to publish the deferred distributions")
+				self.publish_retry = time.monotonic() + PUBLISH_RETRY_INTERVAL
+
+			self.write_status()
+			self.condition.notify_all()
+
+	def run(self):
+		"""
+		Dispatches the queued jobs until the scheduler is closed and
+		the queue is empty (and every deferred publish is done).
+		"""
+
+		with self.condition:
+			while True:
+				job = self.next_job()
+
+				if job is None:
+					timeout = self.get_publish_timeout()
+
+					if self.closed and not self.queue and not self.running \
+						and not self.publishing \
+						and (timeout is None or self.publish_failed):
+						break
+
+					self.condition.wait(timeout)
+					continue
+
+				self.queue.remove(job)
+				self.running[job.path] = job
+
+				wait = time.monotonic() - job.queued
+				stats = self.stats[self.class_names[job.priority]]
+				stats["dispatched"] += 1
+				stats["total_wait"] += wait
+				stats["max_wait"] = max(stats["max_wait"], wait)
+
+				print(
+					"Starting import of %s (class %s, waited %.1fs)" % (
+						job.path,
+						self.class_names[job.priority],
+						wait
+					)
+				)
+
+				self.write_status()
+
+				threading.Thread(
+					target=self.work,
+					args=(job,),
+					daemon=True
+				).start()
+
+	def work(self, job):
+		"""
+		Runs the import of the given job.
+
+		:param: job: the job to run
+		"""
+
+		try:
+			returncode = subprocess.call(self.command + [job.path])
+		except Exception as e:
+			print("Unable to run import of %s: %s" % (job.path, e))
+			returncode = -1
+
+		with self.condition:
+			if returncode != 0:
+				print("Unable to import %s" % job.path)
+				self.stats[self.class_names[job.priority]]["failed"] += 1
+
+			del self.running[job.path]
+
+			self.write_status()
+			self.condition.notify_all()
+
+	def get_status(self):
+		"""
+		Returns the current status of the queue, per priority class.
+
+		Must be called with the condition held.
+		"""
+
+		now = time.monotonic()
+
+		status = {}
+		for index, name in enumerate(self.class_names):
+			queued = [x for x in self.queue if x.priority == index]
+			stats = self.stats[name]
+
+			status[name] = {
+				"depth" : len(queued),
+				"running" : sum(1 for x in self.running.values() if x.priority == index),
+				"oldest_wait" : max((now - x.queued for x in queued), default=0.0),
+				"average_wait" : (
+					stats["total_wait"] / stats["dispatched"]
+					if stats["dispatched"] else 0.0
+				),
+				"max_wait" : stats["max_wait"],
+				"dispatched" : stats["dispatched"],
+				"failed" : stats["failed"],
+			}
+
+		return status
+
+	def write_status(self):
+		"""
+		Atomically writes the queue status to the status file.
+
+		Must be called with the condition held.
+		"""
+
+		if self.status_file is None:
+			return
+
+		try:
+			tmp_path = "%s.tmp" % self.status_file
+			with open(tmp_path, "w") as f:
+				json.dump(
+					{
+						"updated" : time.time(),
+						"classes" : self.get_status(),
+						"publishes" : (
+							self.debouncer.get_status()
+							if self.debouncer is not None else {}
+						),
+					},
+					f,
+					indent=1
+				)
+
+			os.replace(tmp_path, self.status_file)
+		except OSError as e:
+			print("Unable to write queue status: %s" % e)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Local verification of OpenPGP signatures
+"""
+
+import os
+
+import shutil
+
+import tempfile
+
+import subprocess
+
+def can_verify_signature(keyring):
+	"""
+	Returns True if signatures can be verified locally against the
+	given keyring.
+
+	:param: keyring: the keyring to use
+	"""
+
+	return shutil.which("gpgv") is not None and os.path.exists(keyring)
+
+SIGNED_MESSAGE_HEADER = b"-----BEGIN PGP SIGNED MESSAGE-----"
+SIGNATURE_FOOTER = b"-----END PGP SIGNATURE-----"
+
+def check_signed_block(path, data):
+	"""
+	Raises an exception if the given contents aren't exactly one
+	cleartext signed message.
+
+	gpgv checks only the signed block, and happily accepts anything
+	around it: an unsigned paragraph before the signed one would be
+	what a parser sees first.
+
+	:param: path: the file the contents have been read from
+	:param: data: the contents to check
+	"""
+
+	lines = data.strip().splitlines()
+
+	if not lines or lines[0].rstrip() != SIGNED_MESSAGE_HEADER \
+		or lines[-1].rstrip() != SIGNATURE_FOOTER \
+		or len([x for x in lines if x.rstrip() == SIGNED_MESSAGE_HEADER]) != 1:
+		raise Exception(
+			"%s is not a single cleartext signed message" % path
+		)
+
+def verify_signature(path, keyring, data=None):
+	"""
+	Verifies the OpenPGP signature of the given file, raises an
+	exception if it's not valid.
+
+	gpgv is given a private copy of the contents, so that what has been
+	verified can't be changed afterwards. Returns the signed payload,
+	as output by gpgv: it's what should be parsed, rather than the
+	file itself.
+
+	:param: path: the file to verify
+	:param: keyring: the keyring holding the trusted keys
+	:param: data: the contents of the file, if they've already been
+	read
+	"""
+
+	if data is None:
+		with open(path, "rb") as f:
+			data = f.read()
+
+	check_signed_block(path, data)
+
+	with tempfile.NamedTemporaryFile(prefix="aptly-intake-", suffix=".changes") as f:
+		f.write(data)
+		f.flush()
+
+		result = subprocess.run(
+			["gpgv", "--keyring", keyring, "--output", "-", f.name],
+			stdout=subprocess.PIPE,
+			stderr=subprocess.PIPE,
+		)
+
+	if result.returncode != 0:
+		raise Exception(
+			"Unable to verify signature of %s: %s" % (
+				path,
+				result.stderr.decode("utf-8", errors="replace").strip()
+			)
+		)
+
+	return result.stdout
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Local staging of files into aptly's upload directory
+"""
+
+import os
+
+import errno
+
+import shutil
+
+def copy_file(source, destination):
+	"""
+	Copies source to destination, letting the kernel do the work with
+	copy_file_range() (which reflinks the file on filesystems that
+	support it). Falls back to a plain copy if that's not possible.
+
+	Returns the number of bytes copied.
+
+	:param: source: the file to copy
+	:param: destination: the destination path
+	"""
+
+	with open(source, "rb") as src, open(destination, "wb") as dst:
+		size = os.fstat(src.fileno()).st_size
+		copied = 0
+
+		try:
+			while copied < size:
+				count = os.copy_file_range(src.fileno(), dst.fileno(), size - copied)
+				if count == 0:
+					break
+
+				copied += count
+		except (AttributeError, OSError) as e:
+			if isinstance(e, OSError) and not e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+				raise
+
+			src.seek(copied)
+			dst.seek(copied)
+			shutil.copyfileobj(src, dst, 4 * 1024 * 1024)
+			copied = size
+
+	return copied
+
+def stage_file(source, destination, link=True):
+	"""
+	Makes source available as destination, hardlinking it if possible
+	or copying it otherwise (i.e. when they're on different filesystems).
+
+	Returns True if the file has been hardlinked, False if it has been
+	copied.
+
+	:param: source: the file to stage
+	:param: destination: the destination path
+	:param: link: if False, the file is always copied (e.g. when the
+	source can't be removed afterwards)
+	"""
+
+	if os.path.lexists(destination):
+		os.remove(destination)
+
+	if link:
+		try:
+			os.link(source, destination)
+			return True
+		except OSError as e:
+			if not e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+				raise
+
+	copy_file(source, destination)
+
+	return False
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Garbage collection of the upload directories left by failed imports
+"""
+
+import os
+
+import re
+
+import json
+
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .journal import ImportJournal, JOURNAL_DIRECTORY
+
+GC_STATE = "/var/lib/aptly-intake/upload-gc.json"
+
+# Upload directories created by aptly-intake: <uuid>-<component>, and
+# benchmark-<uuid>-<method> (see aptly-intake-import --benchmark-staging)
+UPLOAD_DIRECTORY_PATTERN = re.compile(
+	r"^(?:benchmark-)?(?P<uuid>[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})-.+$"
+)
+
+# Upload directories younger than this (in seconds) are never removed
+GC_MAX_AGE = 24 * 60 * 60
+
+GC_WORKERS = 4
+
+def get_directory_size(path):
+	"""
+	Returns the number of files in the given directory and their size,
+	or (None, None) if it can't be read.
+
+	:param: path: the path of the directory
+	"""
+
+	try:
+		entries = [x for x in os.scandir(path) if x.is_file(follow_symlinks=False)]
+	except OSError:
+		return None, None
+
+	return len(entries), sum(x.stat(follow_symlinks=False).st_size for x in entries)
+
+class UploadGarbageCollector:
+	"""
+	Finds and removes the upload directories of the runs that are not
+	in progress anymore.
+
+	An upload directory is stale when it has been created by
+	aptly-intake, no active journal refers to it and it's older than
+	max_age. Journals not updated for max_age are abandoned: the
+	journal of a failed run stays pending until its .changes file is
+	imported again, which might never happen.
+
+	The age is taken from the directory itself when aptly's upload
+	directory is available locally, otherwise from the first time it
+	has been found orphaned (stored in GC_STATE), so that directories
+	of remote aptly instances get the same grace period.
+	"""
+
+	def __init__(self, session, upload_directory=None, max_age=GC_MAX_AGE, workers=GC_WORKERS, journal_directory=JOURNAL_DIRECTORY, state_path=GC_STATE):
+		"""
+		Initialises the class.
+
+		:param: session: an AptlySession() instance
+		:param: upload_directory: aptly's upload directory, if it's
+		available locally, or None
+		:param: max_age: the minimum age, in seconds, of the directories
+		to remove
+		:param: workers: the number of directories removed at the same time
+		:param: journal_directory: the directory where journals are stored
+		:param: state_path: the path of the file storing when orphaned
+		directories of remote aptly instances have been found
+		"""
+
+		self.session = session
+		self.upload_directory = upload_directory
+		self.max_age = max_age
+		self.workers = workers
+		self.journal_directory = journal_directory
+		self.state_path = state_path
+		self.shard = session.shard or ""
+
+	def load_state(self):
+		"""
+		Returns the first time every orphaned directory of this aptly
+		instance has been found.
+		"""
+
+		try:
+			with open(self.state_path, "r") as f:
+				return json.load(f).get(self.shard, {})
+		except (OSError, ValueError):
+			return {}
+
+	def save_state(self, first_seen):
+		"""
+		Stores the first time every orphaned directory of this aptly
+		instance has been found.
+
+		:param: first_seen: a dictionary mapping directory names to
+		timestamps
+		"""
+
+		try:
+			with open(self.state_path, "r") as f:
+				state = json.load(f)
+		except (OSError, ValueError):
+			state = {}
+
+		state[self.shard] = first_seen
+
+		tmp_path = "%s.tmp" % self.state_path
+		with open(tmp_path, "w") as f:
+			json.dump(state, f, indent="\t")
+			f.flush()
+			os.fsync(f.fileno())
+
+		os.replace(tmp_path, self.state_path)
+
+	def get_age(self, directory, first_seen, now):
+		"""
+		Returns the age of the given upload directory, in seconds.
+
+		:param: directory: the name of the directory
+		:param: first_seen: a dictionary mapping directory names to the
+		first time they have been found orphaned
+		:param: now: the current timestamp
+		"""
+
+		if self.upload_directory is not None:
+			try:
+				return now - os.stat(os.path.join(self.upload_directory, directory)).st_mtime
+			except OSError:
+				pass
+
+		return now - first_seen.setdefault(directory, now)
+
+	def find_stale(self):
+		"""
+		Returns the names of the stale upload directories.
+		"""
+
+		# Directories are listed before the journals are read: runs
+		# create their journal before uploading anything, so every
+		# directory of a run in progress is protected by its journal
+		directories = self.session.Directory.list_directories()
+
+		now = time.time()
+
+		in_progress = set()
+		for journal in ImportJournal.pending(self.journal_directory):
+			if now - journal.state["updated"] >= self.max_age:
+				print("Journal %s has been abandoned, collecting its upload directories" % journal.path)
+				continue
+
+			in_progress.add(str(journal.run_uuid))
+			if journal.upload_prefix is not None:
+				in_progress.add(str(journal.upload_prefix))
+
+		first_seen = self.load_state()
+		stale = []
+		orphaned = set()
+
+		for directory in directories:
+			match = UPLOAD_DIRECTORY_PATTERN.match(directory)
+			if match is None or match.group("uuid") in in_progress:
+				continue
+
+			orphaned.add(directory)
+			if self.get_age(directory, first_seen, now) >= self.max_age:
+				stale.append(directory)
+
+		# Forget the directories that are gone
+		self.save_state({x : y for x, y in first_seen.items() if x in orphaned})
+
+		return stale
+
+	def remove(self, directory):
+		"""
+		Removes the given upload directory, and returns the number of
+		files and bytes reclaimed.
+
+		The number of bytes is only known when aptly's upload
+		directory is available locally, it's None otherwise.
+
+		:param: directory: the name of the directory
+		"""
+
+		size = None
+		if self.upload_directory is not None:
+			files, size = get_directory_size(os.path.join(self.upload_directory, directory))
+		else:
+			files = len(self.session.Directory(dir=directory).list())
+
+		self.session.Directory(dir=directory).delete()
+
+		return files or 0, size
+
+	def collect(self, dry_run=False):
+		"""
+		Removes every stale upload directory, at the same time, and
+		returns a (directories, files, bytes) tuple of what has been
+		reclaimed. bytes is None when unknown.
+
+		:param: dry_run: if True, only reports what would be removed
+		"""
+
+		stale = self.find_stale()
+
+		if dry_run:
+			for directory in stale:
+				print("Would remove upload directory %s" % directory)
+
+			return len(stale), 0, 0
+
+		removed = 0
+		files = 0
+		size = 0
+
+		with ThreadPoolExecutor(max_workers=self.workers) as executor:
+			futures = {
+				directory : executor.submit(self.remove, directory)
+				for directory in stale
+			}
+
+			for directory, future in futures.items():
+				try:
+					directory_files, directory_size = future.result()
+				except Exception as e:
+					print("Unable to remove upload directory %s: %s" % (directory, e))
+					continue
+
+				print("Removed upload directory %s" % directory)
+				removed += 1
+				files += directory_files
+				if directory_size is None:
+					size = None
+				elif size is not None:
+					size += directory_size
+
+		return removed, files, size
@@ -43,17 +43,14 @@ error() {
 
 [ ! -e "${QUEUE_DIRECTORY}" ] && error "Unable to find specified queue directory"
 
+# Imports are run by the scheduler, by priority and with several
+# workers (see aptly_intake_scheduler.py). On startup, it resumes
+# interrupted imports and imports, in bulk, the .changes files that
+# have been left in the queue directory.
 inotifywait \
 	--recursive \
 	--monitor \
 	--event moved_to \
 	--format "%w%f" \
 	"${QUEUE_DIRECTORY}/" \
-	| while read changes
-do
-
-	if [[ ${changes} == *.changes ]]; then
-		info "Found ${changes}, calling aptly-intake-import..."
-		/usr/bin/aptly-intake-import "${changes}" || warning "Unable to import ${changes}"
-	fi
-done
+	| /usr/lib/aptly-intake/aptly_intake_scheduler.py --scan "${QUEUE_DIRECTORY}"
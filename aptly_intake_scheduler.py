@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+
+import sys
+
+import argparse
+
+import threading
+
+import subprocess
+
+import configparser
+
+import aptly_intake
+
+# The scheduler reads the paths of the .changes files to import from
+# stdin (one per line, as printed by inotifywait in
+# aptly-intake-monitor) and runs aptly-intake-import on them, in
+# parallel and by priority.
+
+INTAKE_SETTINGS = "/var/lib/aptly-api/intake-settings"
+
+IMPORT_COMMAND = ["/usr/bin/aptly-intake-import"]
+
+config = configparser.ConfigParser()
+config.read(INTAKE_SETTINGS)
+
+DEFAULT_WORKERS = config.getint(
+	"Intake",
+	"APTLY_INTAKE_WORKERS",
+	fallback=4
+)
+DEFAULT_MAX_PER_DISTRIBUTION = config.getint(
+	"Intake",
+	"APTLY_INTAKE_MAX_PER_DISTRIBUTION",
+	fallback=1
+)
+
+# Priority classes, highest first, in the form
+#  name:channel/distribution[,channel/distribution...]
+# separated by spaces. Patterns are shell-style wildcards.
+DEFAULT_PRIORITIES = [
+	(name, patterns.split(","))
+	for name, patterns in (
+		x.split(":", 1)
+		for x in config.get(
+			"Intake",
+			"APTLY_INTAKE_PRIORITIES",
+			fallback=" ".join(
+				"%s:%s" % (x, ",".join(y))
+				for x, y in aptly_intake.DEFAULT_PRIORITIES
+			)
+		).split()
+	)
+]
+
+def catch_up(scheduler, queue_directory):
+	"""
+	Imports, in bulk, every .changes file that has been left in the
+	queue directory while the monitor wasn't running, and then queues
+	the ones that arrived in the meantime.
+
+	:param: scheduler: the IntakeScheduler to use
+	:param: queue_directory: the queue directory
+	"""
+
+	print("Importing backlog from %s..." % queue_directory)
+	if subprocess.call(IMPORT_COMMAND + ["--resume", "--scan", queue_directory]) != 0:
+		print("Unable to import the whole backlog")
+
+	# inotifywait is watching now, but files might have been moved
+	# in before that. Already imported files are skipped.
+	for directory, dirnames, filenames in os.walk(queue_directory):
+		for filename in sorted(filenames):
+			path = os.path.join(directory, filename)
+			if filename.endswith(".changes") and os.path.getsize(path) > 0:
+				scheduler.submit(path)
+
+def read_queue(scheduler):
+	"""
+	Submits every .changes file read from stdin to the scheduler.
+
+	:param: scheduler: the IntakeScheduler to use
+	"""
+
+	for line in sys.stdin:
+		changes = line.strip()
+
+		if changes.endswith(".changes"):
+			scheduler.submit(changes)
+
+	scheduler.close()
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description="Runs the imports of the .changes files read from stdin"
+	)
+	parser.add_argument(
+		"--scan",
+		metavar="QUEUE_DIRECTORY",
+		help="import the backlog of the given queue directory on startup"
+	)
+	args = parser.parse_args()
+
+	sys.stdout.reconfigure(line_buffering=True)
+
+	scheduler = aptly_intake.IntakeScheduler(
+		IMPORT_COMMAND,
+		workers=DEFAULT_WORKERS,
+		max_per_distribution=DEFAULT_MAX_PER_DISTRIBUTION,
+		priorities=DEFAULT_PRIORITIES,
+		debouncer=aptly_intake.PublishDebouncer(),
+		publish_command=IMPORT_COMMAND + ["--publish-pending"],
+	)
+
+	if args.scan is not None:
+		catch_up(scheduler, args.scan)
+
+	threading.Thread(
+		target=read_queue,
+		args=(scheduler,),
+		daemon=True
+	).start()
+
+	scheduler.run()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import sys
+
+import argparse
+
+import configparser
+
+import aptly_api
+
+INTAKE_SETTINGS = "/var/lib/aptly-api/intake-settings"
+
+config = configparser.ConfigParser()
+config.read(INTAKE_SETTINGS)
+
+def resync(shard, session):
+	"""
+	Fetches every repository, snapshot and publication of the given
+	aptly instance again.
+
+	:param: shard: the name of the aptly instance
+	:param: session: the AptlySession() of the aptly instance
+	"""
+
+	print("Resyncing the metadata mirror of %s" % shard)
+	session.mirror.resync(session)
+	print(
+		"%s: %d repositories, %d snapshots, %d publications" % (
+			shard,
+			len(session.mirror.list_repos()),
+			len(session.mirror.list_snapshots()),
+			len(session.mirror.list_publications())
+		)
+	)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description="Queries or resyncs the local mirror of aptly's metadata"
+	)
+	parser.add_argument(
+		"--resync",
+		action="store_true",
+		help="fetch everything from aptly again (on every aptly instance)"
+	)
+	parser.add_argument(
+		"--shard",
+		help="the aptly instance to query (default: the default one)"
+	)
+	parser.add_argument(
+		"--published-snapshots",
+		action="store_true",
+		help="list the published snapshots"
+	)
+	parser.add_argument(
+		"--versions",
+		nargs=2,
+		metavar=("REPOSITORY", "PACKAGE"),
+		help="list the versions of the given package in the given repository"
+	)
+	args = parser.parse_args()
+
+	with aptly_api.AptlyRouter.from_config(config) as router:
+		if router.mirror is None:
+			parser.error("The metadata mirror is not enabled, set APTLY_METADATA_MIRROR")
+
+		if args.resync:
+			router.map(resync)
+
+		mirror = router.get_session(args.shard or router.default).mirror
+
+		if args.published_snapshots:
+			for snapshot in sorted(mirror.get_published_snapshots()):
+				print(snapshot)
+
+		if args.versions:
+			repository, package = args.versions
+
+			if mirror.get_packages(repository) is None:
+				print(
+					"Package list of %s is not complete, run with --resync" % repository,
+					file=sys.stderr
+				)
+
+			for arch, version, ref in mirror.get_versions(repository, package):
+				print("%s %s (%s)" % (arch, version, ref))
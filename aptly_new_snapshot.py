@@ -27,17 +27,15 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import os
-
-import sys
-
 import uuid
 
+import argparse
+
 import configparser
 
 import aptly_api
 
-from debian.deb822 import Changes
+import aptly_intake
 
 ALLOWED_DISTRIBUTIONS = [
 	"bullseye",
@@ -76,6 +74,10 @@ DEFAULT_SIGNING_GPG_KEYRING = config.get(
 	fallback="/var/lib/aptly-api/.gnupg/pubring.kbx"
 )
 
+# Directory where a manifest of the packages added and removed by
+# every publish is written, for downstream mirrors. Disabled if empty.
+DEFAULT_MANIFEST_OUTBOX = aptly_intake.ManifestOutbox.from_config(config)
+
 # FIXME?
 DEFAULT_ARCHITECTURES = [
 	"source",
@@ -85,8 +87,16 @@ DEFAULT_ARCHITECTURES = [
 	"armhf",
 ]
 
-if __name__ == "__main__":
-	run_uuid = uuid.uuid4()
+def new_snapshot(router, shard, session, run_uuid):
+	"""
+	Snapshots every local repository of the given aptly instance, and
+	publishes the snapshots.
+
+	:param: router: an AptlyRouter() instance
+	:param: shard: the name of the aptly instance
+	:param: session: the AptlySession() of the aptly instance
+	:param: run_uuid: the uuid of the current run
+	"""
 
 	signing_configuration = aptly_api.AptlyAPISigningOptions(
 		[
@@ -95,47 +105,88 @@ if __name__ == "__main__":
 		]
 	)
 
-	with aptly_api.AptlySession("http://localhost:8080/") as session:
-
-		with aptly_api.AptlyAPILock() as lock:
-			# Get the list of local repositories related to the current
-			# channel and distribution combo
-			repo_list = session.LocalRepo.list()
-
-			channels_and_distributions = {
-				"_".join(x["Name"].split("_")[:2])
-				for x in repo_list if "_" in x["Name"] # meh
+	with session.lock() as lock:
+		# Get the list of local repositories related to the current
+		# channel and distribution combo
+		repo_list = session.LocalRepo.list()
+		published = session.PublishedRepo.list()
+
+		channels_and_distributions = {
+			"_".join(x["Name"].split("_")[:2])
+			for x in repo_list if "_" in x["Name"] # meh
+		}
+
+		for channel_and_distribution in channels_and_distributions:
+			channel, distribution = channel_and_distribution.split("_")
+
+			if not router.is_routed(shard, channel, distribution):
+				# Leftovers, this is served by another aptly instance
+				print("Skipping %s on %s, not served by it" % (channel_and_distribution, shard))
+				continue
+
+			repos = {
+				x["Name"] : x["DefaultComponent"] # FIXME: this is an assumption we make
+				for x in repo_list
+				if x["Name"].startswith("%s_%s_" % (channel, distribution))
 			}
 
-			for channel_and_distribution in channels_and_distributions:
-				channel, distribution = channel_and_distribution.split("_")
-
-				repos = {
-					x["Name"] : x["DefaultComponent"] # FIXME: this is an assumption we make
-					for x in repo_list
-					if x["Name"].startswith("%s_%s_" % (channel, distribution))
-				}
-
-				created_snapshots = []
-				for repo, component in repos.items():
-					snapshot_name = "%s_%s" % (repo, run_uuid)
-					print("Creating snapshot for repo %s" % repo)
-					session.LocalRepo(name=repo).snapshot(snapshot_name)
-					created_snapshots.append(
-						{
-							"Component" : component,
-							"Name" : snapshot_name
-						}
+			created_snapshots = []
+			for repo, component in repos.items():
+				snapshot_name = "%s_%s" % (repo, run_uuid)
+				print("Creating snapshot for repo %s" % repo)
+				session.LocalRepo(name=repo).snapshot(snapshot_name)
+				created_snapshots.append(
+					{
+						"Component" : component,
+						"Name" : snapshot_name
+					}
+				)
+
+			# Switch
+			target_published_distribution = session.PublishedDistribution(
+				prefix=channel,
+				distribution=distribution,
+			)
+
+			target_published_distribution.update(
+				snapshots=created_snapshots,
+				signing=signing_configuration,
+				force_overwrite=True,
+			)
+
+			if DEFAULT_MANIFEST_OUTBOX is not None:
+				try:
+					DEFAULT_MANIFEST_OUTBOX.emit(
+						session,
+						channel,
+						distribution,
+						aptly_intake.get_published_sources(published, channel, distribution),
+						created_snapshots
 					)
+				except Exception as e:
+					print("Unable to write the change manifest of %s/%s: %s" % (channel, distribution, e))
 
-				# Switch
-				target_published_distribution = session.PublishedDistribution(
-					prefix=channel,
-					distribution=distribution,
-				)
+			# Pending changes went out as well
+			aptly_intake.PublishDebouncer().mark_published(channel, distribution)
 
-				target_published_distribution.update(
-					snapshots=created_snapshots,
-					signing=signing_configuration,
-					force_overwrite=True,
-				)
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description="Snapshots every local repository and publishes the "
+		"snapshots"
+	)
+	parser.add_argument(
+		"--profile",
+		metavar="MODES",
+		help="profile the run: cpu, memory or all (default: $APTLY_INTAKE_PROFILE). "
+		"Profiles are written to /var/lib/aptly-intake/profiles"
+	)
+	args = parser.parse_args()
+
+	run_uuid = uuid.uuid4()
+
+	# Every aptly instance is snapshotted at the same time
+	with aptly_intake.profiled("new-snapshot", run_uuid, modes=args.profile), \
+		aptly_api.AptlyRouter.from_config(config) as router:
+		router.map(
+			lambda shard, session: new_snapshot(router, shard, session, run_uuid)
+		)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import sys
+
+import uuid
+
+import argparse
+
+import configparser
+
+import aptly_api
+
+import aptly_intake
+
+# How does the promotion work:
+#  1. The packages to promote are looked up in the source channel,
+#     either by query or by comparing the snapshots published in the
+#     source and target channels
+#  2. A lock is acquired
+#  3. The package refs are added to the target channel's local repos
+#     (no upload and no include: packages are already in aptly's pool)
+#  4. Every repository of the target channel is snapshotted
+#  5. The new snapshots gets published, once
+#  6. Lock is released
+#
+# Adding package refs is idempotent, so an interrupted promotion can
+# simply be run again.
+
+INTAKE_SETTINGS = "/var/lib/aptly-api/intake-settings"
+
+config = configparser.ConfigParser()
+config.read(INTAKE_SETTINGS)
+
+DEFAULT_VENDOR = config.get(
+	"Intake",
+	"APTLY_DEFAULT_VENDOR",
+	fallback="Droidian"
+)
+DEFAULT_SIGNING_GPG_FINGERPRINT = config.get(
+	"Intake",
+	"APTLY_SIGNING_GPG_FINGERPRINT",
+	fallback="3027CDD5DF3C0181264550A062F62D66F658C408"
+)
+
+# Directory where a manifest of the packages added and removed by
+# every publish is written, for downstream mirrors. Disabled if empty.
+DEFAULT_MANIFEST_OUTBOX = aptly_intake.ManifestOutbox.from_config(config)
+
+def get_diff(session, source, target, distribution):
+	"""
+	Returns, for every component, the package refs published in the
+	source channel but not in the target one.
+
+	:param: session: an AptlySession() instance
+	:param: source: the source channel
+	:param: target: the target channel
+	:param: distribution: the distribution
+	"""
+
+	published = session.PublishedRepo.list()
+
+	source_snapshots = aptly_intake.get_published_sources(published, source, distribution)
+	if source_snapshots is None:
+		raise Exception("%s/%s is not published" % (source, distribution))
+
+	target_snapshots = aptly_intake.get_published_sources(published, target, distribution) or {}
+
+	package_refs = {}
+	for component, snapshot in source_snapshots.items():
+		if component in target_snapshots:
+			package_refs[component] = [
+				x["Right"]
+				for x in session.SnapshotDiff(
+					name=target_snapshots[component],
+					with_snapshot=snapshot
+				).diff()
+				if x["Right"] is not None
+			]
+		else:
+			package_refs[component] = session.Snapshot(name=snapshot).search()
+
+	return package_refs
+
+def get_matching(session, source, distribution, queries):
+	"""
+	Returns, for every component, the package refs of the source
+	channel matching any of the given queries.
+
+	:param: session: an AptlySession() instance
+	:param: source: the source channel
+	:param: distribution: the distribution
+	:param: queries: a list of aptly package queries
+	"""
+
+	query = " | ".join("(%s)" % x for x in queries)
+
+	return {
+		x["DefaultComponent"] : session.LocalRepo(name=x["Name"]).search(q=query)
+		for x in session.LocalRepo.list()
+		if x["Name"].startswith("%s_%s_" % (source, distribution))
+	}
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description="Promotes packages from a channel to another, without "
+		"uploading or including them again"
+	)
+	parser.add_argument(
+		"distribution",
+		help="the distribution"
+	)
+	parser.add_argument(
+		"queries",
+		nargs="*",
+		metavar="query",
+		help="aptly package queries (e.g. 'Name (= foo)') selecting the "
+		"packages to promote"
+	)
+	parser.add_argument(
+		"--from",
+		dest="source",
+		default="staging",
+		help="the source channel (default: staging)"
+	)
+	parser.add_argument(
+		"--to",
+		dest="target",
+		default="production",
+		help="the target channel (default: production)"
+	)
+	parser.add_argument(
+		"--all",
+		action="store_true",
+		help="promote every package published in the source channel but "
+		"not in the target one"
+	)
+	parser.add_argument(
+		"--dry-run",
+		action="store_true",
+		help="only show what would be promoted"
+	)
+	args = parser.parse_args()
+
+	if bool(args.queries) == args.all:
+		parser.error("Either specify some queries or --all")
+
+	run_uuid = uuid.uuid4()
+
+	with aptly_api.AptlyRouter.from_config(config) as router:
+		# Packages are promoted within the same aptly database
+		shard = router.get_shard(args.source, args.distribution)
+		if not router.is_routed(shard, args.target, args.distribution):
+			parser.error(
+				"%s and %s are not served by the same aptly instance" % (
+					args.source,
+					args.target
+				)
+			)
+
+		session = router.get_session(shard)
+
+		if args.all:
+			package_refs = get_diff(session, args.source, args.target, args.distribution)
+		else:
+			package_refs = get_matching(session, args.source, args.distribution, args.queries)
+
+		package_refs = {
+			x : y
+			for x, y in package_refs.items()
+			if y
+		}
+
+		if not package_refs:
+			print("Nothing to promote")
+			sys.exit(0)
+
+		for component, refs in package_refs.items():
+			print(
+				"Promoting to %s_%s_%s:\n    - %s" % (
+					args.target,
+					args.distribution,
+					component,
+					"\n    - ".join(refs)
+				)
+			)
+
+		if args.dry_run:
+			sys.exit(0)
+
+		with session.lock() as lock:
+			repos = {
+				x["Name"] : x["DefaultComponent"] # FIXME: this is an assumption we make
+				for x in session.LocalRepo.list()
+				if x["Name"].startswith("%s_%s_" % (args.target, args.distribution))
+			}
+
+			for component, refs in package_refs.items():
+				target_repository_name = aptly_intake.get_repository(
+					session,
+					repos,
+					args.target,
+					args.distribution,
+					component
+				)
+
+				session.LocalRepo(name=target_repository_name).add_packages(refs)
+
+			created_snapshots = aptly_intake.snapshot_repositories(session, repos, run_uuid)
+
+			previous_snapshots = aptly_intake.publish_snapshots(
+				session,
+				args.target,
+				args.distribution,
+				created_snapshots,
+				aptly_api.AptlyAPISigningOptions(
+					[
+						("Skip", False),
+						("GpgKey", DEFAULT_SIGNING_GPG_FINGERPRINT),
+					]
+				),
+				"%s (%s channel)" % (DEFAULT_VENDOR, args.target),
+				DEFAULT_VENDOR,
+				aptly_intake.DEFAULT_ARCHITECTURES
+			)
+
+			if DEFAULT_MANIFEST_OUTBOX is not None:
+				try:
+					DEFAULT_MANIFEST_OUTBOX.emit(session, args.target, args.distribution, previous_snapshots, created_snapshots)
+				except Exception as e:
+					print("Unable to write the change manifest of %s/%s: %s" % (args.target, args.distribution, e))
+
+			# Pending changes of the target distribution went out as well
+			aptly_intake.PublishDebouncer().mark_published(args.target, args.distribution)
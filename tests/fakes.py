@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Fake aptly sessions and helpers shared by the tests
+"""
+
+import os
+
+import sys
+
+from contextlib import contextmanager
+
+from functools import cmp_to_key
+
+# The tools live at the top of the source tree
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if not ROOT in sys.path:
+	sys.path.insert(0, ROOT)
+
+import aptly_api
+
+def compare_versions(x, y):
+	"""
+	A stand-in for apt_pkg.version_compare(), good enough for dotted
+	numeric versions.
+	"""
+
+	x = [int(z) for z in x.split(".")]
+	y = [int(z) for z in y.split(".")]
+
+	return (x > y) - (x < y)
+
+def use_test_versions():
+	"""
+	Makes the retention engine sort versions without apt_pkg.
+	"""
+
+	from aptly_intake import retention
+
+	retention._version_key = cmp_to_key(lambda x, y: compare_versions(y, x))
+
+class FakeAptly:
+	"""
+	The state of a fake aptly instance: local repositories (as sets of
+	package refs), snapshots and publications.
+	"""
+
+	def __init__(self):
+		self.repos = {}
+		self.snapshots = {}
+		self.published = []
+		self.searches = []
+		self.deleted = []
+		self.uploads = {}
+
+	def publish(self, prefix, distribution, sources):
+		"""
+		Publishes the given { component : snapshot } sources.
+		"""
+
+		self.published = [
+			x
+			for x in self.published
+			if (x["Prefix"], x["Distribution"]) != (prefix, distribution)
+		] + [
+			{
+				"Prefix" : prefix,
+				"Distribution" : distribution,
+				"SourceKind" : "snapshot",
+				"Sources" : [
+					{ "Component" : x, "Name" : y }
+					for x, y in sources.items()
+				],
+			}
+		]
+
+def match(refs, q):
+	"""
+	Returns the refs matching a query made of "Name (= name)" terms.
+	"""
+
+	if q is None:
+		return sorted(refs)
+
+	return sorted(x for x in refs if "Name (= %s)" % x.split(" ")[1] in q)
+
+class FakeSession:
+	"""
+	A fake AptlySession() backed by a FakeAptly().
+	"""
+
+	def __init__(self, aptly, shard=None, mirror=None):
+		self.aptly = aptly
+		self.shard = shard
+		self.mirror = mirror
+		self.limiter = None
+
+	@contextmanager
+	def lock(self):
+		yield
+
+	@property
+	def LocalRepo(self):
+		aptly = self.aptly
+
+		class LocalRepo:
+			def __init__(self, name):
+				self.name = name
+
+			@staticmethod
+			def list():
+				return [
+					{ "Name" : x, "DefaultComponent" : x.split("_")[-1] }
+					for x in sorted(aptly.repos)
+				]
+
+			def search(self, q=None, format=None):
+				aptly.searches.append(("repo", self.name, q))
+				return match(aptly.repos[self.name], q)
+
+			def delete_packages(self, refs):
+				aptly.deleted += refs
+				aptly.repos[self.name] -= set(refs)
+
+			def snapshot(self, name):
+				aptly.snapshots[name] = set(aptly.repos[self.name])
+
+		return LocalRepo
+
+	@property
+	def Snapshot(self):
+		aptly = self.aptly
+
+		class Snapshot:
+			def __init__(self, name):
+				self.name = name
+
+			@staticmethod
+			def list():
+				return [{ "Name" : x } for x in sorted(aptly.snapshots)]
+
+			def search(self, q=None, format=None):
+				aptly.searches.append(("snapshot", self.name, q))
+				return match(aptly.snapshots[self.name], q)
+
+			def delete(self):
+				if any(
+					self.name == y["Name"]
+					for x in aptly.published
+					for y in x["Sources"]
+				):
+					raise Exception("unable to drop: snapshot is published")
+
+				del aptly.snapshots[self.name]
+
+		return Snapshot
+
+	@property
+	def Directory(self):
+		aptly = self.aptly
+
+		class Directory:
+			def __init__(self, dir):
+				self.dir = dir
+
+			def upload(self, fileobj):
+				aptly.uploads.setdefault(self.dir, []).append(fileobj.name)
+
+			def list(self):
+				if not self.dir in aptly.uploads:
+					raise aptly_api.AptlyAPIError(404, "directory doesn't exist")
+
+				return [os.path.basename(x) for x in aptly.uploads[self.dir]]
+
+		return Directory
+
+	@property
+	def PublishedRepo(self):
+		aptly = self.aptly
+
+		class PublishedRepo:
+			@staticmethod
+			def list():
+				return list(aptly.published)
+
+		return PublishedRepo
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+
+import tempfile
+
+import unittest
+
+from unittest import mock
+
+from tests.fakes import FakeAptly, FakeSession, use_test_versions
+
+import aptly_api
+
+import aptly_clean
+
+from aptly_intake import retention
+
+class CleanTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+
+		use_test_versions()
+
+		patcher = mock.patch.object(
+			retention,
+			"VERSION_INDEX",
+			os.path.join(self.directory.name, "version-index.db")
+		)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+		self.aptly = FakeAptly()
+		self.aptly.repos["staging_trixie_main"] = {
+			"Pamd64 foo 1.0 a",
+			"Pamd64 foo 1.1 b",
+			"Pamd64 foo 1.2 c",
+			"Pamd64 bar 2.0 d",
+		}
+
+	def clean(self, session):
+		with mock.patch.object(aptly_clean, "collect_uploads"), \
+			mock.patch.object(aptly_clean.subprocess, "check_call") as check_call:
+			aptly_clean.clean(aptly_api.DEFAULT_SHARD, session)
+
+		check_call.assert_called_once()
+
+	def test_clean_with_mirror_never_resynced(self):
+		mirror = aptly_api.MetadataMirror(os.path.join(self.directory.name, "metadata.db"))
+		self.addCleanup(mirror.close)
+
+		self.clean(FakeSession(self.aptly, mirror=mirror))
+
+		self.assertEqual(
+			self.aptly.repos["staging_trixie_main"],
+			{
+				"Pamd64 foo 1.2 c",
+				"Pamd64 bar 2.0 d",
+			} | (
+				# Kept by the default rules of the production and
+				# staging repositories
+				{ "Pamd64 foo 1.0 a", "Pamd64 foo 1.1 b" }
+			)
+		)
+
+	def test_clean_removes_old_versions(self):
+		self.aptly.repos["staging_bookworm_main"] = {
+			"Pamd64 foo 1.0 a",
+			"Pamd64 foo 1.1 b",
+		}
+
+		# Every import publishes a snapshot of the whole repository
+		session = FakeSession(self.aptly)
+		session.LocalRepo(name="staging_bookworm_main").snapshot("staging_bookworm_main_1")
+		self.aptly.publish("staging", "bookworm", { "main" : "staging_bookworm_main_1" })
+
+		self.clean(session)
+
+		self.assertEqual(self.aptly.repos["staging_bookworm_main"], { "Pamd64 foo 1.1 b" })
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+
+import time
+
+import tempfile
+
+import unittest
+
+from unittest import mock
+
+from aptly_intake import debounce
+
+class PublishDebouncerTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+
+		self.debouncer = debounce.PublishDebouncer(
+			60,
+			[("production/*", 0)],
+			path=os.path.join(self.directory.name, "publish-state.json")
+		)
+
+	def test_intervals(self):
+		self.assertEqual(self.debouncer.get_interval("staging", "trixie"), 60)
+		self.assertEqual(self.debouncer.get_interval("production", "trixie"), 0)
+
+	def test_first_publish_allowed(self):
+		self.assertTrue(self.debouncer.should_publish("staging", "trixie"))
+		self.assertEqual(self.debouncer.get_due(), [])
+		self.assertIsNone(self.debouncer.get_next_due())
+
+	def test_publishes_coalesced(self):
+		self.debouncer.mark_published("staging", "trixie")
+
+		self.assertFalse(self.debouncer.should_publish("staging", "trixie"))
+		self.assertFalse(self.debouncer.should_publish("staging", "trixie"))
+
+		# Not due yet
+		self.assertFalse(self.debouncer.is_due("staging", "trixie"))
+		self.assertEqual(self.debouncer.get_due(), [])
+		self.assertGreater(self.debouncer.get_next_due(), 0)
+
+		# Other distributions are not affected
+		self.assertTrue(self.debouncer.should_publish("staging", "sid"))
+		self.assertTrue(self.debouncer.should_publish("production", "trixie"))
+
+		with mock.patch.object(debounce.time, "time", return_value=time.time() + 61):
+			self.assertTrue(self.debouncer.is_due("staging", "trixie"))
+			self.assertEqual(self.debouncer.get_due(), [("staging", "trixie")])
+			self.assertEqual(self.debouncer.get_next_due(), 0)
+
+		self.assertEqual(self.debouncer.mark_published("staging", "trixie"), 2)
+		self.assertEqual(
+			self.debouncer.get_status()["staging/trixie"],
+			{
+				"pending" : False,
+				"coalesced" : 0,
+				"total_coalesced" : 2,
+				"publishes" : 2,
+			}
+		)
+
+	def test_state_shared(self):
+		self.debouncer.mark_published("staging", "trixie")
+
+		other = debounce.PublishDebouncer(60, path=self.debouncer.path)
+
+		self.assertFalse(other.should_publish("staging", "trixie"))
+		self.assertEqual(self.debouncer.get_status()["staging/trixie"]["coalesced"], 1)
+
+if __name__ == "__main__":
+	unittest.main()
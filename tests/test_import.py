@@ -0,0 +1,499 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+
+import hashlib
+
+import tempfile
+
+import unittest
+
+import configparser
+
+from types import SimpleNamespace
+
+from unittest import mock
+
+from tests.fakes import FakeAptly, FakeSession, use_test_versions
+
+import aptly_import
+
+import aptly_intake
+
+from aptly_intake import retention
+
+def get_config(**settings):
+	"""
+	Returns intake settings made of the given keys.
+	"""
+
+	config = configparser.ConfigParser()
+	config["Intake"] = settings
+
+	return config
+
+class PruneTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+
+		use_test_versions()
+
+		patcher = mock.patch.object(
+			retention,
+			"VERSION_INDEX",
+			os.path.join(self.directory.name, "version-index.db")
+		)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+		# foo 1.0 is live, foo 1.1 has just been included
+		self.aptly = FakeAptly()
+		self.aptly.repos["staging_bookworm_main"] = {
+			"Pamd64 foo 1.0 a",
+			"Pamd64 bar 1.0 b",
+		}
+		self.session = FakeSession(self.aptly)
+		self.session.LocalRepo(name="staging_bookworm_main").snapshot("staging_bookworm_main_0")
+		self.aptly.publish("staging", "bookworm", { "main" : "staging_bookworm_main_0" })
+		self.aptly.repos["staging_bookworm_main"].add("Pamd64 foo 1.1 c")
+
+		self.journal = SimpleNamespace(
+			channel="staging",
+			distributions=["bookworm"],
+			components=["main"]
+		)
+
+	def prune(self, config):
+		with mock.patch.object(aptly_import, "config", config):
+			aptly_import.prune(
+				self.session,
+				[(self.journal, { "Source" : "foo", "Binary" : "foo" })],
+				{ "staging_bookworm_main" : "main" }
+			)
+
+	def test_prune_removes_superseded_version(self):
+		self.prune(get_config())
+
+		self.assertEqual(
+			self.aptly.repos["staging_bookworm_main"],
+			{ "Pamd64 foo 1.1 c", "Pamd64 bar 1.0 b" }
+		)
+		self.assertEqual([x for x in self.aptly.searches if x[0] == "snapshot"], [])
+
+	def test_prune_keeps_pinned_versions(self):
+		self.aptly.publish("release", "bookworm", { "main" : "staging_bookworm_main_0" })
+
+		config = get_config(APTLY_RETENTION_KEEP_PUBLISHED="true")
+		self.prune(config)
+
+		self.assertIn("Pamd64 foo 1.0 a", self.aptly.repos["staging_bookworm_main"])
+
+		# The pinned snapshot is only fetched once
+		self.aptly.repos["staging_bookworm_main"].add("Pamd64 foo 1.2 d")
+		self.prune(config)
+
+		self.assertEqual(
+			self.aptly.repos["staging_bookworm_main"],
+			{ "Pamd64 foo 1.0 a", "Pamd64 foo 1.2 d", "Pamd64 bar 1.0 b" }
+		)
+		self.assertEqual(
+			[x for x in self.aptly.searches if x[0] == "snapshot"],
+			[("snapshot", "staging_bookworm_main_0", None)]
+		)
+
+class PreflightTest(unittest.TestCase):
+
+	PAYLOAD = b"Source: foo\nVersion: 1.0\nDistribution: trixie\nFiles:\n"
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+
+		self.changes_path = os.path.join(self.directory.name, "foo_1.0_amd64.changes")
+		with open(self.changes_path, "wb") as f:
+			f.write(b"Source: evil\nVersion: 9.0\nDistribution: trixie\nFiles:\n")
+
+		for name, value in (
+			("can_verify_signature", mock.Mock(return_value=True)),
+			("verify_signature", mock.Mock(return_value=self.PAYLOAD)),
+			("ImportJournal", mock.Mock(**{ "find.return_value" : None })),
+		):
+			patcher = mock.patch.object(aptly_intake, name, value)
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+		patcher = mock.patch.object(aptly_import, "DEFAULT_SIGNING_DISABLE_VERIFY_TRANSIT", False)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_signed_payload_parsed(self):
+		changes, digest, verified = aptly_import.preflight(self.changes_path)
+
+		self.assertEqual(changes["Source"], "foo")
+		self.assertEqual(verified, hashlib.sha256(self.PAYLOAD).hexdigest())
+
+		with open(self.changes_path, "rb") as f:
+			self.assertEqual(digest, hashlib.sha256(f.read()).hexdigest())
+
+	def test_unsigned_changes_refused(self):
+		aptly_intake.can_verify_signature.return_value = False
+
+		with self.assertRaisesRegex(Exception, "not a single cleartext signed message"):
+			aptly_import.preflight(self.changes_path)
+
+class FakePoolIndex:
+	"""
+	A PoolIndex() knowing the packages in POOL.
+	"""
+
+	POOL = {
+		"1" * 64 : "Pall foo-data 1.0 a",
+	}
+
+	def __init__(self, path):
+		pass
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		pass
+
+	def lookup(self, session, sha256):
+		return self.POOL.get(sha256)
+
+class ClassifyTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+
+		for name, value in (
+			("PoolIndex", FakePoolIndex),
+		):
+			patcher = mock.patch.object(aptly_intake, name, value)
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+		for name, value in (
+			("DEFAULT_DEDUPE_UPLOADS", True),
+			("DEFAULT_SIGNING_DISABLE_VERIFY_TRANSIT", False),
+		):
+			patcher = mock.patch.object(aptly_import, name, value)
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+		self.changes_path = os.path.join(self.directory.name, "foo_1.0_amd64.changes")
+		with open(self.changes_path, "wb") as f:
+			f.write(b"Source: foo\n")
+
+		self.journal = aptly_intake.ImportJournal.create(
+			"run",
+			self.changes_path,
+			"staging",
+			"trixie",
+			directory=os.path.join(self.directory.name, "journal")
+		)
+
+		self.changes = {
+			"Source" : "foo",
+			"files" : [
+				{ "name" : "foo-data_1.0_all.deb", "size" : "10", "section" : "main" },
+				{ "name" : "foo_1.0_amd64.deb", "size" : "20", "section" : "main" },
+			],
+			"Checksums-Sha256" : [
+				{ "name" : "foo-data_1.0_all.deb", "size" : "10", "sha256" : "1" * 64 },
+				{ "name" : "foo_1.0_amd64.deb", "size" : "20", "sha256" : "2" * 64 },
+			],
+		}
+
+	def test_known_files_referenced(self):
+		self.journal.mark_verified(self.journal.changes_sha256, "0" * 64)
+
+		aptly_import.classify(FakeSession(FakeAptly()), self.journal, self.changes)
+
+		self.assertEqual(
+			self.journal.known,
+			{
+				"foo-data_1.0_all.deb" : {
+					"component" : "main",
+					"key" : "Pall foo-data 1.0 a",
+					"size" : 10,
+				},
+			}
+		)
+
+	def test_unknown_files_uploaded(self):
+		self.journal.mark_verified(self.journal.changes_sha256, "0" * 64)
+		self.changes["Checksums-Sha256"][0]["sha256"] = "3" * 64
+
+		aptly_import.classify(FakeSession(FakeAptly()), self.journal, self.changes)
+
+		self.assertEqual(self.journal.known, {})
+
+	def test_unverified_files_uploaded(self):
+		aptly_import.classify(FakeSession(FakeAptly()), self.journal, self.changes)
+
+		self.assertEqual(self.journal.known, {})
+
+	def test_replaced_changes_refused(self):
+		self.journal.mark_verified(self.journal.changes_sha256, "0" * 64)
+		with open(self.changes_path, "wb") as f:
+			f.write(b"Source: bar\n")
+
+		with self.assertRaisesRegex(Exception, "changed since"):
+			aptly_import.classify(FakeSession(FakeAptly()), self.journal, self.changes)
+
+		self.assertFalse(self.journal.is_classified())
+
+class UploadTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+
+		self.queue = os.path.join(self.directory.name, "staging")
+		self.upload_directory = os.path.join(self.directory.name, "upload")
+		os.makedirs(self.queue)
+		os.makedirs(self.upload_directory)
+
+		for name, value in (
+			("DEFAULT_DEDUPE_UPLOADS", False),
+			("DEFAULT_LOCAL_STAGING", True),
+			("DEFAULT_UPLOAD_DIRECTORY", self.upload_directory),
+		):
+			patcher = mock.patch.object(aptly_import, name, value)
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+		self.deb = os.path.join(self.queue, "foo_1.0_amd64.deb")
+		with open(self.deb, "wb") as f:
+			f.write(b"deb")
+
+		changes_path = os.path.join(self.queue, "foo_1.0_amd64.changes")
+		with open(changes_path, "wb") as f:
+			f.write(b"Source: foo\n")
+
+		self.journal = aptly_intake.ImportJournal.create(
+			"run",
+			changes_path,
+			"staging",
+			"trixie",
+			directory=os.path.join(self.directory.name, "journal")
+		)
+		self.changes = {
+			"Source" : "foo",
+			"files" : [
+				{
+					"name" : "foo_1.0_amd64.deb",
+					"size" : "3",
+					"section" : "main",
+					"md5sum" : hashlib.md5(b"deb").hexdigest(),
+				},
+			],
+		}
+
+	def upload(self):
+		aptly_import.upload(FakeSession(FakeAptly()), self.journal, self.changes, set())
+
+		return os.path.join(
+			self.upload_directory,
+			self.journal.upload_directory("main"),
+			"foo_1.0_amd64.deb"
+		)
+
+	def test_staged_file_moved(self):
+		staged = self.upload()
+
+		self.assertFalse(os.path.exists(self.deb))
+		with open(staged, "rb") as f:
+			self.assertEqual(f.read(), b"deb")
+
+	def test_staged_file_copied_if_not_removable(self):
+		remove = os.remove
+
+		def fail_in_queue(path):
+			if os.path.dirname(path) == self.queue:
+				raise PermissionError(path)
+
+			remove(path)
+
+		with mock.patch.object(os, "remove", fail_in_queue):
+			staged = self.upload()
+
+		self.assertNotEqual(os.stat(staged).st_ino, os.stat(self.deb).st_ino)
+		self.assertEqual(os.path.getsize(self.deb), 0)
+		with open(staged, "rb") as f:
+			self.assertEqual(f.read(), b"deb")
+
+class CheckUploadedTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+
+		self.changes_path = os.path.join(self.directory.name, "staging", "foo_1.0_amd64.changes")
+		os.makedirs(os.path.dirname(self.changes_path))
+		with open(self.changes_path, "wb") as f:
+			f.write(b"Source: foo\n")
+
+		self.journal = aptly_intake.ImportJournal.create(
+			"run",
+			self.changes_path,
+			"staging",
+			"trixie",
+			directory=os.path.join(self.directory.name, "journal")
+		)
+		self.journal.mark_classified({})
+		self.journal.mark_file_uploaded("foo_1.0_amd64.deb", "main")
+		self.journal.mark_uploaded(["main"])
+
+		self.aptly = FakeAptly()
+
+	def test_uploaded_files_available(self):
+		self.aptly.uploads[self.journal.upload_directory("main")] = [
+			"foo_1.0_amd64.deb",
+			"foo_1.0_amd64.changes",
+		]
+
+		aptly_import.check_uploaded(FakeSession(self.aptly), self.journal, {})
+
+	def test_missing_directory(self):
+		with self.assertRaisesRegex(Exception, "is missing"):
+			aptly_import.check_uploaded(FakeSession(self.aptly), self.journal, {})
+
+	def test_other_errors_raised(self):
+		session = mock.Mock()
+		session.Directory.return_value.list.side_effect = ConnectionError("refused")
+
+		with self.assertRaises(ConnectionError):
+			aptly_import.check_uploaded(session, self.journal, {})
+
+class FinalizeTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+
+		self.changes_path = os.path.join(self.directory.name, "staging", "foo_1.0_amd64.changes")
+		os.makedirs(os.path.dirname(self.changes_path))
+		with open(self.changes_path, "wb") as f:
+			f.write(b"Source: foo\n")
+
+		self.journal = aptly_intake.ImportJournal.create(
+			"published",
+			self.changes_path,
+			"staging",
+			"trixie",
+			directory=os.path.join(self.directory.name, "journal")
+		)
+		self.journal.mark_published()
+
+		patcher = mock.patch.object(aptly_intake.ImportJournal, "find", return_value=self.journal)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def prepare(self):
+		with mock.patch.object(aptly_import, "preflight", side_effect=AssertionError("preflight")):
+			return aptly_import.prepare_import(mock.Mock(), [self.changes_path])
+
+	def test_interrupted_finalize_resumed(self):
+		# Interrupted after truncating the .changes file
+		with open(self.changes_path, "w") as f:
+			f.truncate(0)
+
+		self.assertEqual(self.prepare(), (None, [], []))
+		self.assertFalse(os.path.exists(self.journal.path))
+
+	def test_published_run_finalized(self):
+		self.assertEqual(self.prepare(), (None, [], []))
+		self.assertEqual(os.path.getsize(self.changes_path), 0)
+		self.assertFalse(os.path.exists(self.journal.path))
+
+	def test_new_upload_not_truncated(self):
+		with open(self.changes_path, "wb") as f:
+			f.write(b"Source: bar\n")
+
+		with mock.patch.object(aptly_import, "preflight", side_effect=Exception("new upload")):
+			session, runs, failed = aptly_import.prepare_import(mock.Mock(), [self.changes_path])
+
+		self.assertEqual(failed, [self.changes_path])
+		self.assertEqual(os.path.getsize(self.changes_path), len(b"Source: bar\n"))
+		self.assertFalse(os.path.exists(self.journal.path))
+
+class RunUUIDTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+
+		self.changes_path = os.path.join(self.directory.name, "staging", "foo_1.0_amd64.changes")
+		os.makedirs(os.path.dirname(self.changes_path))
+		with open(self.changes_path, "wb") as f:
+			f.write(b"Source: foo\n")
+
+		self.journal = aptly_intake.ImportJournal.create(
+			"interrupted",
+			self.changes_path,
+			"staging",
+			"trixie",
+			directory=os.path.join(self.directory.name, "journal")
+		)
+
+	def test_resumed_run(self):
+		with mock.patch.object(aptly_intake.ImportJournal, "find", return_value=self.journal):
+			self.assertEqual(aptly_import.get_run_uuid(self.changes_path), "interrupted")
+
+	def test_new_run(self):
+		with open(self.changes_path, "wb") as f:
+			f.write(b"Source: bar\n")
+
+		with mock.patch.object(aptly_intake.ImportJournal, "find", return_value=self.journal):
+			self.assertNotEqual(aptly_import.get_run_uuid(self.changes_path), "interrupted")
+
+	def test_new_journal_named_after_run(self):
+		router = mock.Mock()
+		router.is_routed.return_value = True
+
+		with mock.patch.object(aptly_intake.ImportJournal, "find", return_value=None), \
+			mock.patch.object(aptly_intake.ImportJournal, "create") as create:
+			aptly_import.get_journal(
+				router,
+				self.changes_path,
+				{ "Distribution" : "trixie" },
+				"digest",
+				run_uuid="profiled"
+			)
+
+		self.assertEqual(create.call_args[0][0], "profiled")
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+
+import shutil
+
+import hashlib
+
+import tempfile
+
+import unittest
+
+import subprocess
+
+from unittest import mock
+
+from aptly_intake import journal as intake_journal
+
+from aptly_intake import signature
+
+class JournalTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+
+		self.changes_path = os.path.join(self.directory.name, "foo_1.0_amd64.changes")
+		self.write_changes(b"Source: foo\n")
+
+	def write_changes(self, data):
+		with open(self.changes_path, "wb") as f:
+			f.write(data)
+
+		return hashlib.sha256(data).hexdigest()
+
+	def create(self, **kwargs):
+		return intake_journal.ImportJournal.create(
+			"run",
+			self.changes_path,
+			"staging",
+			"trixie",
+			directory=os.path.join(self.directory.name, "journal"),
+			**kwargs
+		)
+
+	def test_resume(self):
+		journal = self.create()
+		journal.mark_classified({})
+		journal.mark_file_uploaded("foo_1.0_amd64.deb", "main")
+		journal.mark_file_uploaded("foo-doc_1.0_all.deb", "contrib")
+		journal.mark_uploaded(["main", "contrib"])
+		journal.mark_component_included("main", ["Pamd64 foo 1.0 a"])
+
+		# As found by a new process
+		resumed = intake_journal.ImportJournal.find(
+			self.changes_path,
+			os.path.join(self.directory.name, "journal")
+		)
+		resumed.new_attempt()
+
+		self.assertEqual(resumed.run_uuid, "run")
+		self.assertEqual(resumed.state["attempts"], 2)
+		self.assertTrue(resumed.matches(self.changes_path))
+		self.assertTrue(resumed.done("uploaded"))
+		self.assertFalse(resumed.done("included"))
+		self.assertTrue(resumed.is_file_uploaded("foo_1.0_amd64.deb"))
+		self.assertEqual(resumed.uploaded_files("contrib"), ["foo-doc_1.0_all.deb"])
+		self.assertTrue(resumed.is_included("main"))
+		self.assertFalse(resumed.is_included("contrib"))
+
+		resumed.mark_component_included("contrib", [])
+		self.assertTrue(resumed.done("included"))
+
+	def test_pending_oldest_first(self):
+		first = self.create()
+
+		second = intake_journal.ImportJournal.create(
+			"second",
+			self.changes_path,
+			"staging",
+			"trixie",
+			directory=os.path.join(self.directory.name, "journal")
+		)
+		second.state["created"] = first.state["created"] - 1
+		second.commit()
+
+		self.assertEqual(
+			[x.run_uuid for x in intake_journal.ImportJournal.pending(os.path.join(self.directory.name, "journal"))],
+			["second", "run"]
+		)
+
+		first.remove()
+		second.remove()
+
+		self.assertEqual(intake_journal.ImportJournal.pending(os.path.join(self.directory.name, "journal")), [])
+
+	def test_replaced_changes_not_resumed(self):
+		journal = self.create()
+
+		self.write_changes(b"Source: bar\n")
+
+		self.assertFalse(journal.matches(self.changes_path))
+
+	def test_verified_contents_only(self):
+		digest = self.write_changes(b"Source: foo\n")
+		journal = self.create(changes_sha256=digest)
+
+		journal.mark_verified(hashlib.sha256(b"Source: bar\n").hexdigest(), "0" * 64)
+		self.assertFalse(journal.verified)
+
+		journal.mark_verified(digest, "0" * 64)
+		self.assertTrue(journal.verified)
+		self.assertEqual(journal.read_changes(), b"Source: foo\n")
+
+	def test_replaced_changes_refused(self):
+		journal = self.create(changes_sha256=self.write_changes(b"Source: foo\n"))
+		journal.mark_verified(journal.changes_sha256, "0" * 64)
+
+		self.write_changes(b"Source: bar\n")
+
+		with self.assertRaises(Exception):
+			journal.read_changes()
+
+SIGNED = b"""-----BEGIN PGP SIGNED MESSAGE-----
+Hash: SHA256
+
+Source: foo
+-----BEGIN PGP SIGNATURE-----
+
+c2lnbmF0dXJl
+-----END PGP SIGNATURE-----
+"""
+
+class SignatureTest(unittest.TestCase):
+
+	def test_verify_signature_checks_given_contents(self):
+		checked = []
+
+		def run(arguments, **kwargs):
+			with open(arguments[-1], "rb") as f:
+				checked.append(f.read())
+
+			return mock.Mock(returncode=0, stdout=b"Source: foo\n", stderr=b"")
+
+		with mock.patch.object(signature.subprocess, "run", run):
+			payload = signature.verify_signature("/nonexistent.changes", "keyring", SIGNED)
+
+		self.assertEqual(checked, [SIGNED])
+		self.assertEqual(payload, b"Source: foo\n")
+
+	def test_verify_signature_failure(self):
+		with mock.patch.object(
+			signature.subprocess,
+			"run",
+			return_value=mock.Mock(returncode=1, stdout=b"", stderr=b"BAD signature")
+		):
+			with self.assertRaisesRegex(Exception, "BAD signature"):
+				signature.verify_signature("/nonexistent.changes", "keyring", SIGNED)
+
+	def test_unsigned_contents_refused(self):
+		for data in (
+			b"Source: foo\n",
+			b"Source: evil\n\n" + SIGNED,
+			SIGNED + b"\nSource: evil\n",
+			SIGNED + SIGNED,
+		):
+			with self.assertRaises(Exception):
+				signature.check_signed_block("/nonexistent.changes", data)
+
+		signature.check_signed_block("/nonexistent.changes", b"\n" + SIGNED + b"\n")
+
+@unittest.skipUnless(shutil.which("gpg") and shutil.which("gpgv"), "gpg is not available")
+class GpgvTest(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.directory = tempfile.TemporaryDirectory()
+
+		home = os.path.join(cls.directory.name, "gnupg")
+		os.mkdir(home, 0o700)
+
+		def gpg(*arguments, data=None):
+			return subprocess.run(
+				["gpg", "--homedir", home, "--batch", "--pinentry-mode", "loopback", "--passphrase", ""] + list(arguments),
+				input=data,
+				stdout=subprocess.PIPE,
+				stderr=subprocess.DEVNULL,
+				check=True
+			).stdout
+
+		gpg("--quick-generate-key", "Test <test@example.com>", "default", "sign", "never")
+
+		cls.keyring = os.path.join(cls.directory.name, "keyring.gpg")
+		with open(cls.keyring, "wb") as f:
+			f.write(gpg("--export"))
+
+		cls.signed = gpg("--clearsign", data=b"Source: foo\nVersion: 1.0\n")
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.directory.cleanup()
+
+	def test_payload_returned(self):
+		payload = signature.verify_signature("/nonexistent.changes", self.keyring, self.signed)
+
+		self.assertEqual(payload, b"Source: foo\nVersion: 1.0\n")
+
+	def test_unsigned_paragraph_refused(self):
+		# gpgv alone would accept this
+		with self.assertRaisesRegex(Exception, "not a single cleartext signed message"):
+			signature.verify_signature(
+				"/nonexistent.changes",
+				self.keyring,
+				b"Source: evil\nVersion: 9.0\n\n" + self.signed
+			)
+
+	def test_tampered_payload_refused(self):
+		with self.assertRaisesRegex(Exception, "Unable to verify"):
+			signature.verify_signature(
+				"/nonexistent.changes",
+				self.keyring,
+				self.signed.replace(b"Source: foo", b"Source: bar")
+			)
+
+if __name__ == "__main__":
+	unittest.main()
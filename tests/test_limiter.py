@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+
+import tempfile
+
+import unittest
+
+import threading
+
+import multiprocessing
+
+from unittest import mock
+
+import configparser
+
+import aptly_api
+
+from aptly_api import limiter
+
+class AdaptiveLimitTest(unittest.TestCase):
+
+	def test_grows_when_saturated(self):
+		limit = limiter.AdaptiveLimit(1, 1, 4)
+
+		limit.acquire()
+		limit.release(0.1)
+
+		self.assertEqual(limit.get_status()["limit"], 2)
+
+		# Not while it's not fully used
+		limit.acquire()
+		limit.release(0.1)
+
+		self.assertEqual(limit.get_status()["limit"], 2)
+
+	def test_backs_off_on_failures(self):
+		limit = limiter.AdaptiveLimit(8, 1, 16)
+
+		limit.acquire()
+		limit.release(0.1, failed=True)
+
+		self.assertEqual(limit.get_status()["limit"], 4)
+		self.assertEqual(limit.get_status()["errors"], 1)
+
+		# Only once per average latency
+		limit.acquire()
+		limit.release(0.1, failed=True)
+
+		self.assertEqual(limit.get_status()["limit"], 4)
+
+	def test_backs_off_when_slow(self):
+		limit = limiter.AdaptiveLimit(8, 1, 16)
+
+		limit.acquire()
+		limit.release(0.1)
+		limit.decreased = 0
+		limit.latency = 0
+		limit.acquire()
+		limit.release(1)
+
+		self.assertEqual(limit.get_status()["limit"], 7)
+
+	def test_uploads_ignore_latency(self):
+		limit = limiter.AdaptiveLimit(8, 1, 16, latency_sensitive=False)
+
+		limit.acquire()
+		limit.release(0.1)
+		limit.acquire()
+		limit.release(10)
+
+		self.assertEqual(limit.get_status()["limit"], 8)
+
+	def test_acquire_waits(self):
+		limit = limiter.AdaptiveLimit(1, 1, 1)
+		limit.acquire()
+
+		acquired = threading.Event()
+
+		def acquire():
+			limit.acquire()
+			acquired.set()
+
+		thread = threading.Thread(target=acquire)
+		thread.start()
+
+		self.assertFalse(acquired.wait(0.1))
+		limit.release(0.1)
+		self.assertTrue(acquired.wait(5))
+		thread.join()
+
+		self.assertEqual(limit.get_status()["throttled"], 1)
+
+class ConcurrencyLimiterTest(unittest.TestCase):
+
+	def test_only_reads_back_off_when_slow(self):
+		concurrency_limiter = limiter.ConcurrencyLimiter()
+
+		for limit in concurrency_limiter.limits.values():
+			limit.acquire()
+			limit.release(0.1)
+			limit.decreased = 0
+			limit.latency = 0
+			limit.acquire()
+			limit.release(10)
+
+		status = concurrency_limiter.get_status()
+
+		self.assertLess(status["read"]["limit"], limiter.DEFAULT_LIMITS["read"][0])
+		self.assertEqual(status["mutate"]["limit"], limiter.DEFAULT_LIMITS["mutate"][0])
+		self.assertEqual(status["upload"]["limit"], limiter.DEFAULT_LIMITS["upload"][0])
+
+	def test_disabled_by_default(self):
+		config = configparser.ConfigParser()
+		config["Intake"] = {}
+
+		self.assertIsNone(aptly_api.AptlyRouter.from_config(config).limits)
+
+def hold(path, started, done):
+	"""
+	Holds a shared request slot until done is set.
+	"""
+
+	limit = limiter.SharedLimit("read", path, 1, 1, 1)
+	limit.acquire()
+	started.set()
+	done.wait(10)
+	limit.release(0.1)
+
+class SharedLimitTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+
+		self.path = os.path.join(self.directory.name, "default.json")
+
+	def test_limit_shared_by_processes(self):
+		started = multiprocessing.Event()
+		done = multiprocessing.Event()
+
+		process = multiprocessing.Process(target=hold, args=(self.path, started, done))
+		process.start()
+		self.addCleanup(process.join)
+		self.addCleanup(done.set)
+
+		self.assertTrue(started.wait(10))
+
+		limit = limiter.SharedLimit("read", self.path, 1, 1, 1)
+		acquired = threading.Event()
+
+		def acquire():
+			limit.acquire()
+			acquired.set()
+
+		thread = threading.Thread(target=acquire)
+		thread.start()
+
+		self.assertFalse(acquired.wait(0.3))
+		done.set()
+		self.assertTrue(acquired.wait(10))
+		thread.join()
+
+		limit.release(0.1)
+		self.assertEqual(limit.get_status()["requests"], 2)
+		self.assertEqual(limit.get_status()["in_flight"], 0)
+
+	def test_backoff_shared(self):
+		first = limiter.SharedLimit("mutate", self.path, 8, 1, 16)
+		second = limiter.SharedLimit("mutate", self.path, 8, 1, 16)
+
+		first.acquire()
+		first.release(0.1, failed=True)
+
+		self.assertEqual(second.get_status()["limit"], 4)
+
+	def test_dead_processes_forgotten(self):
+		limit = limiter.SharedLimit("upload", self.path, 1, 1, 1)
+		limit.acquire()
+
+		with mock.patch.object(limiter, "is_running", return_value=False):
+			self.assertEqual(limit.get_status()["in_flight"], 0)
+
+	def test_limiter_falls_back_to_process_limits(self):
+		path = os.path.join(self.directory.name, "file", "default.json")
+		with open(os.path.join(self.directory.name, "file"), "w"):
+			pass
+
+		concurrency_limiter = limiter.ConcurrencyLimiter(status_path=path)
+
+		self.assertIsNone(concurrency_limiter.status_path)
+		self.assertIsInstance(concurrency_limiter.limits["read"], limiter.AdaptiveLimit)
+		self.assertNotIsInstance(concurrency_limiter.limits["read"], limiter.SharedLimit)
+
+if __name__ == "__main__":
+	unittest.main()
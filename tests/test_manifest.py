@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import unittest
+
+from unittest import mock
+
+from aptly_intake import manifest
+
+SNAPSHOTS = {
+	"old" : [
+		{
+			"Key" : "Pamd64 libfoo1 1.0 a",
+			"Package" : "libfoo1",
+			"Source" : "libfoo (1.0)",
+			"Filename" : "libfoo1_1.0_amd64.deb",
+		},
+		{
+			"Key" : "Psource bar 2.0 b",
+			"Package" : "bar",
+			"Files" : " 0123 10 bar_2.0.dsc\n 4567 20 bar_2.0.tar.xz\n",
+		},
+	],
+	"new" : [
+		{
+			"Key" : "Pamd64 libfoo1 1.1 c",
+			"Package" : "libfoo1",
+			"Source" : "libfoo",
+			"Filename" : "libfoo1_1.1_amd64.deb",
+		},
+		{
+			"Key" : "Psource bar 2.0 b",
+			"Package" : "bar",
+			"Files" : " 0123 10 bar_2.0.dsc\n 4567 20 bar_2.0.tar.xz\n",
+		},
+	],
+}
+
+def get_session():
+	session = mock.Mock()
+	session.Snapshot.side_effect = lambda name: mock.Mock(
+		**{ "search.return_value" : SNAPSHOTS[name] }
+	)
+	session.SnapshotDiff.return_value.diff.return_value = [
+		{ "Left" : "Pamd64 libfoo1 1.0 a", "Right" : "Pamd64 libfoo1 1.1 c" },
+	]
+
+	return session
+
+class ManifestTest(unittest.TestCase):
+
+	def test_changed_pool_files(self):
+		changes = manifest.get_snapshot_changes(get_session(), { "main" : "old" }, { "main" : "new" })
+
+		self.assertEqual(
+			changes["main"],
+			{
+				"previous" : "old",
+				"snapshot" : "new",
+				"added" : ["Pamd64 libfoo1 1.1 c"],
+				"removed" : ["Pamd64 libfoo1 1.0 a"],
+				"added_files" : ["pool/main/libf/libfoo/libfoo1_1.1_amd64.deb"],
+				"removed_files" : ["pool/main/libf/libfoo/libfoo1_1.0_amd64.deb"],
+			}
+		)
+
+	def test_new_component(self):
+		changes = manifest.get_snapshot_changes(get_session(), {}, { "contrib" : "old" })
+
+		self.assertEqual(
+			changes["contrib"]["added_files"],
+			[
+				"pool/contrib/b/bar/bar_2.0.dsc",
+				"pool/contrib/b/bar/bar_2.0.tar.xz",
+				"pool/contrib/libf/libfoo/libfoo1_1.0_amd64.deb",
+			]
+		)
+		self.assertEqual(changes["contrib"]["removed_files"], [])
+
+	def test_unchanged_component(self):
+		session = get_session()
+
+		changes = manifest.get_snapshot_changes(session, { "main" : "new" }, { "main" : "new" })
+
+		self.assertEqual(changes["main"]["added_files"], [])
+		session.Snapshot.assert_not_called()
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+
+import tempfile
+
+import unittest
+
+from unittest import mock
+
+import aptly_api
+
+class MirrorTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+
+		self.mirror = aptly_api.MetadataMirror(os.path.join(self.directory.name, "metadata.db"))
+		self.addCleanup(self.mirror.close)
+
+		self.mirror.set_packages("staging_trixie_main", ["Pamd64 foo 1.0 a"])
+
+		self.session = aptly_api.AptlySession("http://localhost:8080", mirror=self.mirror)
+		self.addCleanup(self.session.close)
+
+	def request(self, *args, **kwargs):
+		return mock.Mock(status_code=200, json=mock.Mock(return_value={}))
+
+	def test_packages_recorded(self):
+		with mock.patch.object(self.session, "post", self.request):
+			self.session.LocalRepo(name="staging_trixie_main").add_packages(["Pamd64 foo 1.1 b"])
+
+		self.assertEqual(
+			sorted(self.mirror.get_packages("staging_trixie_main")),
+			["Pamd64 foo 1.0 a", "Pamd64 foo 1.1 b"]
+		)
+
+	def test_include_invalidates_packages(self):
+		with mock.patch.object(self.session, "post", self.request):
+			self.session.RepositoryDirectory(name="staging_trixie_main", dir="upload").include()
+
+		self.assertIsNone(self.mirror.get_packages("staging_trixie_main"))
+
+	def test_unrecorded_request_invalidates_packages(self):
+		with mock.patch.object(self.session, "post", self.request), \
+			mock.patch.object(self.mirror, "add_packages", side_effect=Exception("disk full")):
+			self.session.LocalRepo(name="staging_trixie_main").add_packages(["Pamd64 foo 1.1 b"])
+
+		self.assertIsNone(self.mirror.get_packages("staging_trixie_main"))
+		self.assertIs(self.session.mirror, self.mirror)
+
+	def test_broken_mirror_disabled(self):
+		with mock.patch.object(self.session, "post", self.request), \
+			mock.patch.object(self.mirror, "add_packages", side_effect=Exception("disk full")), \
+			mock.patch.object(self.mirror, "invalidate_packages", side_effect=Exception("disk full")):
+			self.session.LocalRepo(name="staging_trixie_main").add_packages(["Pamd64 foo 1.1 b"])
+
+		self.assertIsNone(self.session.mirror)
+
+if __name__ == "__main__":
+	unittest.main()
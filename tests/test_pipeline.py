@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import time
+
+import threading
+
+import unittest
+
+from unittest import mock
+
+import aptly_api
+
+from aptly_api import api
+
+from aptly_intake import pipeline
+
+class PipelineTest(unittest.TestCase):
+
+	def run_pipeline(self, first, second, items, depth=1):
+		return pipeline.Pipeline(first, second, depth=depth).run(items)
+
+	def test_results_in_order(self):
+		for depth in (0, 1, 3):
+			self.assertEqual(
+				self.run_pipeline(
+					lambda x: x * 2,
+					lambda x, y: (x, y),
+					range(5),
+					depth
+				),
+				[(x, x * 2) for x in range(5)]
+			)
+
+	def test_first_stage_overlaps(self):
+		second_started = threading.Event()
+		overlapped = []
+
+		def first(item):
+			if item == 1:
+				# Runs while the second stage of item 0 does
+				overlapped.append(second_started.wait(5))
+
+			return item
+
+		def second(item, result):
+			if item == 0:
+				second_started.set()
+
+			return result
+
+		self.assertEqual(self.run_pipeline(first, second, range(2)), [0, 1])
+		self.assertEqual(overlapped, [True])
+
+	def test_first_stage_error_raised_in_order(self):
+		processed = []
+
+		def first(item):
+			if item == 2:
+				raise ValueError(item)
+
+			return item
+
+		def second(item, result):
+			processed.append(item)
+
+			return result
+
+		for depth in (0, 1):
+			del processed[:]
+
+			with self.assertRaises(ValueError):
+				self.run_pipeline(first, second, range(5), depth)
+
+			# Items before the failed one went through both stages
+			self.assertEqual(processed, [0, 1])
+
+	def test_second_stage_error_stops_first_stage(self):
+		started = []
+
+		def first(item):
+			started.append(item)
+
+			return item
+
+		def second(item, result):
+			raise ValueError(item)
+
+		with self.assertRaises(ValueError):
+			self.run_pipeline(first, second, range(100))
+
+		# At most depth items, plus the one being handed over
+		self.assertLessEqual(len(started), 3)
+
+	def test_stats(self):
+		instance = pipeline.Pipeline(lambda x: x, lambda x, y: y, names=("upload", "import"))
+		instance.run(range(3))
+
+		self.assertEqual(instance.stats["upload"]["items"], 3)
+		self.assertEqual(instance.stats["import"]["items"], 3)
+		self.assertLessEqual(instance.max_depth, 1)
+
+class RouterTest(unittest.TestCase):
+
+	def test_sessions_created_once(self):
+		created = []
+
+		def create(*args, **kwargs):
+			# Leave time to the other threads to race
+			time.sleep(0.05)
+			created.append(args)
+
+			return mock.Mock()
+
+		router = aptly_api.AptlyRouter()
+		barrier = threading.Barrier(4)
+		sessions = []
+
+		def get_session():
+			barrier.wait()
+			sessions.append(router.get_session(router.default))
+
+		with mock.patch.object(api, "AptlySession", create):
+			threads = [threading.Thread(target=get_session) for x in range(4)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+
+		self.assertEqual(len(created), 1)
+		self.assertEqual(len({id(x) for x in sessions}), 1)
+
+if __name__ == "__main__":
+	unittest.main()
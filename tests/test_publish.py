@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import unittest
+
+from unittest import mock
+
+from aptly_intake import publish
+
+class PublishTest(unittest.TestCase):
+
+	def test_existing_repository(self):
+		session = mock.Mock()
+		repos = { "staging_trixie_main" : "main" }
+
+		self.assertEqual(
+			publish.get_repository(session, repos, "staging", "trixie", "main"),
+			"staging_trixie_main"
+		)
+		session.LocalRepo.create.assert_not_called()
+
+	def test_new_repository(self):
+		session = mock.Mock()
+		repos = {}
+
+		self.assertEqual(
+			publish.get_repository(session, repos, "production", "trixie", "contrib"),
+			"production_trixie_contrib"
+		)
+		session.LocalRepo.create.assert_called_once_with(
+			"production_trixie_contrib",
+			comment="Local repository for trixie/contrib",
+			default_distribution="trixie",
+			default_component="contrib"
+		)
+		self.assertEqual(repos, { "production_trixie_contrib" : "contrib" })
+
+if __name__ == "__main__":
+	unittest.main()
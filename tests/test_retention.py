@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+
+import tempfile
+
+import unittest
+
+import configparser
+
+from tests.fakes import FakeAptly, FakeSession, use_test_versions
+
+from aptly_intake import retention
+
+class RetentionTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+
+		use_test_versions()
+
+		self.index = retention.VersionIndex(
+			os.path.join(self.directory.name, "version-index.db")
+		).__enter__()
+		self.addCleanup(self.index.__exit__, None, None, None)
+
+	def test_update_ranks_new_versions(self):
+		self.index.update("staging_trixie_main", ["Pamd64 foo 1.0 a", "Pamd64 foo 1.10 c"])
+		self.index.update("staging_trixie_main", [
+			"Pamd64 foo 1.0 a",
+			"Pamd64 foo 1.10 c",
+			"Pamd64 foo 1.9 b",
+			"Pamd64 foo 2.0 d",
+		])
+
+		self.assertEqual(
+			self.index.connection.execute(
+				"SELECT version FROM packages WHERE repo = ? ORDER BY rank",
+				("staging_trixie_main",)
+			).fetchall(),
+			[("2.0",), ("1.10",), ("1.9",), ("1.0",)]
+		)
+
+	def test_get_pinned_snapshots(self):
+		aptly = FakeAptly()
+		aptly.publish("staging", "trixie", { "main" : "staging_trixie_main_1" })
+		aptly.publish("release", "trixie", { "main" : "staging_trixie_main_0" })
+
+		self.assertEqual(
+			retention.get_pinned_snapshots(aptly.published),
+			{ "staging_trixie_main_0" }
+		)
+
+	def test_published_refs_ignore_current_publications(self):
+		aptly = FakeAptly()
+		aptly.repos["staging_trixie_main"] = { "Pamd64 foo 1.0 a" }
+		session = FakeSession(aptly)
+
+		session.LocalRepo(name="staging_trixie_main").snapshot("staging_trixie_main_0")
+		aptly.publish("staging", "trixie", { "main" : "staging_trixie_main_0" })
+		self.assertEqual(retention.get_published_refs(session, self.index), set())
+
+		aptly.publish("release", "trixie", { "main" : "staging_trixie_main_0" })
+		self.assertEqual(
+			retention.get_published_refs(session, self.index),
+			{ "Pamd64 foo 1.0 a" }
+		)
+
+	def test_plan_keeps_newest_versions(self):
+		# Packages found when a repository is first indexed are as old
+		# as they can be
+		self.index.update("staging_trixie_main", ["Pamd64 baz 1.0 z"])
+		self.index.update("staging_trixie_main", [
+			"Pamd64 baz 1.0 z",
+			"Pamd64 foo 1.0 a",
+			"Pamd64 foo 1.1 b",
+			"Pamd64 foo 1.2 c",
+			"Pall foo 1.0 d",
+			"Pamd64 bar 2.0 e",
+		], now=1000)
+
+		policy = retention.RetentionPolicy(keep=[("staging_*", 2)])
+
+		self.assertEqual(policy.get_keep("staging_trixie_main"), 2)
+		self.assertEqual(policy.get_keep("production_trixie_main"), 1)
+		self.assertEqual(
+			policy.plan(self.index, "staging_trixie_main", now=2000),
+			["Pamd64 foo 1.0 a"]
+		)
+		self.assertEqual(
+			policy.plan(self.index, "staging_trixie_main", now=2000, names={"bar"}),
+			[]
+		)
+
+		# Too recent
+		policy.min_age = 1500
+		self.assertEqual(policy.plan(self.index, "staging_trixie_main", now=2000), [])
+
+	def test_plan_after_removal(self):
+		self.index.update("staging_trixie_main", [
+			"Pamd64 foo 1.0 a",
+			"Pamd64 foo 1.1 b",
+			"Pamd64 foo 1.2 c",
+		])
+		self.index.remove("staging_trixie_main", ["Pamd64 foo 1.2 c"])
+
+		self.assertEqual(
+			retention.RetentionPolicy(keep=[]).plan(self.index, "staging_trixie_main"),
+			["Pamd64 foo 1.0 a"]
+		)
+
+	def test_policy_from_config(self):
+		config = configparser.ConfigParser()
+		config["Intake"] = {
+			"APTLY_RETENTION_KEEP" : "production_*:3 staging_*:2",
+			"APTLY_RETENTION_MIN_AGE" : "1",
+		}
+
+		policy = retention.RetentionPolicy.from_config(config)
+
+		self.assertEqual(policy.keep, [("production_*", 3), ("staging_*", 2)])
+		self.assertFalse(policy.keep_published)
+		self.assertEqual(policy.min_age, 24 * 60 * 60)
+
+	def test_plan_keeps_pinned_packages(self):
+		self.index.update("staging_trixie_main", [
+			"Pamd64 foo 1.0 a",
+			"Pamd64 foo 1.1 b",
+			"Pamd64 foo 1.2 c",
+		])
+
+		self.assertEqual(
+			retention.RetentionPolicy(keep=[]).plan(
+				self.index,
+				"staging_trixie_main",
+				{ "Pamd64 foo 1.0 a" }
+			),
+			["Pamd64 foo 1.0 a", "Pamd64 foo 1.1 b"]
+		)
+		self.assertEqual(
+			retention.RetentionPolicy(keep=[], keep_published=True).plan(
+				self.index,
+				"staging_trixie_main",
+				{ "Pamd64 foo 1.0 a" }
+			),
+			["Pamd64 foo 1.1 b"]
+		)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import unittest
+
+from aptly_intake import scheduler
+
+class SchedulerTest(unittest.TestCase):
+
+	def setUp(self):
+		self.scheduler = scheduler.IntakeScheduler(
+			["true"],
+			workers=4,
+			max_per_distribution=2,
+			status_file=None
+		)
+
+	def queue(self, path, distribution="trixie"):
+		job = scheduler.IntakeJob(path, "staging", distribution, 0, self.scheduler.sequence)
+		self.scheduler.sequence += 1
+		self.scheduler.queue.append(job)
+
+		return job
+
+	def test_next_job_in_priority_order(self):
+		self.queue("/queue/foo_1.0_amd64.changes")
+		second = self.queue("/queue/bar_1.0_amd64.changes")
+		second.priority = -1
+
+		self.assertIs(self.scheduler.next_job(), second)
+
+	def test_running_path_not_started_again(self):
+		running = self.queue("/queue/foo_1.0_amd64.changes")
+		self.scheduler.queue.remove(running)
+		self.scheduler.running[running.path] = running
+
+		again = self.queue("/queue/foo_1.0_amd64.changes")
+		other = self.queue("/queue/bar_1.0_amd64.changes")
+
+		self.assertIs(self.scheduler.next_job(), other)
+
+		self.scheduler.queue.remove(other)
+		self.assertIsNone(self.scheduler.next_job())
+
+		del self.scheduler.running[running.path]
+		self.assertIs(self.scheduler.next_job(), again)
+
+	def test_max_per_distribution(self):
+		for name in ("foo", "bar"):
+			job = self.queue("/queue/%s_1.0_amd64.changes" % name)
+			self.scheduler.queue.remove(job)
+			self.scheduler.running[job.path] = job
+
+		self.queue("/queue/baz_1.0_amd64.changes")
+		other = self.queue("/queue/baz_1.0_amd64.changes", distribution="bookworm")
+
+		self.assertIs(self.scheduler.next_job(), other)
+
+if __name__ == "__main__":
+	unittest.main()
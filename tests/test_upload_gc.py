@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+
+import json
+
+import time
+
+import tempfile
+
+import unittest
+
+from aptly_intake import journal as intake_journal
+
+from aptly_intake import upload_gc
+
+RUN = "0a1b2c3d-0000-4000-8000-000000000001"
+OTHER_RUN = "0a1b2c3d-0000-4000-8000-000000000002"
+
+class FakeDirectory:
+	"""
+	A fake Directory section, listing the given directories.
+	"""
+
+	directories = []
+
+	def __init__(self, dir):
+		self.dir = dir
+
+	@classmethod
+	def list_directories(cls):
+		return list(cls.directories)
+
+class FakeSession:
+	shard = None
+	Directory = FakeDirectory
+
+class FindStaleTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.addCleanup(self.directory.cleanup)
+
+		self.journal_directory = os.path.join(self.directory.name, "journal")
+		self.upload_directory = os.path.join(self.directory.name, "upload")
+
+		FakeDirectory.directories = [
+			"%s-main" % RUN,
+			"%s-contrib" % OTHER_RUN,
+			"not-an-import",
+		]
+		for x in FakeDirectory.directories:
+			os.makedirs(os.path.join(self.upload_directory, x))
+
+		self.collector = upload_gc.UploadGarbageCollector(
+			FakeSession(),
+			upload_directory=self.upload_directory,
+			max_age=60,
+			journal_directory=self.journal_directory,
+			state_path=os.path.join(self.directory.name, "upload-gc.json")
+		)
+
+	def age(self, path, seconds):
+		os.utime(path, (time.time() - seconds, time.time() - seconds))
+
+	def create_journal(self, updated):
+		changes_path = os.path.join(self.directory.name, "foo.changes")
+		with open(changes_path, "w") as f:
+			f.write("Source: foo\n")
+
+		journal = intake_journal.ImportJournal.create(
+			RUN,
+			changes_path,
+			"staging",
+			"trixie",
+			directory=self.journal_directory
+		)
+
+		# commit() sets it to the current time
+		journal.state["updated"] = updated
+		with open(journal.path, "w") as f:
+			json.dump(journal.state, f)
+
+	def test_young_directories_kept(self):
+		self.assertEqual(self.collector.find_stale(), [])
+
+	def test_old_directories_collected(self):
+		for x in FakeDirectory.directories:
+			self.age(os.path.join(self.upload_directory, x), 120)
+
+		self.assertEqual(
+			sorted(self.collector.find_stale()),
+			["%s-main" % RUN, "%s-contrib" % OTHER_RUN]
+		)
+
+	def test_pending_journal_protects_directories(self):
+		for x in FakeDirectory.directories:
+			self.age(os.path.join(self.upload_directory, x), 120)
+
+		self.create_journal(time.time())
+
+		self.assertEqual(self.collector.find_stale(), ["%s-contrib" % OTHER_RUN])
+
+	def test_abandoned_journal_collected(self):
+		for x in FakeDirectory.directories:
+			self.age(os.path.join(self.upload_directory, x), 120)
+
+		self.create_journal(time.time() - 120)
+
+		self.assertEqual(
+			sorted(self.collector.find_stale()),
+			["%s-main" % RUN, "%s-contrib" % OTHER_RUN]
+		)
+
+	def test_remote_directories_aged_from_first_seen(self):
+		self.collector.upload_directory = None
+
+		self.assertEqual(self.collector.find_stale(), [])
+
+		with open(self.collector.state_path, "r") as f:
+			state = json.load(f)
+
+		state[""] = { x : y - 120 for x, y in state[""].items() }
+		with open(self.collector.state_path, "w") as f:
+			json.dump(state, f)
+
+		self.assertEqual(
+			sorted(self.collector.find_stale()),
+			["%s-main" % RUN, "%s-contrib" % OTHER_RUN]
+		)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# aptly-intake - pick up and publish with aptly
+# Copyright (C) 2020 Eugenio "g7" Paolantonio <me@medesimo.eu>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Startup-time benchmark of the aptly-intake entry points.
+
+Runs an entry point with --help (a run that does nothing but parse its
+arguments) several times, and fails if it takes longer than the budget
+on top of the interpreter's own startup, or if a module that should be
+loaded lazily is imported by such a run.
+
+The cold path of aptly-intake-import (everything it does with a
+.changes file before talking to aptly) is benchmarked as well, against
+its own budget.
+"""
+
+import os
+
+import sys
+
+import argparse
+
+import resource
+
+import statistics
+
+import tempfile
+
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Entry point, and its budget in milliseconds. Entry points are run as
+# scripts, which are compiled on every run: aptly-intake-import, being
+# the largest one, pays the most for it.
+DEFAULT_BUDGETS = {
+	"aptly_import.py" : 50,
+	"aptly_clean.py" : 25,
+	"aptly_new_snapshot.py" : 25,
+	"aptly_promote.py" : 25,
+	"aptly_mirror.py" : 25,
+}
+
+# Budget of the cold path of an import, in milliseconds: compiling
+# aptly-intake-import, validating a .changes file (which loads
+# debian.deb822) and setting up the session (which loads requests).
+# Those two modules account for most of it
+IMPORT_BUDGET = 200
+
+# Runs the cold path of an import on the .changes file given as the
+# first argument. The script is compiled like when it's run, but its
+# main block is not: signatures are not verified (gpgv is an external
+# command), and aptly is not contacted.
+IMPORT_COLD_PATH = """
+import sys
+import runpy
+
+script = runpy.run_path("aptly_import.py", run_name="aptly_import")
+script["preflight"].__globals__["DEFAULT_SIGNING_DISABLE_VERIFY_TRANSIT"] = True
+
+changes, digest, verified = script["preflight"](sys.argv[1])
+script["get_package_names"](changes)
+
+router = script["aptly_api"].AptlyRouter()
+router.get_session(router.default)
+router.close()
+"""
+
+SAMPLE_CHANGES = """Format: 1.8
+Date: Mon, 19 Oct 2026 00:00:00 +0000
+Source: foo
+Binary: foo
+Architecture: amd64
+Version: 1.0
+Distribution: trixie
+Urgency: medium
+Maintainer: Foo <foo@example.com>
+Changes:
+ foo (1.0) trixie; urgency=medium
+ .
+   * Release.
+Checksums-Sha256:
+ e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855 0 foo_1.0_amd64.deb
+Files:
+ d41d8cd98f00b204e9800998ecf8427e 0 main optional foo_1.0_amd64.deb
+"""
+
+# Modules that must only be imported when they're actually used
+LAZY_MODULES = [
+	"requests",
+	"urllib3",
+	"debian.deb822",
+	"apt_pkg",
+]
+
+def parse_importtime(output):
+	"""
+	Returns a list of (module, cumulative time in microseconds,
+	top-level) tuples of the imports in the given `-X importtime`
+	output, in import order. The module names of the imports made by
+	other modules are indented.
+
+	:param: output: the standard error of the interpreter
+	"""
+
+	imports = []
+
+	for line in output.splitlines():
+		if not line.startswith("import time:"):
+			continue
+
+		_, cumulative, name = line[len("import time:"):].split("|")
+		if not cumulative.strip().isdigit():
+			# Header
+			continue
+
+		imports.append((name[1:], int(cumulative), not name[1:].startswith(" ")))
+
+	return imports
+
+def run(arguments, importtime=False):
+	"""
+	Runs the interpreter with the given arguments, and returns the CPU
+	time it used (in milliseconds, less noisy than the wall-clock time)
+	and its standard error.
+
+	:param: arguments: the arguments of the interpreter
+	:param: importtime: if True, the interpreter reports the time spent
+	importing every module on its standard error
+	"""
+
+	before = resource.getrusage(resource.RUSAGE_CHILDREN)
+	result = subprocess.run(
+		[sys.executable] + (["-X", "importtime"] if importtime else []) + arguments,
+		cwd=ROOT,
+		env={
+			**os.environ,
+			"PYTHONPATH" : ROOT,
+		},
+		stdout=subprocess.DEVNULL,
+		stderr=subprocess.PIPE,
+		universal_newlines=True,
+		check=True
+	)
+
+	after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+	return (
+		(after.ru_utime - before.ru_utime + after.ru_stime - before.ru_stime) * 1000,
+		result.stderr
+	)
+
+def measure(arguments):
+	"""
+	Runs the interpreter once with the given arguments, and once doing
+	nothing, and returns the CPU time they used (in milliseconds).
+
+	:param: arguments: the arguments of the interpreter
+	"""
+
+	elapsed, _ = run(arguments)
+	baseline, _ = run(["-c", "pass"])
+
+	return elapsed, baseline
+
+def get_imported(entry_point):
+	"""
+	Returns the names of the modules imported by a run of the given
+	entry point with --help.
+
+	:param: entry_point: the path of the entry point
+	"""
+
+	_, output = run([entry_point, "--help"], importtime=True)
+
+	return {x.strip() for x, y, z in parse_importtime(output)}
+
+def check_budget(name, arguments, budget, runs):
+	"""
+	Runs the interpreter with the given arguments several times, and
+	returns True if the median CPU time it used, on top of the
+	interpreter's own startup, is within the given budget.
+
+	:param: name: the name of what is benchmarked
+	:param: arguments: the arguments of the interpreter
+	:param: budget: the budget, in milliseconds
+	:param: runs: the number of runs
+	"""
+
+	times, baselines = zip(*(measure(arguments) for i in range(runs)))
+
+	# On top of the interpreter's own startup
+	baseline = statistics.median(baselines)
+	times = [x - baseline for x in times]
+
+	median = statistics.median(times)
+
+	print(
+		"%s: %.1fms median over %d runs (min %.1fms, max %.1fms), budget %dms" % (
+			name,
+			median,
+			runs,
+			min(times),
+			max(times),
+			budget
+		)
+	)
+
+	if median > budget:
+		print("    FAIL: over budget by %.1fms" % (median - budget))
+		return False
+
+	return True
+
+def benchmark(entry_point, budget, runs):
+	"""
+	Benchmarks the startup of the given entry point, and returns True
+	if it is within its budget.
+
+	:param: entry_point: the path of the entry point, relative to ROOT
+	:param: budget: the budget, in milliseconds
+	:param: runs: the number of runs
+	"""
+
+	ok = check_budget(
+		"%s --help" % entry_point,
+		[entry_point, "--help"],
+		budget,
+		runs
+	)
+
+	eager = sorted(x for x in LAZY_MODULES if x in get_imported(entry_point))
+
+	if eager:
+		print("    FAIL: imported at startup: %s" % ", ".join(eager))
+		ok = False
+
+	return ok
+
+def benchmark_import(budget, runs):
+	"""
+	Benchmarks the cold path of an import (see IMPORT_COLD_PATH), and
+	returns True if it is within its budget.
+
+	:param: budget: the budget, in milliseconds
+	:param: runs: the number of runs
+	"""
+
+	with tempfile.TemporaryDirectory() as directory:
+		changes_path = os.path.join(directory, "staging", "foo_1.0_amd64.changes")
+		os.makedirs(os.path.dirname(changes_path))
+
+		with open(changes_path, "w") as f:
+			f.write(SAMPLE_CHANGES)
+
+		open(os.path.join(directory, "staging", "foo_1.0_amd64.deb"), "w").close()
+
+		return check_budget(
+			"aptly_import.py cold path",
+			["-c", IMPORT_COLD_PATH, changes_path],
+			budget,
+			runs
+		)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description="Checks the startup time of the aptly-intake entry points"
+	)
+	parser.add_argument(
+		"entry_points",
+		nargs="*",
+		metavar="entry_point",
+		help="the entry points to check (default: %s)" % ", ".join(DEFAULT_BUDGETS)
+	)
+	parser.add_argument(
+		"--budget",
+		type=int,
+		help="the budget, in milliseconds (default: the entry point's own)"
+	)
+	parser.add_argument(
+		"--runs",
+		type=int,
+		default=7,
+		help="the number of runs (default: 7)"
+	)
+	args = parser.parse_args()
+
+	results = [
+		benchmark(
+			entry_point,
+			args.budget or DEFAULT_BUDGETS.get(entry_point, max(DEFAULT_BUDGETS.values())),
+			args.runs
+		)
+		for entry_point in (args.entry_points or DEFAULT_BUDGETS)
+	]
+
+	if not args.entry_points or "aptly_import.py" in args.entry_points:
+		results.append(benchmark_import(args.budget or IMPORT_BUDGET, args.runs))
+
+	if not all(results):
+		sys.exit(1)